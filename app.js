@@ -161,53 +161,41 @@ async function processFiles() {
     const file1Input = document.getElementById('file1-input');
     const file2Input = document.getElementById('file2-input');
     
-    const file1 = file1Input.files[0];
-    const file2 = file2Input.files[0];
+    // Uno o varios archivos por lado (p. ej. un Crystal por sede)
+    const files1 = Array.from(file1Input.files);
+    const files2 = Array.from(file2Input.files);
     
-    if (!file1 || !file2) {
+    if (!files1.length || !files2.length) {
         showToast('❌ Debes seleccionar ambos archivos', 'error');
         return;
     }
     
-    if (!file1.name.match(/\.(xlsx|xls)$/i) || !file2.name.match(/\.(xlsx|xls)$/i)) {
-        showToast('❌ Ambos archivos deben ser de Excel (.xlsx o .xls)', 'error');
+    if (![...files1, ...files2].every(file => file.name.match(/\.(xlsx|xls)$/i))) {
+        showToast('❌ Todos los archivos deben ser de Excel (.xlsx o .xls)', 'error');
         return;
     }
     
     console.log('📤 Iniciando procesamiento de archivos...');
     
     cancelRequested = false;
-    currentProcessId = Date.now().toString();
+    currentProcessId = null;
     
     const formData = new FormData();
-    formData.append('file1', file1);
-    formData.append('file2', file2);
+    files1.forEach(file => formData.append('file1', file));
+    files2.forEach(file => formData.append('file2', file));
     
     toggleProcessingUI(true);
-    updateProgress(10);
+    updateProgress(5);
     
     try {
-        updateProgress(20);
-        
         console.log('🔄 Enviando archivos al servidor...');
         
-        const controller = new AbortController();
-        const timeoutId = setTimeout(() => controller.abort(), 300000);
-        
         // ✅ URL CORREGIDA para Render - usa ruta relativa
         const response = await fetch('/upload', {
             method: 'POST',
-            body: formData,
-            signal: controller.signal
+            body: formData
         });
         
-        clearTimeout(timeoutId);
-        
-        if (cancelRequested) {
-            showToast('ℹ️ Proceso interrumpido por el usuario', 'info');
-            return;
-        }
-        
         console.log('✅ Respuesta recibida del servidor. Status:', response.status);
         
         if (!response.ok) {
@@ -221,7 +209,19 @@ async function processFiles() {
             throw new Error(errorData.error || `Error del servidor: ${response.status}`);
         }
         
-        const data = await response.json();
+        const job = await response.json();
+        currentProcessId = job.process_id;
+        console.log('🆔 Proceso encolado:', currentProcessId);
+        
+        const finalStatus = await pollProcessStatus(currentProcessId);
+        
+        if (cancelRequested || finalStatus === 'cancelled') {
+            showToast('ℹ️ Proceso interrumpido por el usuario', 'info');
+            return;
+        }
+        
+        const resultResponse = await fetch(`/result/${currentProcessId}`);
+        const data = await resultResponse.json();
         console.log('📊 Datos recibidos del servidor:', data);
         
         if (cancelRequested) {
@@ -241,14 +241,12 @@ async function processFiles() {
         updateProgress(100);
         showToast('✅ Archivos procesados correctamente', 'success');
         
-        processData(data);
+        await processData(data);
         
     } catch (error) {
         console.error('Error en processFiles:', error);
         
-        if (error.name === 'AbortError') {
-            showToast('⏰ Tiempo de espera agotado. El proceso tomó demasiado tiempo.', 'error');
-        } else if (error.name === 'TypeError' && error.message.includes('fetch')) {
+        if (error.name === 'TypeError' && error.message.includes('fetch')) {
             showToast('❌ Error de conexión. Verifica que el servidor esté funcionando.', 'error');
         } else if (!cancelRequested) {
             showToast(`❌ Error: ${error.message}`, 'error');
@@ -263,7 +261,38 @@ async function processFiles() {
     }
 }
 
-function processData(data) {
+function sleep(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
+}
+
+async function pollProcessStatus(processId) {
+    // Consulta el progreso del proceso hasta que termine
+    while (!cancelRequested) {
+        const response = await fetch(`/status/${processId}`);
+        if (!response.ok) {
+            throw new Error('No se pudo consultar el estado del proceso');
+        }
+        
+        const state = await response.json();
+        if (state.status === 'completed' || state.status === 'error' || state.status === 'cancelled') {
+            return state.status;
+        }
+        
+        if (state.status === 'waiting_memory') {
+            // Admitido pero esperando memoria libre en el servidor
+            const progressText = document.getElementById('progress-text');
+            if (progressText) {
+                progressText.textContent = `En espera de memoria disponible (posición ${state.queue_position})...`;
+            }
+        } else {
+            updateProgress(Math.max(5, state.progress || 0));
+        }
+        await sleep(1000);
+    }
+    return 'cancelled';
+}
+
+async function processData(data) {
     console.log('Procesando datos recibidos...', data);
     
     const resultSection = document.getElementById('result');
@@ -278,9 +307,16 @@ function processData(data) {
     }
     
     updateGlobalData(data.totals);
-    populateFilters(data.professionals, data.usuarios_crystal, data.usuarios_query);
     
+    // El resumen no trae listas completas: se consultan paginadas en /jobs
     window.appData = data;
+    await populateFilters(data.process_id);
+    
+    const downloadAllButton = document.getElementById('download-all-button');
+    if (downloadAllButton && data.process_id) {
+        downloadAllButton.href = `/download-all/${data.process_id}`;
+        downloadAllButton.style.display = 'inline-block';
+    }
     
     if (data.column_mapping) {
         console.log('Columnas utilizadas:', data.column_mapping);
@@ -307,44 +343,60 @@ function updateGlobalData(totals) {
     }
 }
 
-function populateFilters(professionals, usuariosCrystal, usuariosQuery) {
-    console.log('Llenando filtros. Profesionales:', professionals, 'Usuarios Crystal:', usuariosCrystal, 'Usuarios Query:', usuariosQuery);
-    
+async function fetchJobPage(processId, path, params) {
+    const query = new URLSearchParams(params).toString();
+    const response = await fetch(`/jobs/${processId}/${path}?${query}`);
+    if (!response.ok) {
+        throw new Error(`No se pudo consultar ${path}`);
+    }
+    return response.json();
+}
+
+async function populateFilters(processId) {
     const professionalFilter = document.getElementById('professional-filter');
-    const userFilter = document.getElementById('user-filter');
     
     if (professionalFilter) {
         professionalFilter.innerHTML = '<option value="">Todos los profesionales (Crystal)</option>';
-        if (professionals && professionals.length > 0) {
-            professionals.forEach(prof => {
+        let page = 1;
+        let pages = 1;
+        while (page <= pages) {
+            const result = await fetchJobPage(processId, 'professionals', { page, per_page: 1000 });
+            result.items.forEach(item => {
                 const option = document.createElement('option');
-                option.value = prof;
-                option.textContent = prof;
+                option.value = item.profesional;
+                option.textContent = item.profesional;
                 professionalFilter.appendChild(option);
             });
-            console.log(`✅ Filtro de profesionales cargado: ${professionals.length} opciones`);
+            pages = result.pages;
+            page++;
         }
+        console.log(`✅ Filtro de profesionales cargado: ${professionalFilter.options.length - 1} opciones`);
     }
     
-    if (userFilter) {
-        userFilter.innerHTML = '<option value="">Todos los usuarios (Query)</option>';
-        if (usuariosQuery && usuariosQuery.length > 0) {
-            usuariosQuery.forEach(user => {
-                const option = document.createElement('option');
-                option.value = user;
-                option.textContent = user;
-                userFilter.appendChild(option);
-            });
-            console.log(`✅ Filtro de usuarios Query cargado: ${usuariosQuery.length} opciones`);
-        }
-    }
+    await loadUserOptions('');
+}
+
+async function loadUserOptions(search) {
+    // Solo la primera página de coincidencias: el buscador acota el resto
+    const userFilter = document.getElementById('user-filter');
+    if (!userFilter || !window.appData) return;
+    
+    const result = await fetchJobPage(window.appData.process_id, 'users', { source: 'query', q: search, per_page: 100 });
+    userFilter.innerHTML = `<option value="">Todos los usuarios (Query) - ${result.total.toLocaleString()}</option>`;
+    result.items.forEach(item => {
+        const option = document.createElement('option');
+        option.value = item.usuario;
+        option.textContent = item.usuario;
+        userFilter.appendChild(option);
+    });
+    console.log(`✅ Filtro de usuarios Query cargado: ${result.items.length} de ${result.total} opciones`);
 }
 
 // ========================================================
 // FUNCIONES DE BÚSQUEDA Y FILTRADO
 // ========================================================
 
-function searchData() {
+async function searchData() {
     const professionalFilter = document.getElementById('professional-filter');
     const userFilter = document.getElementById('user-filter');
     
@@ -362,11 +414,14 @@ function searchData() {
     let foundData = false;
     
     // Buscar en profesionales (CRYSTAL)
-    if (selectedProfessional && window.appData.professional_data && window.appData.professional_data[selectedProfessional]) {
-        const profData = window.appData.professional_data[selectedProfessional];
-        resultHTML = createProfessionalHTML(selectedProfessional, profData);
-        foundData = true;
-        console.log(`✅ Datos encontrados para profesional: ${selectedProfessional}`);
+    if (selectedProfessional) {
+        const response = await fetch(`/jobs/${window.appData.process_id}/professionals/${encodeURIComponent(selectedProfessional)}`);
+        if (response.ok) {
+            const profData = await response.json();
+            resultHTML = createProfessionalHTML(selectedProfessional, profData);
+            foundData = true;
+            console.log(`✅ Datos encontrados para profesional: ${selectedProfessional}`);
+        }
     }
     
     // Buscar en validación de Query (si no se seleccionó nada específico)
@@ -563,6 +618,17 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
+    const userSearch = document.getElementById('user-search');
+    if (userSearch) {
+        let searchTimer = null;
+        userSearch.addEventListener('input', function() {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(() => {
+                loadUserOptions(userSearch.value.trim()).catch(error => console.error('Error buscando usuarios:', error));
+            }, 300);
+        });
+    }
+    
     const file1Input = document.getElementById('file1-input');
     const file2Input = document.getElementById('file2-input');
     
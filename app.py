@@ -1,13 +1,44 @@
-from flask import Flask, request, jsonify, send_file, render_template
-import pandas as pd
-import numpy as np
+import time
+APP_IMPORT_STARTED = time.perf_counter()  # Inicio del arranque (ver /healthz)
+
+from flask import Flask, Response, request, jsonify, send_file, render_template
+from werkzeug.utils import safe_join
 import os
 import gc
-import psutil
-from openpyxl import Workbook
 import tempfile
 import uuid
 import re
+import hashlib
+import shutil
+import stat
+import struct
+import zlib
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+import json
+import threading
+import multiprocessing
+import gzip
+import importlib.util
+import itertools
+import bisect
+import csv
+import datetime
+import sqlite3
+import socket
+import logging
+import sys
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import orjson
+except ImportError:  # Sin orjson se usa el json de la biblioteca estándar
+    orjson = None
 
 app = Flask(__name__, 
            static_folder='static', 
@@ -15,10 +46,224 @@ app = Flask(__name__,
            static_url_path='/static')
 
 # Configuración para Render
-app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB para Render
+# 50MB para Render; con el motor sqlite se pueden admitir archivos más grandes
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 50)) * 1024 * 1024
 
 # Variable global para controlar procesos
 active_processes = {}
+process_lock = threading.Lock()
+
+# Resultados de trabajos terminados: {process_id: {"status", "result", "finished_at"}}
+job_results = {}
+
+# Pool acotado de trabajadores en segundo plano (hilos; los reportes se
+# escriben en un pool de procesos aparte, ver REPORT_WORKERS)
+MAX_JOB_WORKERS = int(os.environ.get('MAX_JOB_WORKERS', 2))
+JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL', 3600))  # segundos
+job_executor = ThreadPoolExecutor(max_workers=MAX_JOB_WORKERS, thread_name_prefix="job")
+
+# ========================================================
+# REGISTRO ESTRUCTURADO (LOGS CON PROCESS_ID)
+# ========================================================
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()  # text | json
+
+# Campos de extra={...} que se incluyen en las líneas JSON
+LOG_EXTRA_FIELDS = ("phase", "seconds", "rss_mb", "status")
+
+# Proceso al que pertenece el código en ejecución ("-" fuera de un trabajo)
+current_process_id = contextvars.ContextVar('current_process_id', default='-')
+
+logger = logging.getLogger("servicios_medicos")
+
+def add_log_context(record):
+    """
+    Filtro del handler: agrega el process_id a cada registro y, en formato
+    JSON, arma la línea completa (mensaje, campos extra y traza de error)
+    """
+    record.process_id = current_process_id.get()
+    if LOG_FORMAT == "json":
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)),
+            "level": record.levelname,
+            "process_id": record.process_id,
+            "message": record.getMessage(),
+        }
+        for field in LOG_EXTRA_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+            record.exc_text = None
+        record.json_line = json.dumps(entry, ensure_ascii=False, default=str)
+    return True
+
+def configure_logging():
+    """Un único handler a stdout (lo recoge gunicorn/Render)"""
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.addFilter(add_log_context)
+    if LOG_FORMAT == "json":
+        handler.setFormatter(logging.Formatter("%(json_line)s"))
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(process_id)s] %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+configure_logging()
+
+@contextmanager
+def log_context(process_id):
+    """Todas las líneas de log dentro del bloque llevan este process_id"""
+    token = current_process_id.set(process_id)
+    try:
+        yield
+    finally:
+        current_process_id.reset(token)
+
+# ========================================================
+# ARRANQUE RÁPIDO: LIBRERÍAS PESADAS BAJO DEMANDA
+# ========================================================
+
+# pandas, numpy, openpyxl y psutil tardan más en importarse que el resto de
+# la app. Se cargan en la primera petición que las necesita (o en segundo
+# plano tras el arranque), así "/", los estáticos y /healthz responden
+# apenas el servidor levanta después de un apagado por inactividad.
+pd = None
+np = None
+psutil = None
+load_workbook = None
+
+heavy_modules_lock = threading.Lock()
+heavy_modules_ready = threading.Event()
+
+# Precarga en un hilo al terminar de importar app.py (0 la desactiva)
+PRELOAD_HEAVY_MODULES = os.environ.get('PRELOAD_HEAVY_MODULES', '1').lower() in ('1', 'true', 'yes', 'si')
+
+# Tiempos de arranque en segundos: importar app.py y las librerías pesadas
+startup_timings = {}
+
+def load_heavy_modules():
+    """Importa las librerías pesadas una sola vez; los demás hilos esperan a la primera carga"""
+    global pd, np, psutil, load_workbook
+    if heavy_modules_ready.is_set():
+        return
+    with heavy_modules_lock:
+        if heavy_modules_ready.is_set():
+            return
+        started = time.perf_counter()
+        import numpy as np
+        import pandas as pd
+        import psutil
+        from openpyxl import load_workbook
+        startup_timings["heavy_modules_seconds"] = round(time.perf_counter() - started, 4)
+        heavy_modules_ready.set()
+    logger.info(f"📦 Librerías de procesamiento cargadas en {startup_timings['heavy_modules_seconds']:.2f}s")
+
+def preload_heavy_modules():
+    try:
+        load_heavy_modules()
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudieron precargar las librerías: {e}")
+
+def start_heavy_modules_preload():
+    """Carga en segundo plano para que el primer procesamiento no espere"""
+    if PRELOAD_HEAVY_MODULES and not heavy_modules_ready.is_set():
+        threading.Thread(target=preload_heavy_modules, name="preload", daemon=True).start()
+
+# Límite de memoria del contenedor: (límite, uso, estadísticas) de cgroup v2 y v1
+CGROUP_MEMORY_FILES = (
+    ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current", "/sys/fs/cgroup/memory.stat", "inactive_file"),
+    ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes",
+     "/sys/fs/cgroup/memory/memory.stat", "total_inactive_file"),
+)
+
+def physical_memory_mb():
+    """RAM total del host (MB) sin importar psutil, para la configuración al arrancar"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // MB
+    except (ValueError, OSError, AttributeError):
+        load_heavy_modules()
+        return psutil.virtual_memory().total // MB
+
+def read_cgroup_value(path, key=None):
+    """Entero de un archivo del cgroup (o de la línea key de memory.stat); None si no existe o es "max" """
+    try:
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    for line in lines:
+        name, _, value = line.strip().rpartition(" ")
+        if name == (key or "") and value.isdigit():
+            return int(value)
+    return None
+
+def cgroup_memory_mb():
+    """
+    (límite, uso) del contenedor en MB, o None si no tiene límite. El uso no
+    cuenta la caché de archivos inactiva, que el kernel libera al necesitarla.
+    """
+    physical = physical_memory_mb()
+    for limit_path, usage_path, stat_path, inactive_key in CGROUP_MEMORY_FILES:
+        limit = read_cgroup_value(limit_path)
+        # cgroup v1 sin límite informa un número enorme
+        if limit is None or limit // MB >= physical:
+            continue
+        usage = (read_cgroup_value(usage_path) or 0) - (read_cgroup_value(stat_path, inactive_key) or 0)
+        return limit // MB, max(usage, 0) / MB
+    return None
+
+def total_memory_mb():
+    """Memoria de la app (MB): el límite del contenedor o, si no tiene, la RAM del host"""
+    limits = cgroup_memory_mb()
+    return limits[0] if limits else physical_memory_mb()
+
+def available_memory_mb():
+    """Memoria libre real (MB), medida contra el mismo límite que total_memory_mb"""
+    load_heavy_modules()
+    available = psutil.virtual_memory().available / MB
+    limits = cgroup_memory_mb()
+    if limits:
+        available = min(available, limits[0] - limits[1])
+    return available
+
+# Cuota de CPU del contenedor: (cuota, período) de cgroup v2 y v1
+CGROUP_CPU_FILES = (
+    ("/sys/fs/cgroup/cpu.max", None),
+    ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us"),
+)
+
+def cgroup_cpu_quota():
+    """CPUs de la cuota del contenedor, o None si no tiene ("max" o -1)"""
+    for quota_path, period_path in CGROUP_CPU_FILES:
+        try:
+            with open(quota_path, 'r') as f:
+                fields = f.read().split()
+            if period_path:
+                with open(period_path, 'r') as f:
+                    fields += f.read().split()
+        except OSError:
+            continue
+        if len(fields) == 2 and all(field.isdigit() for field in fields) and int(fields[1]):
+            return int(fields[0]) / int(fields[1])
+        return None
+    return None
+
+def available_cpus():
+    """CPUs que puede usar este proceso (afinidad y cuota del contenedor), no las del host"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    if quota:
+        cpus = min(cpus, max(1, int(quota)))
+    return cpus
 
 # ========================================================
 # FUNCIONES AUXILIARES PARA NOMBRES DE ARCHIVOS
@@ -54,6 +299,8 @@ def format_filename(name):
 # FUNCIONES PARA SERIALIZAR DATOS - MÁS ROBUSTA
 # ========================================================
 
+NATIVE_SCALARS = (str, int, float, bool, type(None))
+
 def safe_serialize(obj):
     """
     Convierte cualquier objeto a tipos nativos de Python de forma segura
@@ -75,6 +322,9 @@ def safe_serialize(obj):
     elif isinstance(obj, dict):
         return {str(k): safe_serialize(v) for k, v in obj.items()}
     elif isinstance(obj, list):
+        # Listas de escalares nativos (p. ej. usuarios): sin recursión por elemento
+        if all(type(item) in NATIVE_SCALARS for item in obj):
+            return list(obj)
         return [safe_serialize(item) for item in obj]
     elif isinstance(obj, tuple):
         return tuple(safe_serialize(item) for item in obj)
@@ -92,14 +342,225 @@ def safe_serialize(obj):
 # LECTURA OPTIMIZADA DE ARCHIVOS EXCEL
 # ========================================================
 
-def read_large_excel(path):
+# Filas por bloque al leer en streaming
+READ_CHUNK_SIZE = int(os.environ.get('READ_CHUNK_SIZE', 50000))
+
+# Textos que pd.read_excel interpreta como vacíos por defecto
+NA_STRINGS = {
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+    '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'
+}
+
+def normalize_headers(raw_headers):
+    """
+    Convierte la fila de encabezados en nombres de columna como lo haría
+    pd.read_excel (Unnamed: N, duplicados con sufijo .1) y luego los limpia
+    y pasa a minúsculas.
+    """
+    headers = []
+    seen = {}
+    for i, value in enumerate(raw_headers):
+        name = f"Unnamed: {i}" if value is None else str(value)
+        count = seen.get(name, 0)
+        unique_name = name
+        while unique_name in seen:
+            count += 1
+            unique_name = f"{name}.{count}"
+        seen[name] = count
+        seen[unique_name] = 0
+        headers.append(unique_name)
+    return [h.strip().lower() for h in headers]
+
+def open_first_sheet(path):
+    """Abre el libro en modo solo lectura y devuelve (libro, primera hoja)"""
+    wb = load_workbook(path, read_only=True, data_only=True)
+    return wb, wb.worksheets[0]
+
+def next_non_empty_row(rows):
+    """Devuelve la primera fila con algún valor (encabezados) o None"""
+    for row in rows:
+        if any(value is not None for value in row):
+            return row
+    return None
+
+def open_excel_input(path):
+    """
+    Abre la primera hoja y lee su fila de encabezados. Devuelve
+    {"wb", "ws", "rows", "header_row", "headers"} con rows en la primera fila
+    de datos, para detectar columnas y luego leer los datos con el mismo libro
+    abierto: abrirlo procesa sharedStrings completo, no se hace dos veces.
+    Lo cierra el lector que lo recibe, o close_excel_inputs.
+    """
+    wb, ws = open_first_sheet(path)
+    try:
+        rows = ws.iter_rows(values_only=True)
+        header_row = next_non_empty_row(rows) or ()
+    except Exception:
+        wb.close()
+        raise
+    return {"wb": wb, "ws": ws, "rows": rows, "header_row": header_row, "headers": normalize_headers(header_row)}
+
+def close_excel_inputs(sources):
+    """Cierra los libros abiertos con open_excel_input que nadie llegó a leer"""
+    for source in sources.values():
+        source["wb"].close()
+    sources.clear()
+
+def read_excel_headers(path, sources=None):
+    """
+    Lee solo la fila de encabezados, sin cargar los datos. Con un dict en
+    sources el libro queda abierto en sources[path] para la lectura posterior.
+    """
+    source = open_excel_input(path)
+    if sources is not None and path not in sources:
+        sources[path] = source
+    else:
+        source["wb"].close()
+    return source["headers"]
+
+def normalize_cell(value):
+    """Normaliza una celda igual que el lector de pandas"""
+    if isinstance(value, str):
+        return None if value in NA_STRINGS else value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def compact_chunk(values):
+    """
+    Convierte los valores de un bloque de una columna en un arreglo compacto:
+    int64 o float64 si todo es numérico, object en otro caso.
+    """
+    has_none = False
+    all_int = True
+    for value in values:
+        if value is None:
+            has_none = True
+        elif isinstance(value, bool) or not isinstance(value, (int, float)):
+            return np.array(values, dtype=object)
+        elif not isinstance(value, int):
+            all_int = False
+    if all_int and not has_none:
+        try:
+            return np.array(values, dtype=np.int64)
+        except OverflowError:
+            return np.array(values, dtype=object)
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+def finalize_column(chunks):
+    """
+    Une los bloques de una columna e infiere el tipo final como pd.read_excel
+    (texto numérico a número, fechas a datetime64).
+    """
+    if not chunks:
+        return np.array([], dtype=object)
+    if all(chunk.dtype != object for chunk in chunks):
+        return np.concatenate(chunks)
+
+    column = np.concatenate([chunk.astype(object) for chunk in chunks])
+    column[pd.isna(column)] = np.nan
+    try:
+        return pd.to_numeric(column)
+    except (ValueError, TypeError):
+        return pd.Series(column).infer_objects().to_numpy()
+
+def read_large_excel(path, process_id=None, usecols=None, chunk_size=READ_CHUNK_SIZE, progress_range=None,
+                     skip_rows=0, digest=None, source=None):
     """
-    Lectura optimizada de Excel sin chunksize.
-    Convierte columnas numéricas y libera memoria.
+    Lectura en streaming con openpyxl (modo solo lectura, iter_rows).
+    Lee solo las columnas de usecols (todas si es None), por bloques de
+    chunk_size filas que se guardan como arreglos compactos. source es el
+    libro ya abierto por read_excel_headers (se abre aquí si es None).
+    Si se pasa process_id, verifica cancelación e informa progreso por bloque;
+    devuelve None si el proceso fue cancelado.
+    Las primeras skip_rows filas de datos no se cargan. Si se pasa un dict en
+    digest, se completa con el SHA-256 de esas filas ("prefix"), el de todas
+    ("full") y el total de filas ("rows"), para el modo incremental.
     """
-    print(f"📘 Leyendo archivo: {os.path.basename(path)} ...")
+    logger.info(f"📘 Leyendo archivo: {os.path.basename(path)} ...")
+
+    source = source or open_excel_input(path)
+    wb, ws, rows = source["wb"], source["ws"], source["rows"]
+    header_row, headers = source["header_row"], source["headers"]
+    try:
+        # Proyección de columnas: solo se guardan las necesarias
+        if usecols is None:
+            selected = list(range(len(headers)))
+        else:
+            wanted = set(usecols)
+            selected = [i for i, h in enumerate(headers) if h in wanted]
+
+        total_rows = max((ws.max_row or 0) - 1, 1)
+        buffers = [[] for _ in selected]
+        chunks = [[] for _ in selected]
+        pending_blank = 0
+        rows_read = 0
 
-    df = pd.read_excel(path, engine='openpyxl')
+        hasher = hashlib.sha256() if digest is not None else None
+        if hasher is not None:
+            digest["prefix"] = hasher.hexdigest() if skip_rows == 0 else None
+
+        def flush():
+            for buffer, column_chunks in zip(buffers, chunks):
+                if buffer:
+                    column_chunks.append(compact_chunk(buffer))
+                    buffer.clear()
+
+        for row in rows:
+            # Filas vacías intermedias se conservan; las finales se descartan
+            if not any(value is not None for value in row):
+                pending_blank += 1
+                continue
+            while pending_blank:
+                if rows_read >= skip_rows:
+                    for buffer in buffers:
+                        buffer.append(None)
+                pending_blank -= 1
+                rows_read += 1
+                if hasher is not None:
+                    hasher.update(b"\n")
+                    if rows_read == skip_rows:
+                        digest["prefix"] = hasher.hexdigest()
+
+            if rows_read >= skip_rows:
+                width = len(row)
+                for buffer, i in zip(buffers, selected):
+                    buffer.append(normalize_cell(row[i]) if i < width else None)
+            rows_read += 1
+            if hasher is not None:
+                hasher.update(repr(row).encode() + b"\n")
+                if rows_read == skip_rows:
+                    digest["prefix"] = hasher.hexdigest()
+
+            if rows_read % chunk_size == 0:
+                flush()
+                if process_id is not None:
+                    # Verificar cancelación por bloque
+                    if job_cancelled(process_id):
+                        logger.info(f"🛑 Lectura cancelada: {os.path.basename(path)}")
+                        return None
+                    if progress_range:
+                        start, end = progress_range
+                        progress = start + min(rows_read / total_rows, 1) * (end - start)
+                        set_process_state(process_id, status=f"Leyendo {os.path.basename(path)}", progress=progress)
+        flush()
+        if hasher is not None:
+            digest["full"] = hasher.hexdigest()
+            digest["rows"] = rows_read
+    finally:
+        wb.close()
+
+    columns = [(i, finalize_column(column_chunks)) for i, column_chunks in zip(selected, chunks)]
+    del chunks
+
+    # Columnas finales sin encabezado ni datos se descartan, como en pandas
+    while columns and header_row[columns[-1][0]] is None and pd.isna(columns[-1][1]).all():
+        columns.pop()
+
+    # Claves posicionales: los encabezados en minúsculas pueden repetirse
+    df = pd.DataFrame({pos: column for pos, (_, column) in enumerate(columns)})
+    df.columns = [headers[i] for i, _ in columns]
+    del columns
 
     # Reducir tipos numéricos
     for col in df.select_dtypes(include=['float64']).columns:
@@ -107,21 +568,218 @@ def read_large_excel(path):
     for col in df.select_dtypes(include=['int64']).columns:
         df[col] = pd.to_numeric(df[col], downcast='integer')
 
-    df.columns = df.columns.str.strip().str.lower()
-    gc.collect()
-    print(f"✅ Archivo {os.path.basename(path)} leído: {len(df)} filas, {len(df.columns)} columnas.")
+    logger.info(f"✅ Archivo {os.path.basename(path)} leído: {len(df)} filas, {len(df.columns)} columnas.")
     return df
 
+# ========================================================
+# DIRECTORIO DE DATOS PRIVADO (CACHÉS, REPORTES, ESTADO)
+# ========================================================
+
+# Base de cachés, reportes, índices y estado (cada uno se puede mover con su
+# propia variable). Las cachés se leen con pickle: ningún otro usuario del
+# equipo debe poder escribir en ellas, así que no se usa el /tmp compartido.
+DATA_DIR = os.environ.get('DATA_DIR', os.path.join(os.path.expanduser('~'), ".servicios_medicos"))
+
+def private_dir(path):
+    """
+    Crea el directorio (y los niveles que falten) con permisos 0o700 y lo
+    devuelve. Uno existente debe ser un directorio de este usuario
+    (PermissionError si no); si otros tenían acceso, se les quita.
+    """
+    missing = []
+    current = os.path.abspath(path)
+    while not os.path.lexists(current):
+        missing.append(current)
+        current = os.path.dirname(current)
+    for directory in reversed(missing):
+        try:
+            os.mkdir(directory, 0o700)
+        except FileExistsError:
+            pass
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise PermissionError(f"{path} no es un directorio propio del usuario del proceso")
+    if info.st_mode & 0o077:
+        os.chmod(path, 0o700)
+    return path
+
+def read_private_pickle(path):
+    """
+    pd.read_pickle solo de archivos de este usuario: un pickle ajeno
+    ejecutaría código al leerse (PermissionError si no es propio)
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_uid != os.getuid():
+            raise PermissionError(f"{path} no pertenece al usuario del proceso")
+        return pd.read_pickle(f)
+
+# ========================================================
+# CACHÉ DE ARCHIVOS LEÍDOS (POR CONTENIDO)
+# ========================================================
+
+PARSED_CACHE_DIR = os.environ.get('PARSED_CACHE_DIR', os.path.join(DATA_DIR, "parsed_cache"))
+PARSED_CACHE_MAX_BYTES = int(os.environ.get('PARSED_CACHE_MAX_MB', 200)) * 1024 * 1024
+# Cambiar al modificar read_large_excel para no servir DataFrames viejos
+PARSED_CACHE_VERSION = 1
+
+parsed_cache_lock = threading.Lock()
+
+def file_sha256(path, block_size=1024 * 1024):
+    """Calcula el SHA-256 del archivo leyendo por bloques"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def parsed_cache_path(digest):
+    return os.path.join(PARSED_CACHE_DIR, f"v{PARSED_CACHE_VERSION}_{digest}.pkl")
+
+def get_cached_input(digest):
+    """
+    Devuelve (DataFrame, columnas detectadas) si el archivo ya fue leído, o None.
+    Un acierto actualiza la fecha de uso para el desalojo LRU.
+    """
+    path = parsed_cache_path(digest)
+    try:
+        entry = read_private_pickle(path)
+        os.utime(path)
+        return entry["df"], tuple(entry["columns"])
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"⚠️ Entrada de caché inválida, se descarta: {e}")
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+def put_cached_input(digest, df, columns):
+    """Guarda el DataFrame leído y sus columnas detectadas, luego aplica el límite de tamaño"""
+    try:
+        private_dir(PARSED_CACHE_DIR)
+        path = parsed_cache_path(digest)
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        pd.to_pickle({"df": df, "columns": list(columns)}, tmp_path)
+        os.replace(tmp_path, path)
+        evict_parsed_cache()
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo guardar en caché: {e}")
+
+def evict_parsed_cache():
+    """Elimina las entradas menos usadas hasta quedar bajo PARSED_CACHE_MAX_BYTES"""
+    with parsed_cache_lock:
+        entries = []
+        for name in os.listdir(PARSED_CACHE_DIR):
+            if not name.endswith(".pkl"):
+                continue
+            path = os.path.join(PARSED_CACHE_DIR, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= PARSED_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                logger.info(f"🧹 Caché desalojada: {os.path.basename(path)}")
+            except OSError:
+                pass
+
+def prepare_input(path, df_name, cache_stats, sources=None):
+    """
+    Busca el archivo en la caché por contenido. Si no está, lee solo los
+    encabezados y detecta columnas (con sources, el libro queda abierto para
+    leerlo después). Devuelve (digest, df_cacheado_o_None, encabezados, columnas).
+    """
+    digest = file_sha256(path)
+    cached = get_cached_input(digest)
+    if cached is not None:
+        cache_stats["hits"] += 1
+        df, columns = cached
+        logger.info(f"⚡ Archivo {df_name} leído desde caché ({digest[:12]})")
+        return digest, df, list(df.columns), columns
+
+    cache_stats["misses"] += 1
+    headers = read_excel_headers(path, sources)
+
+    # Detección INTELIGENTE de columnas
+    logger.info(f"🔍 Detectando columnas en archivo {df_name}")
+    return digest, None, headers, detect_columns(headers, df_name)
+
+# ========================================================
+# CACHÉ DE RESULTADOS (MISMO PAR DE ARCHIVOS)
+# ========================================================
+
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', os.path.join(DATA_DIR, "result_cache"))
+RESULT_CACHE_VERSION = 2
+
+def result_cache_key(digest1, digest2, column_mapping, report_format="xlsx"):
+    """Clave del resultado: contenido de ambos archivos, columnas usadas y formato de los reportes"""
+    payload = json.dumps([RESULT_CACHE_VERSION, digest1, digest2, column_mapping, report_format], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def result_cache_path(key):
+    return os.path.join(RESULT_CACHE_DIR, f"{key}.json")
+
+def get_cached_result(key):
+    """
+    Devuelve el resultado guardado si todos sus archivos generados siguen
+    existiendo. Si alguno fue eliminado, la entrada se invalida.
+    """
+    path = result_cache_path(key)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"⚠️ Resultado en caché inválido, se descarta: {e}")
+        entry = None
+
+    if entry is not None and all(report_available(artifact) for artifact in entry["artifacts"]):
+        # Los reportes siguen en uso: renovar su TTL/LRU
+        for job_dir in {os.path.dirname(artifact) for artifact in entry["artifacts"]}:
+            touch_job_dir(job_dir)
+        return entry["result"]
+
+    try:
+        os.remove(path)
+        logger.info(f"🧹 Resultado en caché invalidado: {key[:12]}")
+    except OSError:
+        pass
+    return None
+
+def put_cached_result(key, result, artifacts):
+    """Guarda el resultado serializado junto con la lista de archivos que referencia"""
+    try:
+        private_dir(RESULT_CACHE_DIR)
+        path = result_cache_path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"result": result, "artifacts": artifacts}, f)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo guardar el resultado en caché: {e}")
+
 # ========================================================
 # DETECCIÓN INTELIGENTE DE COLUMNAS
 # ========================================================
 
 def detect_columns(df, df_name):
     """
-    Detecta automáticamente las columnas relevantes con múltiples variantes
+    Detecta automáticamente las columnas relevantes con múltiples variantes.
+    Acepta un DataFrame o directamente la lista de encabezados.
     """
-    print(f"🔍 Analizando columnas de {df_name}...")
-    print(f"   Columnas disponibles: {list(df.columns)}")
+    columns = list(df.columns) if hasattr(df, 'columns') else list(df)
+    logger.info(f"🔍 Analizando columnas de {df_name}...")
+    logger.info(f"Columnas disponibles: {columns}")
     
     # Buscar columnas con múltiples variantes
     professional_variants = ['profesional', 'profesionales', 'medico', 'médico', 'doctor', 'nombre', 'nombres', 'empleado']
@@ -134,382 +792,3567 @@ def detect_columns(df, df_name):
     
     # Buscar columna de profesional
     for variant in professional_variants:
-        for col in df.columns:
+        for col in columns:
             if variant in col.lower():
                 col_prof = col
-                print(f"   ✅ Columna profesional detectada: '{col}' (coincide con '{variant}')")
+                logger.info(f"✅ Columna profesional detectada: '{col}' (coincide con '{variant}')")
                 break
         if col_prof:
             break
     
     # Buscar columna de servicio
     for variant in service_variants:
-        for col in df.columns:
+        for col in columns:
             if variant in col.lower():
                 col_serv = col
-                print(f"   ✅ Columna servicio detectada: '{col}' (coincide con '{variant}')")
+                logger.info(f"✅ Columna servicio detectada: '{col}' (coincide con '{variant}')")
                 break
         if col_serv:
             break
     
     # Buscar columna de usuario/paciente
     for variant in user_variants:
-        for col in df.columns:
+        for col in columns:
             if variant in col.lower() and col != col_prof:  # Evitar duplicados con profesional
                 col_user = col
-                print(f"   ✅ Columna usuario detectada: '{col}' (coincide con '{variant}')")
+                logger.info(f"✅ Columna usuario detectada: '{col}' (coincide con '{variant}')")
                 break
         if col_user:
             break
     
     # Si no encontramos, usar las primeras columnas como fallback
-    if not col_prof and len(df.columns) >= 1:
-        col_prof = df.columns[0]
-        print(f"   ⚠️  Usando primera columna como profesional: '{col_prof}'")
+    if not col_prof and len(columns) >= 1:
+        col_prof = columns[0]
+        logger.warning(f"⚠️ Usando primera columna como profesional: '{col_prof}'")
     
-    if not col_serv and len(df.columns) >= 2:
-        col_serv = df.columns[1]
-        print(f"   ⚠️  Usando segunda columna como servicio: '{col_serv}'")
+    if not col_serv and len(columns) >= 2:
+        col_serv = columns[1]
+        logger.warning(f"⚠️ Usando segunda columna como servicio: '{col_serv}'")
     
-    if not col_user and len(df.columns) >= 3:
-        col_user = df.columns[2]
-        print(f"   ⚠️  Usando tercera columna como usuario: '{col_user}'")
+    if not col_user and len(columns) >= 3:
+        col_user = columns[2]
+        logger.warning(f"⚠️ Usando tercera columna como usuario: '{col_user}'")
     
     return col_prof, col_serv, col_user
 
 # ========================================================
-# PROCESAMIENTO PRINCIPAL SIMPLIFICADO
+# REPRESENTACIÓN COMPACTA DE COLUMNAS CLAVE
 # ========================================================
 
-def process_excel(file1_path, file2_path, process_id):
+def key_text(value):
     """
-    Procesa los archivos y genera Excel por profesional SOLO con datos completos
+    Clave de texto de una celda de columna clave (profesional, servicio,
+    usuario), la misma en todos los motores y en el modo incremental:
+    vacío -> "", 1000001.0 -> "1000001", el resto str(valor). Así una columna
+    numérica da las mismas claves con o sin celdas vacías (que la vuelven float).
     """
-    try:
-        # Verificar si el proceso fue cancelado
-        if process_id not in active_processes:
-            return {"error": "Proceso cancelado por el usuario"}
-        
-        # En Render, usar /tmp es más seguro
-        output_dir = "/tmp" if os.path.exists("/tmp") else tempfile.gettempdir()
-        os.makedirs(output_dir, exist_ok=True)
-        print("🧩 Iniciando procesamiento...")
-        print(f"📁 Directorio temporal: {output_dir}")
+    if value is None:
+        return ""
+    if isinstance(value, (float, np.floating)):
+        if np.isnan(value):
+            return ""
+        if float(value).is_integer():
+            return str(int(value))
+    return str(value)
 
-        # Verificar que los archivos existen
-        if not os.path.exists(file1_path):
-            raise FileNotFoundError(f"Archivo 1 no encontrado: {file1_path}")
-        if not os.path.exists(file2_path):
-            raise FileNotFoundError(f"Archivo 2 no encontrado: {file2_path}")
-
-        # Actualizar estado del proceso
-        active_processes[process_id] = {"status": "reading_files", "progress": 10}
-        
-        df1 = read_large_excel(file1_path)
-        df2 = read_large_excel(file2_path)
+def ordered_counts(items):
+    """
+    {clave: cantidad} a partir de (clave, cantidad, posición de primera
+    aparición), sumando claves repetidas. Orden común a todos los motores: de
+    más a menos filas y, en empates, por primera aparición, con los vacíos al final.
+    """
+    totals, first = {}, {}
+    for key, count, position in items:
+        totals[key] = totals.get(key, 0) + int(count)
+        first[key] = min(first.get(key, position), position)
+    return {key: totals[key] for key in sorted(totals, key=lambda key: (-totals[key], key == "", first[key]))}
 
-        # Verificar cancelación
-        if process_id not in active_processes:
-            return {"error": "Proceso cancelado por el usuario"}
+def encode_key_column(series):
+    """
+    Codifica una columna clave (profesional, servicio, usuario) como categórica.
+    Los vacíos se convierten en "" igual que fillna(""), pero cada fila ocupa
+    solo un código entero y los valores originales se conservan para el Excel.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series
 
-        # Detección INTELIGENTE de columnas
-        print("\n" + "="*50)
-        print("🔍 DETECTANDO COLUMNAS EN ARCHIVO CRYSTAL")
-        print("="*50)
-        col_prof1, col_serv1, col_user1 = detect_columns(df1, "CRYSTAL")
-        
-        print("\n" + "="*50)
-        print("🔍 DETECTANDO COLUMNAS EN ARCHIVO QUERY")
-        print("="*50)
-        col_prof2, col_serv2, col_user2 = detect_columns(df2, "QUERY")
-        
-        print("\n" + "="*50)
-        print("📊 RESUMEN DE DETECCIÓN DE COLUMNAS")
-        print("="*50)
-        print(f"CRYSTAL - Profesional: '{col_prof1}', Servicio: '{col_serv1}', Usuario: '{col_user1}'")
-        print(f"QUERY   - Profesional: '{col_prof2}', Servicio: '{col_serv2}', Usuario: '{col_user2}'")
-        print("="*50 + "\n")
+    codes, uniques = pd.factorize(series, use_na_sentinel=True)
+    categories = list(uniques)
+    if (codes == -1).any():
+        if "" in categories:
+            empty_code = categories.index("")
+        else:
+            empty_code = len(categories)
+            categories.append("")
+        codes = np.where(codes == -1, empty_code, codes)
 
-        # Verificar que tenemos las columnas mínimas necesarias
-        if not col_prof1:
-            error_msg = {
-                "error": "❌ No se pudo detectar la columna de profesional en el archivo CRYSTAL",
-                "details": {
-                    "crystal_columns": list(df1.columns),
-                    "query_columns": list(df2.columns)
-                }
-            }
-            return error_msg
+    categorical = pd.Categorical.from_codes(codes, categories=pd.Index(categories, dtype=object))
+    return pd.Series(categorical, index=series.index, name=series.name)
 
-        df1.fillna("", inplace=True)
-        df2.fillna("", inplace=True)
+def drop_unused_categories(df):
+    """
+    Bloque de filas con sus columnas categóricas reducidas a las categorías que
+    usa. Un iloc conserva el diccionario de todo el archivo (todos los usuarios,
+    servicios y profesionales), que de otro modo viajaría en cada tarea del
+    pool y en cada pendiente del modo diferido.
+    """
+    categorical = [col for col, dtype in df.dtypes.items() if isinstance(dtype, pd.CategoricalDtype)]
+    if not categorical:
+        return df
+    return df.assign(**{col: df[col].cat.remove_unused_categories() for col in categorical})
 
-        # Verificar cancelación
-        if process_id not in active_processes:
-            return {"error": "Proceso cancelado por el usuario"}
+def shared_string_codes(*columns):
+    """
+    Asigna a cada columna categórica códigos enteros en un diccionario común
+    basado en key_text(valor), para comparar Crystal y Query sin crear strings por fila.
+    Devuelve (lista de arreglos de códigos, tamaño del diccionario).
+    """
+    vocabulary = {}
+    result = []
+    for column in columns:
+        category_ids = np.array(
+            [vocabulary.setdefault(key_text(c), len(vocabulary)) for c in column.cat.categories],
+            dtype=np.int64
+        )
+        codes = column.cat.codes.to_numpy()
+        result.append(category_ids[codes] if len(category_ids) else np.zeros(len(codes), dtype=np.int64))
+    return result, len(vocabulary)
 
-        active_processes[process_id] = {"status": "processing_professionals", "progress": 30}
+def codes_in(codes, other_codes, vocabulary_size):
+    """Pertenencia por códigos enteros: True donde el código aparece en other_codes"""
+    present = np.zeros(vocabulary_size, dtype=bool)
+    present[other_codes] = True
+    return present[codes]
 
-        # OBTENER DATOS PARA FILTROS - CONVERTIR A LISTAS NATIVAS INMEDIATAMENTE
-        professionals = [str(prof) for prof in df1[col_prof1].dropna().unique()] if col_prof1 in df1.columns else []
-        professionals.sort()
-        
-        usuarios_crystal = [str(user) for user in df1[col_user1].dropna().unique()] if col_user1 in df1.columns else []
-        usuarios_crystal.sort()
-        
-        usuarios_query = [str(user) for user in df2[col_user2].dropna().unique()] if col_user2 in df2.columns else []
-        usuarios_query.sort()
+def yes_no_column(mask, index):
+    """Columna categórica 'SI'/'NO' a partir de una máscara booleana"""
+    categorical = pd.Categorical.from_codes(mask.astype(np.int8), categories=['NO', 'SI'])
+    return pd.Series(categorical, index=index)
 
-        total_services_crystal = int(len(df1))
-        total_services_query = int(len(df2))
+def count_values(series):
+    """
+    value_counts como dict nativo {key_text(valor): cantidad}, en el orden de
+    ordered_counts. Cuenta sobre los códigos de la columna categórica, cuyas
+    categorías están en orden de primera aparición, y omite las que no tienen filas.
+    """
+    series = encode_key_column(series)
+    codes = series.cat.codes.to_numpy()
+    counts = np.bincount(codes[codes >= 0], minlength=len(series.cat.categories))
+    return ordered_counts((key_text(category), count, code)
+                          for code, (category, count) in enumerate(zip(series.cat.categories, counts)) if count)
 
-        # Convertir value_counts a dict nativo inmediatamente
-        servicios_por_categoria_crystal = {}
-        if col_serv1 in df1.columns:
-            for k, v in df1[col_serv1].value_counts().items():
-                servicios_por_categoria_crystal[str(k)] = int(v)
-        
-        servicios_por_categoria_query = {}
-        if col_serv2 in df2.columns:
-            for k, v in df2[col_serv2].value_counts().items():
-                servicios_por_categoria_query[str(k)] = int(v)
+# ========================================================
+# AGREGADOS Y VALIDACIÓN CRUZADA
+# ========================================================
 
-        professional_data = {}
-        user_data = {}
+def encode_key_columns(df, key_columns):
+    """
+    Columnas clave como categóricas (equivale a fillna("") en ellas).
+    El resto conserva NaN y sus tipos compactos: se escriben igual en Excel.
+    """
+    for col in key_columns:
+        if col in df.columns:
+            df[col] = encode_key_column(df[col])
 
-        # Procesar profesionales - GENERAR EXCEL POR PROFESIONAL SOLO CON DATOS COMPLETOS
-        total_professionals = len(professionals)
-        for index, prof in enumerate(professionals):
-            # Verificar cancelación en cada iteración
-            if process_id not in active_processes:
-                return {"error": "Proceso cancelado por el usuario"}
-            
-            # Actualizar progreso
-            progress = 30 + (index / total_professionals) * 50
-            active_processes[process_id] = {"status": f"Procesando {prof}", "progress": progress}
-            
-            # Filtrar datos del profesional actual
-            df_prof = df1[df1[col_prof1] == prof].copy()
-            if not df_prof.empty:
-                # AGREGAR COLUMNA DE VALIDACIÓN AL DATAFRAME ORIGINAL
-                df_prof_copy = df_prof.copy()
-                df_prof_copy['Validación Query'] = 'NO'
-                
-                # Verificar qué usuarios están en Query
-                if col_user2 in df2.columns and col_user1 in df_prof_copy.columns:
-                    usuarios_en_query = [str(user) for user in df2[col_user2].dropna().unique()]
-                    mask = df_prof_copy[col_user1].astype(str).isin(usuarios_en_query)
-                    df_prof_copy.loc[mask, 'Validación Query'] = 'SI'
-                
-                # GENERAR NOMBRE DE ARCHIVO LEGIBLE - SIN GUIONES BAJOS
-                nombre_formateado = format_filename(prof)
-                file_name = f"{nombre_formateado}.xlsx"
-                output_file = os.path.join(output_dir, file_name)
-                
-                print(f"💾 Generando reporte para {prof}: {output_file}")
-                
-                # SOLO UNA HOJA CON DATOS COMPLETOS
-                with pd.ExcelWriter(output_file, engine="openpyxl") as writer:
-                    df_prof_copy.to_excel(writer, sheet_name='Datos', index=False)
-                
-                # Convertir a tipos nativos para serialización - MÁS ROBUSTO
-                servicios_cat = {}
-                if col_serv1 in df_prof.columns:
-                    for k, v in df_prof[col_serv1].value_counts().items():
-                        servicios_cat[str(k)] = int(v)
-                
-                total_usuarios = int(len(df_prof[col_user1].dropna().unique())) if col_user1 in df_prof.columns else 0
-                total_servicios = int(len(df_prof))
-                
-                professional_data[str(prof)] = {
-                    "servicios_por_categoria": servicios_cat,
-                    "total_usuarios": total_usuarios,
-                    "total_servicios": total_servicios,
-                    "download_link": f"/download/{file_name}",
-                    "nombre_archivo": file_name
-                }
-                
-                del df_prof, df_prof_copy
-                gc.collect()
+def compute_aggregates(df1, df2, crystal_columns, query_columns):
+    """
+    Listas para los filtros y totales globales, ya como tipos nativos
+    """
+    col_prof1, col_serv1, col_user1 = crystal_columns
+    col_prof2, col_serv2, col_user2 = query_columns
 
-        # PROCESAR ARCHIVO QUERY - Generar archivo con validación de usuarios
-        if col_user2 in df2.columns:
-            active_processes[process_id] = {"status": "processing_query", "progress": 85}
-            
-            # Crear archivo de validación de usuarios Query
-            df_query_validation = df2.copy()
-            df_query_validation['Usuario en Crystal'] = 'NO'
-            
-            if col_user1 in df1.columns:
-                usuarios_crystal_list = [str(user) for user in df1[col_user1].dropna().unique()]
-                mask = df_query_validation[col_user2].astype(str).isin(usuarios_crystal_list)
-                df_query_validation.loc[mask, 'Usuario en Crystal'] = 'SI'
-            
-            # Generar archivo Excel para Query con nombre legible - SIN GUIONES BAJOS
-            query_file_name = "Validación Usuarios Query.xlsx"
-            query_output_file = os.path.join(output_dir, query_file_name)
-            
-            print(f"💾 Generando reporte de validación Query: {query_output_file}")
-            
-            # SOLO UNA HOJA CON DATOS COMPLETOS
-            with pd.ExcelWriter(query_output_file, engine="openpyxl") as writer:
-                df_query_validation.to_excel(writer, sheet_name='Datos', index=False)
-            
-            usuarios_en_crystal = int(len(df_query_validation[df_query_validation['Usuario en Crystal'] == 'SI']))
-            usuarios_solo_query = int(len(df_query_validation[df_query_validation['Usuario en Crystal'] == 'NO']))
-            total_usuarios_query = int(len(df_query_validation))
-            
-            user_data["query_validation"] = {
-                "download_link": f"/download/{query_file_name}",
-                "nombre_archivo": query_file_name,
-                "total_usuarios": total_usuarios_query,
-                "usuarios_en_crystal": usuarios_en_crystal,
-                "usuarios_solo_query": usuarios_solo_query
-            }
+    # OBTENER DATOS PARA FILTROS - CONVERTIR A LISTAS NATIVAS INMEDIATAMENTE
+    professionals = sorted({key_text(prof) for prof in df1[col_prof1].dropna().unique()}) if col_prof1 in df1.columns else []
 
-        # Limpiar memoria
-        del df1, df2
-        gc.collect()
+    usuarios_crystal = sorted({key_text(user) for user in df1[col_user1].dropna().unique()}) if col_user1 in df1.columns else []
 
-        active_processes[process_id] = {"status": "completed", "progress": 100}
+    usuarios_query = sorted({key_text(user) for user in df2[col_user2].dropna().unique()}) if col_user2 in df2.columns else []
 
-        mem = psutil.virtual_memory()
-        print(f"✅ Procesamiento completo. Uso de memoria: {mem.percent}%")
+    # Convertir value_counts a dict nativo inmediatamente
+    servicios_por_categoria_crystal = count_values(df1[col_serv1]) if col_serv1 in df1.columns else {}
+    servicios_por_categoria_query = count_values(df2[col_serv2]) if col_serv2 in df2.columns else {}
 
-        # Construir resultado final con tipos nativos
-        result_data = {
-            "totals": {
-                "total_services_crystal": total_services_crystal,
-                "total_services_query": total_services_query,
-                "num_professionals": len(professionals),
-                "num_users_crystal": len(usuarios_crystal),
-                "num_users_query": len(usuarios_query),
-                "servicios_por_categoria_crystal": servicios_por_categoria_crystal,
-                "servicios_por_categoria_query": servicios_por_categoria_query,
-            },
-            "professionals": professionals,
-            "usuarios_crystal": usuarios_crystal,
-            "usuarios_query": usuarios_query,
-            "professional_data": professional_data,
-            "user_data": user_data,
-            "column_mapping": {
-                "crystal": {"profesional": str(col_prof1), "servicio": str(col_serv1), "usuario": str(col_user1)},
-                "query": {"profesional": str(col_prof2), "servicio": str(col_serv2), "usuario": str(col_user2)}
-            },
-            "process_id": process_id
+    return {
+        "professionals": professionals,
+        "usuarios_crystal": usuarios_crystal,
+        "usuarios_query": usuarios_query,
+        "totals": {
+            "total_services_crystal": int(len(df1)),
+            "total_services_query": int(len(df2)),
+            "num_professionals": len(professionals),
+            "num_users_crystal": len(usuarios_crystal),
+            "num_users_query": len(usuarios_query),
+            "servicios_por_categoria_crystal": servicios_por_categoria_crystal,
+            "servicios_por_categoria_query": servicios_por_categoria_query,
         }
+    }
 
-        # Aplicar serialización segura a TODO el resultado
-        return safe_serialize(result_data)
-
-    except Exception as e:
-        print(f"❌ Error en procesamiento: {e}")
-        import traceback
-        print(traceback.format_exc())
-        return {"error": f"Error en procesamiento: {str(e)}"}
+def cross_validate(df1, df2, col_user1, col_user2):
+    """
+    VALIDACIÓN CRUZADA UNA SOLA VEZ, CON CÓDIGOS ENTEROS COMPARTIDOS.
+    Devuelve (filas Crystal cuyo usuario está en Query, filas Query cuyo
+    usuario está en Crystal o None si falta alguna columna de usuario).
+    """
+    in_query = np.zeros(len(df1), dtype=bool)
+    in_crystal = None
+    if col_user2 in df2.columns and col_user1 in df1.columns:
+        (user_codes1, user_codes2), vocabulary_size = shared_string_codes(df1[col_user1], df2[col_user2])
+        in_query = codes_in(user_codes1, user_codes2, vocabulary_size)
+        in_crystal = codes_in(user_codes2, user_codes1, vocabulary_size)
+    return in_query, in_crystal
 
 # ========================================================
-# ENDPOINTS FLASK
+# PARTICIONADO POR PROFESIONAL (UNA SOLA PASADA)
 # ========================================================
 
-@app.route('/upload', methods=['POST'])
-def upload():
-    try:
-        file1 = request.files.get('file1')
-        file2 = request.files.get('file2')
+def professional_codes(column):
+    """
+    Código entero por fila según key_text(profesional), con los nombres ordenados.
+    Devuelve (códigos, nombres).
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        names = pd.Index([key_text(c) for c in column.cat.categories], dtype=object)
+        name_codes, uniques = pd.factorize(names, sort=True)
+        return name_codes[column.cat.codes.to_numpy()], uniques
+    return pd.factorize(column.map(key_text), sort=True)
 
-        if not file1 or not file2:
-            return jsonify({"error": "Debes subir ambos archivos."}), 400
+def partition_by_professional(df, col_prof):
+    """
+    Ordena el DataFrame una sola vez por profesional (orden estable, conserva
+    el orden original de las filas) y devuelve el DataFrame ordenado junto con
+    un dict {profesional: (inicio, fin)} para tomar cada bloque con iloc.
+    """
+    if col_prof not in df.columns or df.empty:
+        return df, {}
 
-        # Generar ID único para este proceso
-        process_id = str(uuid.uuid4())
-        active_processes[process_id] = {"status": "starting", "progress": 0}
+    # Códigos enteros por profesional: ordenar enteros es mucho más rápido que strings
+    codes, uniques = professional_codes(df[col_prof])
+    order = np.argsort(codes, kind="stable")
+    df_sorted = df.take(order)
 
-        # Guardar archivos temporales - En Render usar /tmp
-        temp_dir = "/tmp" if os.path.exists("/tmp") else tempfile.gettempdir()
-        file1_name = f"crystal_{uuid.uuid4().hex[:8]}.xlsx"
-        file2_name = f"query_{uuid.uuid4().hex[:8]}.xlsx"
-        
-        file1_path = os.path.join(temp_dir, file1_name)
-        file2_path = os.path.join(temp_dir, file2_name)
-        
-        file1.save(file1_path)
-        file2.save(file2_path)
+    # Límites de cada bloque contiguo
+    counts = np.bincount(codes, minlength=len(uniques))
+    ends = np.cumsum(counts)
+    starts = ends - counts
 
-        # Procesar archivos
-        data = process_excel(file1_path, file2_path, process_id)
+    ranges = {str(name): (int(s), int(e)) for name, s, e in zip(uniques, starts, ends)}
+    return df_sorted, ranges
 
-        # Limpiar archivos temporales
-        try:
-            if os.path.exists(file1_path):
-                os.remove(file1_path)
-            if os.path.exists(file2_path):
-                os.remove(file2_path)
-        except Exception as e:
-            print(f"⚠️ No se pudieron eliminar archivos temporales: {e}")
+def build_professional_entry(prof, df_prof, col_serv, col_user, output_dir, process_id, lazy=False,
+                             report_format="xlsx", sheet=None):
+    """
+    Escribe el reporte de un profesional (o lo deja pendiente si lazy) y devuelve
+    su entrada para professional_data. En formato workbook no escribe nada: la
+    entrada apunta a su hoja (sheet) del libro único.
+    """
+    if report_format == "workbook":
+        file_name = WORKBOOK_FILE_NAME
+    else:
+        # GENERAR NOMBRE DE ARCHIVO LEGIBLE - SIN GUIONES BAJOS
+        nombre_formateado = format_filename(prof)
+        file_name = report_file_name(nombre_formateado, report_format)
+        output_file = os.path.join(output_dir, file_name)
 
-        # Remover proceso de la lista activa si existe
-        if process_id in active_processes:
-            del active_processes[process_id]
+        logger.info(f"💾 Generando reporte para {prof}: {output_file}")
+        save_report(df_prof, output_file, lazy, report_format)
 
-        return jsonify(data)
+    # Convertir a tipos nativos para serialización - MÁS ROBUSTO
+    servicios_cat = count_values(df_prof[col_serv]) if col_serv in df_prof.columns else {}
 
-    except Exception as e:
-        print(f"❌ Error en /upload: {e}")
-        import traceback
-        print(traceback.format_exc())
-        return jsonify({"error": f"Error del servidor: {str(e)}"}), 500
+    total_usuarios = int(df_prof[col_user].nunique(dropna=True)) if col_user in df_prof.columns else 0
+    total_servicios = int(len(df_prof))
 
-@app.route('/cancel-process', methods=['POST'])
-def cancel_process():
-    """Endpoint para cancelar procesos activos"""
-    try:
-        data = request.get_json()
-        if not data:
-            return jsonify({"error": "Datos no proporcionados"}), 400
-            
-        process_id = data.get('process_id')
+    entry = {
+        "servicios_por_categoria": servicios_cat,
+        "total_usuarios": total_usuarios,
+        "total_servicios": total_servicios,
+        "download_link": artifact_link(process_id, file_name),
+        "nombre_archivo": file_name
+    }
+    if sheet:
+        entry["hoja"] = sheet
+    return entry
+
+def query_validation_frame(df2, in_crystal):
+    """Query con la columna 'Usuario en Crystal' (SI/NO)"""
+    if in_crystal is None:
+        in_crystal = np.zeros(len(df2), dtype=bool)
+    return df2.assign(**{'Usuario en Crystal': yes_no_column(in_crystal, df2.index)})
+
+def build_query_validation_entry(df2, in_crystal, output_dir, process_id, lazy=False, report_format="xlsx",
+                                 sheet=None):
+    """
+    Escribe el reporte de validación de usuarios Query y devuelve su entrada para user_data.
+    in_crystal es la máscara booleana de filas cuyo usuario está en Crystal (o None).
+    En formato workbook no escribe nada: la entrada apunta a su hoja (sheet).
+    """
+    if report_format == "workbook":
+        query_file_name = WORKBOOK_FILE_NAME
+    else:
+        # Crear archivo de validación de usuarios Query
+        df_query_validation = query_validation_frame(df2, in_crystal)
+
+        # Generar archivo para Query con nombre legible - SIN GUIONES BAJOS
+        query_file_name = report_file_name("Validación Usuarios Query", report_format)
+        query_output_file = os.path.join(output_dir, query_file_name)
+
+        logger.info(f"💾 Generando reporte de validación Query: {query_output_file}")
+        save_report(df_query_validation, query_output_file, lazy, report_format)
+
+    entry = {
+        "download_link": artifact_link(process_id, query_file_name),
+        "nombre_archivo": query_file_name,
+        **query_validation_totals(in_crystal, len(df2))
+    }
+    if sheet:
+        entry["hoja"] = sheet
+    return entry
+
+def query_validation_totals(in_crystal, total_rows):
+    """Filas Query con y sin usuario en Crystal"""
+    usuarios_en_crystal = int(in_crystal.sum()) if in_crystal is not None else 0
+    return {
+        "total_usuarios": int(total_rows),
+        "usuarios_en_crystal": usuarios_en_crystal,
+        "usuarios_solo_query": int(total_rows) - usuarios_en_crystal
+    }
+
+def build_report_tasks(df1_sorted, prof_ranges, professionals, df2, in_crystal,
+                       key_columns, output_dir, process_id, lazy=False, report_format="xlsx"):
+    """
+    Tareas de escritura para run_report_tasks. El reporte Query va primero
+    para que se escriba al mismo tiempo que los reportes por profesional.
+    En formato workbook las tareas solo arman las entradas con su hoja; el
+    libro se escribe después con write_workbook_report.
+    Devuelve (tareas, profesionales en el mismo orden que sus tareas).
+    """
+    col_serv1, col_user1, col_user2 = key_columns
+    has_query = col_user2 in df2.columns
+    task_professionals = [prof for prof in professionals if prof in prof_ranges]
+
+    sheets = [None] * (len(task_professionals) + has_query)
+    if report_format == "workbook":
+        sheets = sheet_titles(["Validación Query"] * has_query + task_professionals)
+
+    tasks = []
+    if has_query:
+        tasks.append(("validación Query", build_query_validation_entry,
+                      (df2, in_crystal, output_dir, process_id, lazy, report_format, sheets[0])))
+
+    # Procesar profesionales - GENERAR EXCEL POR PROFESIONAL SOLO CON DATOS COMPLETOS
+    for prof, sheet in zip(task_professionals, sheets[has_query:]):
+        # Bloque contiguo del profesional actual, solo con sus propias categorías
+        bounds = prof_ranges[prof]
+        df_prof = drop_unused_categories(df1_sorted.iloc[bounds[0]:bounds[1]])
+        tasks.append((prof, build_professional_entry,
+                      (prof, df_prof, col_serv1, col_user1, output_dir, process_id, lazy, report_format, sheet)))
+    return tasks, task_professionals
+
+def write_workbook_report(tasks, entries, output_dir):
+    """
+    Libro único del formato workbook: una hoja por entrada, en el orden de las
+    tareas, escrita fila por fila desde los mismos bloques del DataFrame
+    """
+    def sheets():
+        for (label, fn, args), entry in zip(tasks, entries):
+            frame = query_validation_frame(args[0], args[1]) if fn is build_query_validation_entry else args[1]
+            yield entry["hoja"], frame_headers(frame), frame_rows(frame)
+
+    logger.info(f"💾 Generando libro único: {WORKBOOK_FILE_NAME} ({len(entries)} hojas)")
+    write_workbook(sheets(), os.path.join(output_dir, WORKBOOK_FILE_NAME))
+
+# ========================================================
+# MODO RESUMEN: TOTALES SIN GENERAR REPORTES
+# ========================================================
+
+def summarize_professionals(df, key_columns, professionals):
+    """
+    Totales por profesional (servicios, usuarios distintos y servicios por
+    categoría) en una sola pasada agrupada sobre códigos enteros, sin ordenar
+    ni partir el DataFrame. Mismos valores que build_professional_entry.
+    """
+    col_prof, col_serv, col_user = key_columns
+    if col_prof not in df.columns or df.empty:
+        return {}
+
+    prof_codes, names = professional_codes(df[col_prof])
+    prof_codes = prof_codes.astype(np.int64)
+    num_profs = len(names)
+    total_servicios = np.bincount(prof_codes, minlength=num_profs)
+
+    # Usuarios distintos: pares (profesional, usuario) únicos
+    total_usuarios = np.zeros(num_profs, dtype=np.int64)
+    if col_user in df.columns:
+        user_codes = df[col_user].cat.codes.to_numpy().astype(np.int64)
+        valid = user_codes >= 0
+        width = int(user_codes.max()) + 1 if len(user_codes) else 1
+        pairs = np.unique(prof_codes[valid] * width + user_codes[valid])
+        total_usuarios = np.bincount(pairs // width, minlength=num_profs)
+
+    # Servicios por categoría: conteo de pares (profesional, servicio)
+    servicios = [[] for _ in range(num_profs)]
+    if col_serv in df.columns:
+        categories = df[col_serv].cat.categories
+        serv_codes = df[col_serv].cat.codes.to_numpy().astype(np.int64)
+        valid = serv_codes >= 0
+        width = len(categories) or 1
+        pairs, counts = np.unique(prof_codes[valid] * width + serv_codes[valid], return_counts=True)
+        for pair, count in zip(pairs.tolist(), counts.tolist()):
+            servicios[pair // width].append((key_text(categories[pair % width]), count, pair % width))
+
+    index = {str(name): i for i, name in enumerate(names)}
+    professional_data = {}
+    for prof in professionals:
+        i = index.get(str(prof))
+        if i is None:
+            continue
+        professional_data[str(prof)] = {
+            "servicios_por_categoria": ordered_counts(servicios[i]),
+            "total_usuarios": int(total_usuarios[i]),
+            "total_servicios": int(total_servicios[i]),
+        }
+    return professional_data
+
+# ========================================================
+# FORMATOS DE REPORTE
+# ========================================================
+
+# Extensión de cada formato:
+# xlsx: pandas + openpyxl, el formato de siempre (arma todo el libro en memoria)
+# xlsx_stream: openpyxl en modo write_only, memoria constante por hoja
+# csv: UTF-8 con BOM para que Excel muestre bien los acentos
+# parquet: para las herramientas de BI (requiere pyarrow)
+# workbook: un solo libro con una hoja por profesional y otra para la validación Query
+REPORT_FORMATS = {
+    "xlsx": ".xlsx",
+    "xlsx_stream": ".xlsx",
+    "csv": ".csv",
+    "parquet": ".parquet",
+    "workbook": ".xlsx",
+}
+REPORT_FORMAT = os.environ.get('REPORT_FORMAT', 'xlsx').lower()
+if REPORT_FORMAT not in REPORT_FORMATS:
+    REPORT_FORMAT = "xlsx"
+WORKBOOK_FILE_NAME = "Reportes.xlsx"
+# Filas por bloque al recorrer un DataFrame o un cursor
+REPORT_ROW_BLOCK = 5000
+
+def report_format_available(report_format):
+    """True si el formato existe y sus dependencias están instaladas"""
+    if report_format == "parquet":
+        return importlib.util.find_spec("pyarrow") is not None
+    return report_format in REPORT_FORMATS
+
+def report_file_name(base_name, report_format):
+    return f"{base_name}{REPORT_FORMATS[report_format]}"
+
+def sheet_titles(names):
+    """Nombres de hoja válidos en Excel (31 caracteres como máximo) y sin repetidos"""
+    titles = []
+    seen = set()
+    for name in names:
+        base = format_filename(name)[:31]
+        title = base
+        count = 1
+        while title.lower() in seen:
+            count += 1
+            suffix = f" ({count})"
+            title = f"{base[:31 - len(suffix)]}{suffix}"
+        seen.add(title.lower())
+        titles.append(title)
+    return titles
+
+def frame_headers(df):
+    return [str(col) for col in df.columns]
+
+def frame_rows(df):
+    """Filas de un DataFrame con valores nativos (vacíos como None), por bloques"""
+    for start in range(0, len(df), REPORT_ROW_BLOCK):
+        block = df.iloc[start:start + REPORT_ROW_BLOCK]
+        columns = []
+        for i in range(block.shape[1]):
+            column = block.iloc[:, i].astype(object)
+            columns.append(column.where(column.notna(), None).tolist())
+        yield from zip(*columns)
+
+def write_workbook(sheets, output_file):
+    """
+    Libro en modo write_only a partir de [(título, encabezados, filas)]: cada
+    fila se escribe directo al archivo temporal de su hoja, así la memoria no
+    depende del número de filas. Escritura atómica (temporal + os.replace).
+    """
+    from openpyxl import Workbook
+    tmp_file = f"{output_file}.{uuid.uuid4().hex[:8]}.tmp"
+    wb = Workbook(write_only=True)
+    for title, headers, rows in sheets:
+        ws = wb.create_sheet(title)
+        ws.append(headers)
+        for row in rows:
+            ws.append(row)
+    wb.save(tmp_file)
+    os.replace(tmp_file, output_file)
+
+def write_csv(headers, rows, output_file):
+    with open(output_file, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        writer.writerows(rows)
+
+def parquet_frame(df):
+    """
+    Parquet exige un tipo por columna: las columnas de texto con valores de
+    varios tipos (p. ej. cédulas numéricas y alfanuméricas) se guardan como texto
+    """
+    mixed = {}
+    for i in range(df.shape[1]):
+        column = df.iloc[:, i]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            values = pd.Series(column.cat.categories)
+        elif column.dtype == object:
+            values = column.dropna()
+        else:
+            continue
+        if values.map(type).nunique() > 1:
+            mixed[i] = column.astype(object).map(lambda value: None if pd.isna(value) else str(value))
+    if not mixed:
+        return df
+    df = df.copy(deep=False)
+    for i, column in mixed.items():
+        df.isetitem(i, column)
+    return df
+
+def parquet_type(types):
+    """Tipo de pyarrow para una columna según los tipos de Python que contiene"""
+    import pyarrow as pa
+    if not types or types <= {int, float}:
+        return pa.int64() if types == {int} else pa.float64()
+    if len(types) == 1:
+        value_type = next(iter(types))
+        arrow_types = {bool: pa.bool_(), str: pa.string(), datetime.datetime: pa.timestamp('us'),
+                       datetime.date: pa.date32(), datetime.time: pa.time64('us')}
+        if value_type in arrow_types:
+            return arrow_types[value_type]
+    return pa.string()
+
+def write_parquet_rows(headers, rows, output_file, value_types):
+    """
+    Parquet escrito por grupos de filas; value_types es el conjunto de tipos
+    de Python de cada columna (las mezclas se guardan como texto)
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([(name, parquet_type(types)) for name, types in zip(headers, value_types)])
+    as_text = [field.type == pa.string() for field in schema]
+    tmp_file = f"{output_file}.{uuid.uuid4().hex[:8]}.tmp"
+    with pq.ParquetWriter(tmp_file, schema) as writer:
+        batch = []
+        for row in itertools.chain(rows, [None]):
+            if row is not None:
+                batch.append(row)
+                if len(batch) < REPORT_ROW_BLOCK:
+                    continue
+            if batch:
+                arrays = []
+                for i, field in enumerate(schema):
+                    values = [row[i] for row in batch]
+                    if as_text[i]:
+                        values = [None if value is None else str(value) for value in values]
+                    arrays.append(pa.array(values, type=field.type))
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                batch = []
+    os.replace(tmp_file, output_file)
+
+def write_rows_report(headers, rows, output_file, report_format, value_types=None):
+    """
+    Reporte de una hoja a partir de filas (cursor o generador), sin cargarlas
+    todas. value_types solo hace falta para parquet.
+    """
+    if report_format == "csv":
+        write_csv(headers, rows, output_file)
+    elif report_format == "parquet":
+        write_parquet_rows(headers, rows, output_file, value_types)
+    else:
+        write_workbook([('Datos', headers, rows)], output_file)
+
+def file_bytes(paths):
+    total = 0
+    for path in set(paths):
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+def report_output_metrics(report_format, artifacts, phases, rows_written, lazy=False):
+    """Números del escritor de reportes usado: tiempo, bytes y velocidad"""
+    seconds = phases.get("write_reports", {}).get("seconds", 0)
+    size = 0 if lazy else file_bytes(artifacts)
+    return {
+        "format": report_format,
+        "lazy": lazy,
+        "files": len(set(artifacts)),
+        "bytes": size,
+        "seconds": seconds,
+        "rows_per_second": round(rows_written / seconds, 1) if rows_written and seconds > 0 else None,
+        "mb_per_second": round(size / MB / seconds, 2) if size and seconds > 0 else None,
+    }
+
+# ========================================================
+# GENERACIÓN DIFERIDA DE REPORTES (PRIMERA DESCARGA)
+# ========================================================
+
+render_locks = {}
+render_locks_lock = threading.Lock()
+
+def write_report(df, output_file, report_format="xlsx"):
+    """SOLO UNA HOJA CON DATOS COMPLETOS, en el formato pedido"""
+    if report_format == "xlsx":
+        with pd.ExcelWriter(output_file, engine="openpyxl") as writer:
+            df.to_excel(writer, sheet_name='Datos', index=False)
+    elif report_format == "csv":
+        df.to_csv(output_file, index=False, encoding='utf-8-sig')
+    elif report_format == "parquet":
+        parquet_frame(df).to_parquet(output_file, index=False)
+    else:
+        write_workbook([('Datos', frame_headers(df), frame_rows(df))], output_file)
+
+def pending_report_path(output_file):
+    """Datos guardados de un reporte que aún no se ha generado"""
+    directory, file_name = os.path.split(output_file)
+    return os.path.join(directory, f".{file_name}.pkl")
+
+def save_report(df, output_file, lazy=False, report_format="xlsx"):
+    """
+    Escribe el reporte. En modo diferido solo guarda los datos (mucho más rápido
+    que openpyxl) y el reporte se genera en la primera descarga.
+    """
+    if lazy:
+        pd.to_pickle({"df": df, "format": report_format}, pending_report_path(output_file))
+    else:
+        write_report(df, output_file, report_format)
+
+def report_available(output_file):
+    """True si el Excel existe o puede generarse bajo demanda"""
+    return os.path.isfile(output_file) or os.path.isfile(pending_report_path(output_file))
+
+def ensure_report(output_file):
+    """
+    Genera el Excel pendiente si hace falta. Devuelve True si el archivo existe.
+    La escritura es atómica, así que dos workers que lo generen a la vez no se dañan.
+    """
+    if os.path.isfile(output_file):
+        return True
+
+    with render_locks_lock:
+        lock = render_locks.setdefault(output_file, threading.Lock())
+
+    try:
+        with lock:
+            if os.path.isfile(output_file):
+                return True
+            pending = pending_report_path(output_file)
+            try:
+                data = read_private_pickle(pending)
+            except FileNotFoundError:
+                return os.path.isfile(output_file)
+            except PermissionError as e:
+                logger.warning(f"⚠️ Reporte pendiente rechazado: {e}")
+                return False
+            # Pendientes de versiones anteriores: solo el DataFrame, en xlsx
+            if isinstance(data, dict):
+                df, report_format = data["df"], data["format"]
+            else:
+                df, report_format = data, "xlsx"
+
+            directory, file_name = os.path.split(output_file)
+            tmp_file = os.path.join(directory, f".{uuid.uuid4().hex[:8]}.{file_name}")
+            logger.info(f"💾 Generando reporte bajo demanda: {output_file}")
+            write_report(df, tmp_file, report_format)
+            os.replace(tmp_file, output_file)
+            try:
+                os.remove(pending)
+            except OSError:
+                pass
+            return True
+    finally:
+        with render_locks_lock:
+            render_locks.pop(output_file, None)
+
+# ========================================================
+# ESCRITURA PARALELA DE REPORTES
+# ========================================================
+
+# Número de procesos para escribir los Excel (1 = secuencial, sin pool). Cada
+# uno importa pandas y openpyxl (~90 MB) y el pool es uno por worker de
+# gunicorn: por defecto a lo sumo 2, sin pasar de las CPUs del contenedor
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', min(2, available_cpus())))
+
+report_executor = None
+report_executor_lock = threading.Lock()
+
+def get_report_executor():
+    """
+    Devuelve el pool de procesos compartido para escribir reportes.
+    Se usa 'spawn' porque el proceso padre tiene hilos activos.
+    """
+    global report_executor
+    with report_executor_lock:
+        if report_executor is None:
+            report_executor = ProcessPoolExecutor(
+                max_workers=REPORT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=load_heavy_modules
+            )
+        return report_executor
+
+def reset_report_executor():
+    """Descarta el pool si un trabajador murió (por ejemplo, sin memoria)"""
+    global report_executor
+    with report_executor_lock:
+        if report_executor is not None:
+            report_executor.shutdown(wait=False, cancel_futures=True)
+        report_executor = None
+
+def run_in_log_context(process_id, fn, *args):
+    """Ejecuta fn en un trabajador del pool con el process_id en sus logs"""
+    with log_context(process_id):
+        return fn(*args)
+
+def run_report_tasks(process_id, tasks, progress_start, progress_end, parallel=True):
+    """
+    Ejecuta las tareas de escritura [(etiqueta, funcion, args), ...] y devuelve
+    sus resultados en el mismo orden. Devuelve None si el proceso se cancela.
+    Con parallel y REPORT_WORKERS > 1 las tareas corren en el pool de procesos,
+    con un máximo de tareas en vuelo para no duplicar todos los datos en memoria.
+    """
+    total = len(tasks)
+    results = [None] * total
+
+    def report_progress(done, label):
+        progress = progress_start + (done / total) * (progress_end - progress_start) if total else progress_end
+        set_process_state(process_id, status=f"Procesando {label}", progress=progress)
+
+    if not parallel or REPORT_WORKERS <= 1 or total <= 1:
+        for index, (label, fn, args) in enumerate(tasks):
+            # Verificar cancelación en cada iteración
+            if job_cancelled(process_id):
+                return None
+            report_progress(index, label)
+            results[index] = fn(*args)
+        return results
+
+    executor = get_report_executor()
+    max_in_flight = REPORT_WORKERS * 2
+    pending = {}
+    next_task = 0
+    done_count = 0
+
+    try:
+        while next_task < total or pending:
+            # Verificar cancelación mientras los trabajadores escriben
+            if job_cancelled(process_id):
+                for future in pending:
+                    future.cancel()
+                return None
+
+            while next_task < total and len(pending) < max_in_flight:
+                label, fn, args = tasks[next_task]
+                pending[executor.submit(run_in_log_context, process_id, fn, *args)] = (next_task, label)
+                next_task += 1
+
+            finished, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index, label = pending.pop(future)
+                results[index] = future.result()
+                done_count += 1
+                report_progress(done_count, label)
+    except BrokenProcessPool:
+        reset_report_executor()
+        raise
+
+    return results
+
+# ========================================================
+# ALMACÉN DE REPORTES POR PROCESO (TTL + PRESUPUESTO DE DISCO)
+# ========================================================
+
+ARTIFACTS_DIR = os.environ.get('ARTIFACTS_DIR', os.path.join(DATA_DIR, "reportes"))
+ARTIFACTS_TTL = int(os.environ.get('ARTIFACTS_TTL', 6 * 3600))  # segundos sin uso
+ARTIFACTS_MAX_BYTES = int(os.environ.get('ARTIFACTS_MAX_MB', 500)) * 1024 * 1024
+ARTIFACTS_SWEEP_INTERVAL = int(os.environ.get('ARTIFACTS_SWEEP_INTERVAL', 300))  # segundos
+
+artifacts_lock = threading.Lock()
+artifact_sweeper = None
+
+def job_artifact_dir(process_id):
+    """Directorio propio del proceso: los reportes de distintos procesos no se pisan"""
+    return safe_join(ARTIFACTS_DIR, process_id)
+
+def create_job_dir(job_dir):
+    """Crea el directorio de un proceso dentro de ARTIFACTS_DIR (privado)"""
+    private_dir(ARTIFACTS_DIR)
+    os.makedirs(job_dir, exist_ok=True)
+
+def artifact_link(process_id, file_name):
+    return f"/download/{process_id}/{file_name}"
+
+def artifact_path_from_link(link):
+    """Ruta en disco de un enlace /download/<process_id>/<archivo> (None si es inválido)"""
+    parts = link.split('/', 3)
+    if len(parts) != 4 or parts[1] != 'download':
+        return None
+    job_dir = job_artifact_dir(parts[2])
+    return safe_join(job_dir, parts[3]) if job_dir else None
+
+def touch_job_dir(job_dir):
+    """Marca el directorio como usado recientemente (para el desalojo LRU)"""
+    try:
+        os.utime(job_dir)
+    except OSError:
+        pass
+
+def remove_job_dir(job_dir):
+    shutil.rmtree(job_dir, ignore_errors=True)
+    if job_dir:
+        forget_zip_crcs(job_dir)
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def sweep_artifacts():
+    """
+    Elimina directorios de procesos sin uso por más de ARTIFACTS_TTL y, si el
+    total supera ARTIFACTS_MAX_BYTES, los menos usados recientemente.
+    Nunca toca los directorios de procesos activos.
+    """
+    if not os.path.isdir(ARTIFACTS_DIR):
+        return
+
+    with artifacts_lock:
+        with process_lock:
+            active = set(active_processes)
+        active |= set(shared_active_jobs())
+
+        now = time.time()
+        jobs = []
+        for name in os.listdir(ARTIFACTS_DIR):
+            job_dir = os.path.join(ARTIFACTS_DIR, name)
+            if name in active or not os.path.isdir(job_dir):
+                continue
+            try:
+                last_used = os.stat(job_dir).st_mtime
+            except OSError:
+                continue
+            if now - last_used > ARTIFACTS_TTL:
+                remove_job_dir(job_dir)
+                logger.info(f"🧹 Reportes expirados eliminados: {name}")
+                continue
+            jobs.append((last_used, dir_size(job_dir), name, job_dir))
+
+        total = sum(size for _, size, _, _ in jobs)
+        for _, size, name, job_dir in sorted(jobs):
+            if total <= ARTIFACTS_MAX_BYTES:
+                break
+            remove_job_dir(job_dir)
+            total -= size
+            logger.info(f"🧹 Reportes desalojados por espacio: {name}")
+
+def artifact_sweeper_loop():
+    while True:
+        time.sleep(ARTIFACTS_SWEEP_INTERVAL)
+        try:
+            sweep_artifacts()
+        except Exception as e:
+            logger.warning(f"⚠️ Error limpiando reportes: {e}")
+
+def start_artifact_sweeper():
+    """Inicia el hilo de limpieza una sola vez (no en los procesos hijos del pool)"""
+    global artifact_sweeper
+    with artifacts_lock:
+        if artifact_sweeper is None:
+            artifact_sweeper = threading.Thread(target=artifact_sweeper_loop, name="artifact-sweeper", daemon=True)
+            artifact_sweeper.start()
+
+# ========================================================
+# MÉTRICAS POR FASE Y FORMATO PROMETHEUS (/metrics)
+# ========================================================
+
+MB = 1024 * 1024
+
+METRICS_PREFIX = "servicios_medicos_"
+
+# Histogramas: nombre -> (ayuda, límites superiores de los buckets)
+HISTOGRAMS = {
+    "job_duration_seconds": ("Duración de los trabajos de procesamiento",
+                             (1, 5, 10, 30, 60, 120, 300, 600, 1200)),
+    "job_rows_per_second": ("Filas Crystal + Query procesadas por segundo",
+                            (1000, 5000, 10000, 25000, 50000, 100000, 250000, 500000)),
+    "job_files_written": ("Reportes Excel escritos por trabajo",
+                          (0, 1, 5, 10, 25, 50, 100, 250, 500)),
+    "upload_bytes": ("Tamaño de cada archivo subido",
+                     (MB, 5 * MB, 10 * MB, 20 * MB, 30 * MB, 40 * MB, 50 * MB)),
+}
+
+# Los valores viven en memoria de este proceso: con varios workers de
+# gunicorn cada uno expone los suyos
+metrics_lock = threading.Lock()
+histogram_values = {name: {"buckets": [0] * len(bounds), "sum": 0.0, "count": 0}
+                    for name, (_, bounds) in HISTOGRAMS.items()}
+jobs_by_status = {}
+# Reportes escritos por formato: {formato: {"files", "bytes", "seconds"}}
+report_writes = {}
+
+def observe(name, value):
+    """Registra un valor en el histograma (buckets acumulados como en Prometheus)"""
+    bounds = HISTOGRAMS[name][1]
+    with metrics_lock:
+        values = histogram_values[name]
+        for i, bound in enumerate(bounds):
+            if value <= bound:
+                values["buckets"][i] += 1
+        values["sum"] += value
+        values["count"] += 1
+
+def record_job_metrics(status, seconds, result):
+    """Métricas de un trabajo terminado (las de filas/archivos solo si se procesó)"""
+    with metrics_lock:
+        jobs_by_status[status] = jobs_by_status.get(status, 0) + 1
+    observe("job_duration_seconds", seconds)
+
+    metrics = result.get("metrics") if isinstance(result, dict) else None
+    if status != "completed" or not metrics:
+        return
+    if metrics.get("rows_per_second") is not None:
+        observe("job_rows_per_second", metrics["rows_per_second"])
+    observe("job_files_written", metrics["files_written"])
+
+    output = metrics.get("output")
+    if output and not output["lazy"]:
+        with metrics_lock:
+            totals = report_writes.setdefault(output["format"], {"files": 0, "bytes": 0, "seconds": 0.0})
+            totals["files"] += output["files"]
+            totals["bytes"] += output["bytes"]
+            totals["seconds"] += output["seconds"]
+
+def render_metrics():
+    """Texto en formato de exposición de Prometheus"""
+    lines = []
+    with metrics_lock:
+        for name, (help_text, bounds) in HISTOGRAMS.items():
+            metric = METRICS_PREFIX + name
+            values = histogram_values[name]
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for bound, count in zip(bounds, values["buckets"]):
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {count}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {values["count"]}')
+            lines.append(f"{metric}_sum {values['sum']}")
+            lines.append(f"{metric}_count {values['count']}")
+
+        metric = METRICS_PREFIX + "jobs_total"
+        lines.append(f"# HELP {metric} Trabajos terminados por estado")
+        lines.append(f"# TYPE {metric} counter")
+        for status, count in sorted(jobs_by_status.items()):
+            lines.append(f'{metric}{{status="{status}"}} {count}')
+
+        for name, key, help_text in (("report_files_total", "files", "Reportes escritos por formato"),
+                                     ("report_bytes_total", "bytes", "Bytes de reportes escritos por formato"),
+                                     ("report_write_seconds_total", "seconds", "Tiempo escribiendo reportes por formato")):
+            metric = METRICS_PREFIX + name
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for report_format, totals in sorted(report_writes.items()):
+                lines.append(f'{metric}{{format="{report_format}"}} {totals[key]}')
+
+    with process_lock:
+        queued = sum(1 for state in active_processes.values() if state.get("status") == "queued")
+        running = len(active_processes) - queued
+    metric = METRICS_PREFIX + "active_jobs"
+    lines.append(f"# HELP {metric} Trabajos en cola o en ejecución")
+    lines.append(f"# TYPE {metric} gauge")
+    lines.append(f'{metric}{{state="queued"}} {queued}')
+    lines.append(f'{metric}{{state="running"}} {running}')
+
+    metric = METRICS_PREFIX + "startup_seconds"
+    lines.append(f"# HELP {metric} Tiempo de arranque del worker por etapa")
+    lines.append(f"# TYPE {metric} gauge")
+    for stage, seconds in sorted(startup_timings.items()):
+        lines.append(f'{metric}{{stage="{stage.replace("_seconds", "")}"}} {seconds}')
+    return "\n".join(lines) + "\n"
+
+def rss_mb():
+    return psutil.Process().memory_info().rss / MB
+
+@contextmanager
+def phase_timer(phases, name):
+    """Mide duración y RSS al inicio/fin de una fase y lo guarda en phases[name]"""
+    rss_start = rss_mb()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        rss_end = rss_mb()
+        phases[name] = {"seconds": round(seconds, 4), "rss_start_mb": round(rss_start, 1), "rss_end_mb": round(rss_end, 1)}
+        logger.info(f"⏱️ Fase {name}: {seconds:.3f}s, RSS {rss_end:.1f} MB",
+                    extra={"phase": name, "seconds": round(seconds, 4), "rss_mb": round(rss_end, 1)})
+
+def build_job_metrics(started, phases, rows, files_written, output=None):
+    """
+    Resumen que se adjunta al resultado del trabajo; output son los números
+    del escritor de reportes (report_output_metrics)
+    """
+    duration = time.perf_counter() - started
+    total_rows = sum(rows.values())
+    snapshots = [phase[key] for phase in phases.values() for key in ("rss_start_mb", "rss_end_mb")]
+    metrics = {
+        "duration_seconds": round(duration, 4),
+        "phases": phases,
+        "rows": rows,
+        "rows_per_second": round(total_rows / duration, 1) if total_rows and duration > 0 else None,
+        "files_written": files_written,
+        "peak_rss_mb": max(snapshots, default=round(rss_mb(), 1)),
+    }
+    if output:
+        metrics["output"] = output
+    return metrics
+
+# ========================================================
+# ESTADO COMPARTIDO DE TRABAJOS (VARIOS WORKERS / INSTANCIAS)
+# ========================================================
+
+# memory: el estado vive solo en este proceso (por defecto).
+# sqlite: estado, cancelaciones y resultados se publican en un archivo SQLite
+# compartido, para correr varios workers de gunicorn o varias instancias
+# sobre el mismo volumen (ARTIFACTS_DIR también debe ser compartido).
+JOB_STATE_BACKEND = os.environ.get('JOB_STATE_BACKEND', 'memory').lower()
+SHARED_JOB_STATE = JOB_STATE_BACKEND == 'sqlite'
+JOB_STATE_DIR = os.environ.get('JOB_STATE_DIR', os.path.join(DATA_DIR, "estado_trabajos"))
+JOB_STATE_DB = os.path.join(JOB_STATE_DIR, "trabajos.sqlite3")
+JOB_RESULTS_DIR = os.path.join(JOB_STATE_DIR, "resultados")
+# El progreso se publica en lote una vez por intervalo, y con la misma
+# frecuencia el worker dueño revisa si otro pidió cancelar cada trabajo
+JOB_STATE_FLUSH_SECONDS = float(os.environ.get('JOB_STATE_FLUSH_SECONDS', 1.0))
+# Trabajos sin actualizaciones por más de esto se dan por perdidos (worker caído)
+JOB_STATE_STALE_SECONDS = int(os.environ.get('JOB_STATE_STALE_SECONDS', 900))
+
+JOB_STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    process_id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    state TEXT NOT NULL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    finished_at REAL,
+    updated_at REAL NOT NULL,
+    reports_process_id TEXT
+);
+"""
+
+job_store_local = threading.local()
+job_store_lock = threading.Lock()
+# Estados por publicar y última consulta de cancelación, por trabajo
+pending_states = {}
+cancel_checks = {}
+state_flusher = None
+
+def job_store():
+    """Conexión del hilo actual al almacén compartido (una por hilo, en autocommit)"""
+    conn = getattr(job_store_local, "conn", None)
+    if conn is None:
+        private_dir(JOB_STATE_DIR)
+        os.makedirs(JOB_RESULTS_DIR, exist_ok=True)
+        conn = sqlite3.connect(JOB_STATE_DB, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(JOB_STATE_SCHEMA)
+        if "reports_process_id" not in {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}:
+            try:
+                conn.execute("ALTER TABLE jobs ADD COLUMN reports_process_id TEXT")
+            except sqlite3.OperationalError:
+                pass  # Otro worker ya la agregó
+        job_store_local.conn = conn
+    return conn
+
+def state_owner():
+    """Identifica al worker dueño de un trabajo"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def job_result_path(process_id):
+    return os.path.join(JOB_RESULTS_DIR, f"{process_id}.json")
+
+UPSERT_JOB_STATE = (
+    "INSERT INTO jobs (process_id, owner, state, updated_at) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(process_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at "
+    "WHERE cancel_requested = 0 AND finished_at IS NULL"
+)
+
+def store_job_state(process_id, state, force=False):
+    """
+    Publica el estado de un trabajo activo. Sin force solo queda pendiente:
+    el hilo de publicación escribe los pendientes de todos los trabajos en
+    una transacción cada JOB_STATE_FLUSH_SECONDS. No pisa un trabajo ya
+    cancelado o terminado.
+    """
+    if not SHARED_JOB_STATE:
+        return
+    if not force:
+        with job_store_lock:
+            pending_states[process_id] = state
+        start_state_flusher()
+        return
+    with job_store_lock:
+        pending_states.pop(process_id, None)
+    try:
+        job_store().execute(UPSERT_JOB_STATE, (process_id, state_owner(), json.dumps(state, default=str), time.time()))
+    except sqlite3.Error as e:
+        logger.warning(f"⚠️ No se pudo publicar el estado del proceso: {e}")
+
+def flush_job_states():
+    """Escribe de una vez los estados pendientes"""
+    with job_store_lock:
+        states = list(pending_states.items())
+        pending_states.clear()
+    if not states:
+        return
+    owner, now = state_owner(), time.time()
+    conn = job_store()
+    with conn:
+        conn.execute("BEGIN")
+        conn.executemany(UPSERT_JOB_STATE, [(process_id, owner, json.dumps(state, default=str), now)
+                                            for process_id, state in states])
+
+def state_flusher_loop():
+    while True:
+        time.sleep(JOB_STATE_FLUSH_SECONDS)
+        try:
+            flush_job_states()
+        except Exception as e:
+            logger.warning(f"⚠️ Error publicando estados: {e}")
+
+def start_state_flusher():
+    """Inicia el hilo de publicación una sola vez por worker"""
+    global state_flusher
+    with job_store_lock:
+        if state_flusher is None:
+            state_flusher = threading.Thread(target=state_flusher_loop, name="state-flusher", daemon=True)
+            state_flusher.start()
+
+def load_job_state(process_id):
+    """Estado publicado de un trabajo (de cualquier worker) o None"""
+    if not SHARED_JOB_STATE:
+        return None
+    row = job_store().execute(
+        "SELECT state, cancel_requested, finished_at FROM jobs WHERE process_id = ?", (process_id,)).fetchone()
+    if row is None:
+        return None
+    state = json.loads(row[0])
+    if row[2] is not None:
+        return {"status": state["status"], "progress": 100}
+    if row[1]:
+        return {"status": "cancelled", "progress": state.get("progress", 0)}
+    return state
+
+def request_job_cancel(process_id):
+    """Marca la cancelación para el worker dueño. True si el trabajo seguía activo."""
+    if not SHARED_JOB_STATE:
+        return False
+    cursor = job_store().execute(
+        "UPDATE jobs SET cancel_requested = 1, updated_at = ? "
+        "WHERE process_id = ? AND finished_at IS NULL AND cancel_requested = 0",
+        (time.time(), process_id))
+    return cursor.rowcount > 0
+
+def job_cancel_requested(process_id, force=False):
+    """¿Se pidió cancelar desde otro worker? Consulta a lo sumo cada JOB_STATE_FLUSH_SECONDS."""
+    if not SHARED_JOB_STATE:
+        return False
+    now = time.monotonic()
+    with job_store_lock:
+        if not force and now - cancel_checks.get(process_id, 0) < JOB_STATE_FLUSH_SECONDS:
+            return False
+        cancel_checks[process_id] = now
+    try:
+        row = job_store().execute(
+            "SELECT cancel_requested FROM jobs WHERE process_id = ?", (process_id,)).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"⚠️ No se pudo consultar la cancelación: {e}")
+        return False
+    return bool(row and row[0])
+
+def job_cancelled(process_id):
+    """
+    ¿El trabajo fue cancelado? Localmente ya no está en active_processes; con
+    estado compartido también cuenta la marca puesta por otro worker, que se
+    aplica aquí igual que una cancelación local.
+    """
+    if process_id not in active_processes:
+        return True
+    if job_cancel_requested(process_id):
+        with process_lock:
+            active_processes.pop(process_id, None)
+        logger.info(f"✅ Proceso {process_id} cancelado desde otro worker")
+        return True
+    return False
+
+def store_job_result(process_id, job):
+    """Publica el resultado final de un trabajo para que cualquier worker lo sirva"""
+    with job_store_lock:
+        pending_states.pop(process_id, None)
+        cancel_checks.pop(process_id, None)
+    if not SHARED_JOB_STATE:
+        return
+    try:
+        path = job_result_path(process_id)
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({key: job[key] for key in ("status", "result", "finished_at", "inputs") if key in job}, f, default=str)
+        os.replace(tmp_path, path)
+        job_store().execute(
+            "INSERT INTO jobs (process_id, owner, state, finished_at, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(process_id) DO UPDATE SET state = excluded.state, "
+            "finished_at = excluded.finished_at, updated_at = excluded.updated_at",
+            (process_id, state_owner(), json.dumps({"status": job["status"]}), job["finished_at"], time.time()))
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"⚠️ No se pudo publicar el resultado del proceso: {e}")
+
+def load_job_result(process_id):
+    """Resultado final publicado por cualquier worker, o None"""
+    if not SHARED_JOB_STATE:
+        return None
+    row = job_store().execute(
+        "SELECT finished_at FROM jobs WHERE process_id = ?", (process_id,)).fetchone()
+    if row is None or row[0] is None:
+        return None
+    try:
+        with open(job_result_path(process_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def claim_job_reports(process_id, reports_id):
+    """
+    Reserva en el almacén compartido los reportes de un trabajo de solo
+    resumen, en una sola sentencia. Devuelve el proceso de reportes que otro
+    worker ya encoló, o None si la reserva quedó para reports_id.
+    """
+    if not SHARED_JOB_STATE:
+        return None
+    conn = job_store()
+    cursor = conn.execute(
+        "UPDATE jobs SET reports_process_id = ? WHERE process_id = ? AND reports_process_id IS NULL",
+        (reports_id, process_id))
+    if cursor.rowcount:
+        return None
+    row = conn.execute("SELECT reports_process_id FROM jobs WHERE process_id = ?", (process_id,)).fetchone()
+    return row[0] if row else None
+
+def release_job_reports(process_id, reports_id):
+    """Libera la reserva si no se pudo encolar el proceso de reportes"""
+    if not SHARED_JOB_STATE:
+        return
+    try:
+        job_store().execute(
+            "UPDATE jobs SET reports_process_id = NULL WHERE process_id = ? AND reports_process_id = ?",
+            (process_id, reports_id))
+    except sqlite3.Error as e:
+        logger.warning(f"⚠️ No se pudo liberar la reserva de reportes: {e}")
+
+def shared_active_jobs():
+    """{process_id: estado} de los trabajos activos de otros workers"""
+    if not SHARED_JOB_STATE:
+        return {}
+    try:
+        rows = job_store().execute(
+            "SELECT process_id, state FROM jobs WHERE finished_at IS NULL AND cancel_requested = 0 "
+            "AND owner != ? AND updated_at > ?",
+            (state_owner(), time.time() - JOB_STATE_STALE_SECONDS)).fetchall()
+    except sqlite3.Error as e:
+        logger.warning(f"⚠️ No se pudo leer el estado compartido: {e}")
+        return {}
+    return {process_id: json.loads(state) for process_id, state in rows}
+
+def prune_job_store(limit):
+    """Elimina trabajos terminados antes de limit y los abandonados por workers caídos"""
+    if not SHARED_JOB_STATE:
+        return
+    try:
+        conn = job_store()
+        stale = time.time() - max(JOB_STATE_STALE_SECONDS, JOB_RESULT_TTL)
+        expired = [row[0] for row in conn.execute(
+            "SELECT process_id FROM jobs WHERE finished_at < ? OR (finished_at IS NULL AND updated_at < ?)",
+            (limit, stale))]
+        for process_id in expired:
+            conn.execute("DELETE FROM jobs WHERE process_id = ?", (process_id,))
+            try:
+                os.remove(job_result_path(process_id))
+            except OSError:
+                pass
+    except sqlite3.Error as e:
+        logger.warning(f"⚠️ No se pudo limpiar el estado compartido: {e}")
+
+# ========================================================
+# CONTROL DE ESTADO DE PROCESOS
+# ========================================================
+
+def set_process_state(process_id, **state):
+    """
+    Actualiza el estado de un proceso activo.
+    Si el proceso fue cancelado (ya no está en active_processes) no lo revive.
+    Con estado compartido se publica agrupando las escrituras de progreso.
+    La marca remota se consulta antes de tomar process_lock: job_cancelled
+    lo toma para sacar el trabajo de active_processes.
+    """
+    if job_cancelled(process_id):
+        return
+    with process_lock:
+        if process_id not in active_processes:
+            return
+        active_processes[process_id].update(state)
+        snapshot = dict(active_processes[process_id])
+    store_job_state(process_id, snapshot)
+
+def get_process_state(process_id):
+    """
+    Devuelve una copia del estado del proceso (activo o terminado) o None.
+    Si no es de este worker se busca en el estado compartido.
+    """
+    with process_lock:
+        if process_id in active_processes:
+            return dict(active_processes[process_id])
+        job = job_results.get(process_id)
+        if job:
+            return {"status": job["status"], "progress": 100}
+    return load_job_state(process_id)
+
+def get_job(process_id):
+    """
+    Trabajo terminado {"status", "result", "finished_at"} de este worker o,
+    con estado compartido, publicado por otro (queda en job_results)
+    """
+    with process_lock:
+        job = job_results.get(process_id)
+    if job is None:
+        job = load_job_result(process_id)
+        if job is not None:
+            with process_lock:
+                job = job_results.setdefault(process_id, job)
+    return job
+
+# ========================================================
+# LOTES: VARIOS ARCHIVOS CRYSTAL / QUERY EN UN TRABAJO
+# ========================================================
+
+# Máximo de archivos por lado (Crystal o Query) en una misma carga
+MAX_BATCH_FILES = int(os.environ.get('MAX_BATCH_FILES', 24))
+# Columna agregada en modo lote con el archivo de origen de cada fila
+SOURCE_COLUMN = "Archivo"
+
+def as_path_list(paths):
+    """Una ruta o una lista de rutas, siempre como lista"""
+    if paths is None:
+        return []
+    if isinstance(paths, (list, tuple)):
+        return list(paths)
+    return [paths]
+
+def unique_source_names(names):
+    """Nombres de archivo para mostrar, sin repetidos ('sede.xlsx', 'sede.xlsx (2)')"""
+    seen = {}
+    result = []
+    for name in names:
+        seen[name] = seen.get(name, 0) + 1
+        result.append(name if seen[name] == 1 else f"{name} ({seen[name]})")
+    return result
+
+def batch_digest(inputs, names):
+    """Huella de un lado del lote: contenido y nombre de cada archivo, en orden"""
+    payload = json.dumps([[digest, name] for (digest, _, _, _), name in zip(inputs, names)])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def reconcile_columns(df, columns, target_columns, source_name):
+    """
+    Renombra las columnas clave detectadas en un archivo a los nombres del
+    primero del lote. Si el archivo ya tiene otra columna con ese nombre, se
+    conserva con el nombre del archivo como sufijo.
+    """
+    renames = {}
+    for col, target in zip(columns, target_columns):
+        if col and target and col != target:
+            renames[col] = target
+    for target in renames.values():
+        if target in df.columns and target not in renames:
+            renames[target] = f"{target} [{source_name}]"
+    if SOURCE_COLUMN in df.columns:
+        renames[SOURCE_COLUMN] = f"{SOURCE_COLUMN} original"
+    return df.rename(columns=renames) if renames else df
+
+def read_batch_inputs(process_id, batch, progress_range, cache=True):
+    """
+    Lee en paralelo (pool de reportes) los archivos del lote que no estaban
+    en caché y, con cache, guarda cada uno en la caché. batch es una lista de
+    [(ruta, nombre, (digest, df_o_None, encabezados, columnas)), ...].
+    Devuelve la lista de DataFrames en el mismo orden, o None si se cancela.
+    """
+    frames = [inputs[1] for _, _, inputs in batch]
+    missing = [i for i, frame in enumerate(frames) if frame is None]
+    tasks = [(batch[i][1], read_large_excel, (batch[i][0],)) for i in missing]
+    results = run_report_tasks(process_id, tasks, *progress_range)
+    if results is None:
+        return None
+    for i, df in zip(missing, results):
+        digest, _, _, columns = batch[i][2]
+        if cache:
+            put_cached_input(digest, df, columns)
+        frames[i] = df
+    return frames
+
+def concat_batch(frames, batch, target_columns):
+    """
+    Une los archivos de un lado en un solo DataFrame con las columnas clave
+    del primero y la columna de origen al inicio. Devuelve (df, rangos de
+    filas por archivo [(nombre, inicio, fin, columnas), ...]).
+    """
+    parts = []
+    ranges = []
+    start = 0
+    for df, (_, name, inputs) in zip(frames, batch):
+        ranges.append((name, start, start + len(df), df.shape[1]))
+        df = reconcile_columns(df, inputs[3], target_columns, name)
+        df.insert(0, SOURCE_COLUMN, name)
+        parts.append(df)
+        start += len(df)
+    combined = pd.concat(parts, ignore_index=True, sort=False)
+    combined[SOURCE_COLUMN] = combined[SOURCE_COLUMN].astype("category")
+    return combined, ranges
+
+def file_totals(df, ranges, columns):
+    """Totales de cada archivo del lote sobre las columnas ya reconciliadas"""
+    col_prof, col_serv, col_user = columns
+    totals = []
+    for name, start, end, num_columns in ranges:
+        part = df.iloc[start:end]
+        totals.append({
+            "archivo": name,
+            "filas": int(end - start),
+            "columnas": int(num_columns),
+            "profesionales": int(part[col_prof].nunique()) if col_prof in part.columns else 0,
+            "usuarios": int(part[col_user].nunique()) if col_user in part.columns else 0,
+            "servicios_por_categoria": count_values(part[col_serv]) if col_serv in part.columns else {},
+        })
+    return totals
+
+# ========================================================
+# PROCESAMIENTO PRINCIPAL SIMPLIFICADO
+# ========================================================
+
+def process_excel(file1_path, file2_path, process_id, use_cache=True, lazy=False, source_names=None,
+                  summary=False, report_format="xlsx"):
+    """
+    Procesa los archivos y genera Excel por profesional SOLO con datos completos.
+    Con use_cache=False se ignora el resultado guardado para el mismo par de archivos.
+    Con lazy=True los Excel se generan recién en su primera descarga.
+    file1_path y file2_path pueden ser listas de rutas (modo lote): se unen
+    con las columnas del primer archivo y source_names ({ruta: nombre}) da
+    el nombre de cada archivo en la columna de origen y los totales por archivo.
+    Con summary=True solo se calculan los totales, sin escribir nada en disco
+    (ni reportes ni cachés); los reportes se piden luego en /jobs/<id>/reports.
+    report_format elige el escritor (REPORT_FORMATS); workbook ignora lazy.
+    """
+    load_heavy_modules()
+    if report_format == "workbook":
+        lazy = False
+    # Libros abiertos al detectar columnas, pendientes de leer
+    sources = {}
+    try:
+        # Verificar si el proceso fue cancelado
+        if job_cancelled(process_id):
+            return {"error": "Proceso cancelado por el usuario"}
+
+        # Tiempo y RSS por fase, se adjuntan al resultado en "metrics"
+        started = time.perf_counter()
+        phases = {}
+        
+        # Directorio propio del proceso (se crea al escribir los reportes)
+        output_dir = job_artifact_dir(process_id)
+        logger.info("🧩 Iniciando procesamiento...")
+        logger.info(f"📁 Directorio de reportes: {output_dir}")
+
+        crystal_paths = as_path_list(file1_path)
+        query_paths = as_path_list(file2_path)
+        batch_mode = len(crystal_paths) > 1 or len(query_paths) > 1
+
+        # Verificar que los archivos existen
+        for path in crystal_paths:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Archivo 1 no encontrado: {path}")
+        for path in query_paths:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Archivo 2 no encontrado: {path}")
+
+        # Actualizar estado del proceso
+        set_process_state(process_id, status="reading_files", progress=10)
+        
+        # Caché por contenido; si no hay acierto se leen solo los encabezados
+        # para detectar columnas antes de cargar datos
+        cache_stats = {"hits": 0, "misses": 0}
+        with phase_timer(phases, "detect_columns"):
+            if batch_mode:
+                # Cada archivo se detecta por separado; el primero define el esquema
+                names = source_names or {}
+                crystal_names = unique_source_names([names.get(p, os.path.basename(p)) for p in crystal_paths])
+                query_names = unique_source_names([names.get(p, os.path.basename(p)) for p in query_paths])
+                crystal_inputs = [prepare_input(p, "CRYSTAL", cache_stats) for p in crystal_paths]
+                query_inputs = [prepare_input(p, "QUERY", cache_stats) for p in query_paths]
+                _, cached_df1, headers1, (col_prof1, col_serv1, col_user1) = crystal_inputs[0]
+                _, cached_df2, headers2, (col_prof2, col_serv2, col_user2) = query_inputs[0]
+                digest1 = batch_digest(crystal_inputs, crystal_names)
+                digest2 = batch_digest(query_inputs, query_names)
+            else:
+                digest1, cached_df1, headers1, (col_prof1, col_serv1, col_user1) = prepare_input(
+                    file1_path, "CRYSTAL", cache_stats, sources)
+                digest2, cached_df2, headers2, (col_prof2, col_serv2, col_user2) = prepare_input(
+                    file2_path, "QUERY", cache_stats, sources)
+        
+        logger.info(f"📊 CRYSTAL - Profesional: '{col_prof1}', Servicio: '{col_serv1}', Usuario: '{col_user1}'")
+        logger.info(f"📊 QUERY   - Profesional: '{col_prof2}', Servicio: '{col_serv2}', Usuario: '{col_user2}'")
+
+        # Verificar que tenemos las columnas mínimas necesarias
+        if not col_prof1:
+            error_msg = {
+                "error": "❌ No se pudo detectar la columna de profesional en el archivo CRYSTAL",
+                "details": {
+                    "crystal_columns": headers1,
+                    "query_columns": headers2
+                }
+            }
+            return error_msg
+
+        column_mapping = {
+            "crystal": {"profesional": str(col_prof1), "servicio": str(col_serv1), "usuario": str(col_user1)},
+            "query": {"profesional": str(col_prof2), "servicio": str(col_serv2), "usuario": str(col_user2)}
+        }
+
+        # Mismo par de archivos ya procesado: devolver el resultado guardado
+        result_key = result_cache_key(digest1, digest2, column_mapping, report_format)
+        if use_cache and not summary:
+            cached_result = get_cached_result(result_key)
+            if cached_result is not None:
+                logger.info(f"⚡ Resultado recuperado de caché ({result_key[:12]})")
+                set_process_state(process_id, status="completed", progress=100)
+                cached_result["cache"] = {"parsed_inputs": cache_stats, "result": "hit"}
+                cached_result["process_id"] = process_id
+                cached_result["metrics"] = build_job_metrics(started, phases, {"crystal": 0, "query": 0}, 0)
+                return cached_result
+
+        crystal_columns = (col_prof1, col_serv1, col_user1)
+        query_columns = (col_prof2, col_serv2, col_user2)
+
+        file_ranges = None
+        if batch_mode:
+            # Lectura en paralelo de todos los archivos no cacheados del lote
+            crystal_batch = list(zip(crystal_paths, crystal_names, crystal_inputs))
+            query_batch = list(zip(query_paths, query_names, query_inputs))
+            del cached_df1, cached_df2
+            with phase_timer(phases, "read_files"):
+                frames = read_batch_inputs(process_id, crystal_batch + query_batch, (10, 30), cache=not summary)
+            if frames is None:
+                return {"error": "Proceso cancelado por el usuario"}
+            with phase_timer(phases, "concat"):
+                df1, crystal_ranges = concat_batch(frames[:len(crystal_batch)], crystal_batch, crystal_columns)
+                df2, query_ranges = concat_batch(frames[len(crystal_batch):], query_batch, query_columns)
+            del frames, crystal_inputs, query_inputs, crystal_batch, query_batch
+            file_ranges = {"crystal": crystal_ranges, "query": query_ranges}
+            logger.info(f"📚 Lote unido: {len(crystal_ranges)} archivo(s) CRYSTAL, {len(query_ranges)} archivo(s) QUERY")
+            cached_df1 = df1
+            cached_df2 = df2
+
+        # En modo resumen solo hacen falta las columnas clave (y no se cachean)
+        usecols1 = [col for col in crystal_columns if col] if summary else None
+        usecols2 = [col for col in query_columns if col] if summary else None
+        df1 = cached_df1
+        if df1 is None:
+            with phase_timer(phases, "read_crystal"):
+                df1 = read_large_excel(file1_path, process_id, usecols1, progress_range=(10, 20),
+                                       source=sources.pop(file1_path, None))
+            if df1 is None:
+                return {"error": "Proceso cancelado por el usuario"}
+            if not summary:
+                put_cached_input(digest1, df1, (col_prof1, col_serv1, col_user1))
+        df2 = cached_df2
+        if df2 is None:
+            with phase_timer(phases, "read_query"):
+                df2 = read_large_excel(file2_path, process_id, usecols2, progress_range=(20, 30),
+                                       source=sources.pop(file2_path, None))
+            if df2 is None:
+                return {"error": "Proceso cancelado por el usuario"}
+            if not summary:
+                put_cached_input(digest2, df2, (col_prof2, col_serv2, col_user2))
+        del cached_df1, cached_df2
+        rows = {"crystal": int(len(df1)), "query": int(len(df2))}
+
+        with phase_timer(phases, "encode_keys"):
+            encode_key_columns(df1, crystal_columns)
+            encode_key_columns(df2, query_columns)
+
+        # Totales por archivo del lote, antes de agregar columnas de validación
+        files = None
+        if file_ranges:
+            files = {
+                "crystal": file_totals(df1, file_ranges["crystal"], crystal_columns),
+                "query": file_totals(df2, file_ranges["query"], query_columns),
+            }
+
+        # Verificar cancelación
+        if job_cancelled(process_id):
+            return {"error": "Proceso cancelado por el usuario"}
+
+        set_process_state(process_id, status="processing_professionals", progress=30)
+
+        with phase_timer(phases, "aggregation"):
+            aggregates = compute_aggregates(df1, df2, crystal_columns, query_columns)
+        professionals = aggregates["professionals"]
+
+        professional_data = {}
+        user_data = {}
+
+        with phase_timer(phases, "validation"):
+            in_query, in_crystal = cross_validate(df1, df2, col_user1, col_user2)
+            if not summary:
+                df1['Validación Query'] = yes_no_column(in_query, df1.index)
+
+        if summary:
+            # Totales por profesional en una pasada agrupada, sin reportes
+            with phase_timer(phases, "summary"):
+                professional_data = summarize_professionals(df1, crystal_columns, professionals)
+                if col_user2 in df2.columns:
+                    user_data["query_validation"] = query_validation_totals(in_crystal, len(df2))
+        else:
+            # Particionar Crystal por profesional en una sola pasada
+            with phase_timer(phases, "partition"):
+                df1_sorted, prof_ranges = partition_by_professional(df1, col_prof1)
+
+            create_job_dir(output_dir)
+
+            tasks, task_professionals = build_report_tasks(
+                df1_sorted, prof_ranges, professionals, df2, in_crystal,
+                (col_serv1, col_user1, col_user2), output_dir, process_id, lazy, report_format)
+
+            # En modo diferido solo se guardan los datos: no vale la pena el pool.
+            # En workbook las tareas no escriben y el libro se escribe aquí
+            with phase_timer(phases, "write_reports"):
+                results = run_report_tasks(process_id, tasks, 30, 85,
+                                           parallel=not lazy and report_format != "workbook")
+                if results is not None and report_format == "workbook":
+                    write_workbook_report(tasks, results, output_dir)
+            if results is None:
+                return {"error": "Proceso cancelado por el usuario"}
+
+            if col_user2 in df2.columns:
+                user_data["query_validation"] = results.pop(0)
+            for prof, entry in zip(task_professionals, results):
+                professional_data[str(prof)] = entry
+
+            del df1_sorted, tasks, results
+
+        # Limpiar memoria
+        del df1, df2
+        gc.collect()
+
+        set_process_state(process_id, status="completed", progress=100)
+
+        mem = psutil.virtual_memory()
+        logger.info(f"✅ Procesamiento completo. Uso de memoria: {mem.percent}%")
+
+        # Construir resultado final con tipos nativos
+        result_data = {
+            "totals": aggregates["totals"],
+            "professionals": professionals,
+            "usuarios_crystal": aggregates["usuarios_crystal"],
+            "usuarios_query": aggregates["usuarios_query"],
+            "professional_data": professional_data,
+            "user_data": user_data,
+            "column_mapping": column_mapping,
+            "cache": {"parsed_inputs": cache_stats, "result": "miss" if use_cache and not summary else "bypass"},
+            "process_id": process_id
+        }
+        if files:
+            result_data["files"] = files
+        if summary:
+            result_data["summary_only"] = True
+
+        # Aplicar serialización segura a TODO el resultado
+        with phase_timer(phases, "serialize"):
+            result = safe_serialize(result_data)
+
+        if summary:
+            result["metrics"] = build_job_metrics(started, phases, rows, 0)
+            return result
+
+        # En modo diferido los reportes se escriben al descargarlos
+        artifacts = [os.path.join(output_dir, entry["nombre_archivo"]) for entry in professional_data.values()]
+        artifacts += [os.path.join(output_dir, entry["nombre_archivo"]) for entry in user_data.values()]
+        files_written = 0 if lazy else len(set(artifacts))
+        output = report_output_metrics(report_format, artifacts, phases, sum(rows.values()), lazy)
+        result["metrics"] = build_job_metrics(started, phases, rows, files_written, output)
+        sweep_artifacts()
+        put_cached_result(result_key, result, artifacts)
+
+        return result
+
+    except Exception as e:
+        logger.exception(f"❌ Error en procesamiento: {e}")
+        return {"error": f"Error en procesamiento: {str(e)}"}
+    finally:
+        close_excel_inputs(sources)
+
+# ========================================================
+# MOTOR FUERA DE MEMORIA (SQLITE EN DISCO)
+# ========================================================
+
+# memory: todo en DataFrames (lo más rápido). sqlite: las filas se copian a
+# una base SQLite temporal, las agregaciones y la validación cruzada se hacen
+# en SQL y cada reporte se escribe desde un cursor, así la memoria no crece
+# con el tamaño de los archivos. auto: sqlite solo si la estimación de
+# memoria no cabe en el presupuesto.
+ENGINES = ("auto", "memory", "sqlite")
+PROCESS_ENGINE = os.environ.get('PROCESS_ENGINE', 'auto').lower()
+if PROCESS_ENGINE not in ENGINES:
+    PROCESS_ENGINE = "auto"
+OUT_OF_CORE_DIR = os.environ.get('OUT_OF_CORE_DIR', os.path.join(DATA_DIR, "motor_sqlite"))
+# Pico de memoria estimado de un trabajo con el motor sqlite (no depende de los archivos)
+OUT_OF_CORE_MEMORY_MB = int(os.environ.get('OUT_OF_CORE_MEMORY_MB', 150))
+# Caché de páginas de SQLite por trabajo
+OUT_OF_CORE_CACHE_MB = int(os.environ.get('OUT_OF_CORE_CACHE_MB', 64))
+OUT_OF_CORE_BATCH_ROWS = 5000
+
+# Tipos que SQLite no guarda tal cual: se guardan como texto/entero y se
+# restauran al escribir el reporte
+RESTORABLE_TYPES = (datetime.datetime, datetime.date, datetime.time, bool)
+
+def sqlite_cell(value):
+    """Valor ya normalizado, en un tipo que SQLite conserva"""
+    if isinstance(value, RESTORABLE_TYPES):
+        if isinstance(value, bool):
+            return int(value)
+        return value.isoformat()
+    return value
+
+def restore_type(value_types):
+    """
+    Tipo a restaurar en una columna según los tipos de Python que tenía: el
+    único tipo de RESTORABLE_TYPES presente (bool solo si no hay otros valores)
+    """
+    restorable = [value_type for value_type in RESTORABLE_TYPES if value_type in value_types]
+    if len(restorable) != 1 or (restorable[0] is bool and len(value_types) > 1):
+        return None
+    return restorable[0]
+
+def restore_cell(value, value_type):
+    """Inverso de sqlite_cell para las columnas con fechas u horas"""
+    if value is None or value_type is None:
+        return value
+    if value_type is bool:
+        return bool(value)
+    if isinstance(value, str):
+        try:
+            return value_type.fromisoformat(value)
+        except ValueError:
+            return value
+    return value
+
+def track_key_kind(kind, value):
+    """
+    Acumula en kind si la columna clave quedaría numérica al leerla con
+    pandas ("numeric": números o texto numérico) y si sería float ("float":
+    con vacíos o decimales). "text" indica que hubo texto numérico.
+    """
+    if value is None:
+        kind["float"] = True
+    elif not kind["numeric"]:
+        return
+    elif isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        kind["numeric"] = False
+    elif isinstance(value, float):
+        kind["float"] = True
+    elif isinstance(value, str):
+        kind["text"] = True
+        try:
+            int(value)
+        except ValueError:
+            try:
+                float(value)
+                kind["float"] = True
+            except ValueError:
+                kind["numeric"] = False
+
+def numeric_key(text, as_float):
+    """Clave (key_text) del número que pandas lee en una columna numérica con texto numérico"""
+    if text == "":
+        return text
+    return key_text(float(text)) if as_float else str(int(text))
+
+def load_sheet_into_sqlite(conn, table, path, key_columns, process_id, progress_range, source=None):
+    """
+    Copia la primera hoja a la tabla en lotes: columnas c0..cN con los valores
+    y k_prof, k_serv, k_user con las claves como texto. Filas vacías y celdas
+    se tratan igual que en read_large_excel (source: libro ya abierto por
+    read_excel_headers). Devuelve (encabezados, conjunto de tipos de Python
+    de cada columna, filas) o None si el proceso se cancela.
+    """
+    logger.info(f"📘 Copiando a SQLite: {os.path.basename(path)} ...")
+    source = source or open_excel_input(path)
+    wb, ws, rows = source["wb"], source["ws"], source["rows"]
+    header_row, headers = source["header_row"], source["headers"]
+    try:
+        width = len(headers)
+        key_index = [headers.index(col) if col in headers else None for col in key_columns]
+
+        columns = ", ".join(f"c{i}" for i in range(width))
+        conn.execute(f"CREATE TABLE {table} (row INTEGER PRIMARY KEY, k_prof TEXT, k_serv TEXT, k_user TEXT"
+                     f"{', ' if width else ''}{columns})")
+        insert = f"INSERT INTO {table} VALUES (NULL, ?, ?, ?{', ?' * width})"
+
+        total_rows = max((ws.max_row or 0) - 1, 1)
+        value_types = [set() for _ in range(width)]
+        blank = (None,) * width
+        batch = []
+        pending_blank = 0
+        rows_read = 0
+
+        kinds = [{"numeric": True, "float": False, "text": False} for _ in key_columns]
+
+        def key_values(values):
+            keys = []
+            for i, kind in zip(key_index, kinds):
+                value = values[i] if i is not None else None
+                track_key_kind(kind, value)
+                keys.append(key_text(value))
+            return keys
+
+        for row in rows:
+            # Filas vacías intermedias se conservan; las finales se descartan
+            if not any(value is not None for value in row):
+                pending_blank += 1
+                continue
+            while pending_blank:
+                for kind in kinds:
+                    kind["float"] = True
+                batch.append(("", "", "") + blank)
+                pending_blank -= 1
+                rows_read += 1
+            cells = [normalize_cell(row[i]) if i < len(row) else None for i in range(width)]
+            for i, value in enumerate(cells):
+                if value is not None:
+                    value_types[i].add(type(value))
+            batch.append(tuple(key_values(cells)) + tuple(sqlite_cell(value) for value in cells))
+            rows_read += 1
+
+            if len(batch) >= OUT_OF_CORE_BATCH_ROWS:
+                conn.executemany(insert, batch)
+                batch.clear()
+                if job_cancelled(process_id):
+                    logger.info(f"🛑 Copia cancelada: {os.path.basename(path)}")
+                    return None
+                start, end = progress_range
+                progress = start + min(rows_read / total_rows, 1) * (end - start)
+                set_process_state(process_id, status=f"Leyendo {os.path.basename(path)}", progress=progress)
+        if batch:
+            conn.executemany(insert, batch)
+
+        # Columnas clave que pandas leería como números: misma clave que en memoria
+        for name, i, kind in zip(("k_prof", "k_serv", "k_user"), key_index, kinds):
+            if i is not None and kind["numeric"] and (kind["float"] or kind["text"]):
+                conn.execute(f"UPDATE {table} SET {name} = numeric_key({name}, ?) WHERE {name} != ''",
+                             (kind["float"],))
+        conn.commit()
+    finally:
+        wb.close()
+
+    # Columnas finales sin encabezado ni datos se descartan, como en pandas
+    while width and header_row[width - 1] is None and not value_types[width - 1]:
+        width -= 1
+    logger.info(f"✅ Archivo {os.path.basename(path)} copiado: {rows_read} filas, {width} columnas.")
+    return headers[:width], value_types[:width], rows_read
+
+def report_rows(cursor, value_types):
+    """Filas de un cursor con los tipos restaurados y la última columna como SI/NO"""
+    restore = [restore_type(types) for types in value_types]
+    for row in cursor:
+        values = [restore_cell(value, value_type) for value, value_type in zip(row, restore)]
+        values.append('SI' if row[-1] else 'NO')
+        yield values
+
+def out_of_core_connect(process_id):
+    """Base temporal del trabajo, sin diario y con caché de páginas acotada"""
+    private_dir(OUT_OF_CORE_DIR)
+    path = os.path.join(OUT_OF_CORE_DIR, f"{process_id}.sqlite3")
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA temp_store=FILE")
+    conn.execute(f"PRAGMA cache_size=-{OUT_OF_CORE_CACHE_MB * 1024}")
+    conn.create_function("numeric_key", 2, numeric_key, deterministic=True)
+    return conn, path
+
+def process_out_of_core(file1_path, file2_path, process_id, summary=False, report_format="xlsx"):
+    """
+    Mismo resultado que process_excel con el motor sqlite: las filas pasan
+    del lector en streaming a SQLite, los totales, la validación cruzada y el
+    particionado por profesional son consultas, y cada reporte se escribe
+    desde un cursor (xlsx también en modo write_only). Con summary=True no
+    se escriben reportes.
+    """
+    load_heavy_modules()
+    conn = None
+    db_path = None
+    sources = {}
+    try:
+        if job_cancelled(process_id):
+            return {"error": "Proceso cancelado por el usuario"}
+
+        started = time.perf_counter()
+        phases = {}
+        output_dir = job_artifact_dir(process_id)
+        logger.info("🧩 Iniciando procesamiento fuera de memoria (SQLite)...")
+
+        for path in (file1_path, file2_path):
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Archivo no encontrado: {path}")
+
+        set_process_state(process_id, status="reading_files", progress=10)
+        with phase_timer(phases, "detect_columns"):
+            headers1 = read_excel_headers(file1_path, sources)
+            headers2 = read_excel_headers(file2_path, sources)
+            col_prof1, col_serv1, col_user1 = detect_columns(headers1, "CRYSTAL")
+            col_prof2, col_serv2, col_user2 = detect_columns(headers2, "QUERY")
+
+        if not col_prof1:
+            return {
+                "error": "❌ No se pudo detectar la columna de profesional en el archivo CRYSTAL",
+                "details": {"crystal_columns": headers1, "query_columns": headers2}
+            }
+
+        column_mapping = {
+            "crystal": {"profesional": str(col_prof1), "servicio": str(col_serv1), "usuario": str(col_user1)},
+            "query": {"profesional": str(col_prof2), "servicio": str(col_serv2), "usuario": str(col_user2)}
+        }
+
+        conn, db_path = out_of_core_connect(process_id)
+        with phase_timer(phases, "read_crystal"):
+            loaded1 = load_sheet_into_sqlite(conn, "crystal", file1_path, (col_prof1, col_serv1, col_user1),
+                                             process_id, (10, 30), sources.pop(file1_path, None))
+        if loaded1 is None:
+            return {"error": "Proceso cancelado por el usuario"}
+        with phase_timer(phases, "read_query"):
+            loaded2 = load_sheet_into_sqlite(conn, "query", file2_path, (col_prof2, col_serv2, col_user2),
+                                             process_id, (30, 40), sources.pop(file2_path, None))
+        if loaded2 is None:
+            return {"error": "Proceso cancelado por el usuario"}
+        headers1, types1, rows1 = loaded1
+        headers2, types2, rows2 = loaded2
+        has_serv1, has_user1 = col_serv1 in headers1, col_user1 in headers1
+        has_serv2, has_user2 = col_serv2 in headers2, col_user2 in headers2
+
+        set_process_state(process_id, status="processing_professionals", progress=40)
+
+        # Índices: bloque contiguo por profesional y usuarios únicos de cada lado
+        with phase_timer(phases, "index"):
+            conn.executescript("""
+                CREATE INDEX crystal_prof ON crystal (k_prof, row);
+                CREATE TABLE crystal_users (k_user TEXT PRIMARY KEY) WITHOUT ROWID;
+                CREATE TABLE query_users (k_user TEXT PRIMARY KEY) WITHOUT ROWID;
+            """)
+            if has_user1:
+                conn.execute("INSERT OR IGNORE INTO crystal_users SELECT k_user FROM crystal")
+            if has_user2:
+                conn.execute("INSERT OR IGNORE INTO query_users SELECT k_user FROM query")
+            conn.commit()
+
+        with phase_timer(phases, "aggregation"):
+            professionals = sorted(row[0] for row in conn.execute("SELECT DISTINCT k_prof FROM crystal"))
+            usuarios_crystal = sorted(row[0] for row in conn.execute("SELECT k_user FROM crystal_users"))
+            usuarios_query = sorted(row[0] for row in conn.execute("SELECT k_user FROM query_users"))
+
+            def service_counts(table, group=""):
+                """
+                Conteos por servicio (y por group si se indica) con el orden de
+                value_counts en memoria: de más a menos filas y, en empates, por
+                primera aparición del servicio en la tabla, con los vacíos al final
+                """
+                rank = {service: (service == "", first) for service, first in conn.execute(
+                    f"SELECT k_serv, MIN(row) FROM {table} GROUP BY k_serv")}
+                rows = conn.execute(f"SELECT {group}{', ' if group else ''}k_serv, COUNT(*) FROM {table} "
+                                    f"GROUP BY {group}{', ' if group else ''}k_serv").fetchall()
+                return sorted(rows, key=lambda row: (-row[-1], rank[row[-2]]))
+
+            totals = {
+                "total_services_crystal": rows1,
+                "total_services_query": rows2,
+                "num_professionals": len(professionals),
+                "num_users_crystal": len(usuarios_crystal),
+                "num_users_query": len(usuarios_query),
+                "servicios_por_categoria_crystal": dict(service_counts("crystal")) if has_serv1 else {},
+                "servicios_por_categoria_query": dict(service_counts("query")) if has_serv2 else {},
+            }
+
+            # Totales por profesional con consultas agrupadas
+            stats = {prof: {"servicios_por_categoria": {}, "total_usuarios": 0, "total_servicios": total}
+                     for prof, total in conn.execute("SELECT k_prof, COUNT(*) FROM crystal GROUP BY k_prof")}
+            if has_user1:
+                for prof, users in conn.execute("SELECT k_prof, COUNT(DISTINCT k_user) FROM crystal GROUP BY k_prof"):
+                    stats[prof]["total_usuarios"] = users
+            if has_serv1:
+                for prof, service, count in service_counts("crystal", group="k_prof"):
+                    stats[prof]["servicios_por_categoria"][service] = count
+
+        # VALIDACIÓN CRUZADA EN SQL: filas Query cuyo usuario está en Crystal
+        in_crystal_sql = "EXISTS (SELECT 1 FROM crystal_users u WHERE u.k_user = query.k_user)"
+        in_query_sql = "EXISTS (SELECT 1 FROM query_users u WHERE u.k_user = crystal.k_user)"
+        with phase_timer(phases, "validation"):
+            usuarios_en_crystal = conn.execute(f"SELECT COALESCE(SUM({in_crystal_sql}), 0) FROM query").fetchone()[0]
+        query_totals = {
+            "total_usuarios": rows2,
+            "usuarios_en_crystal": usuarios_en_crystal,
+            "usuarios_solo_query": rows2 - usuarios_en_crystal
+        }
+
+        professional_data = {}
+        user_data = {}
+        columns1 = ", ".join([f"c{i}" for i in range(len(headers1))] + [in_query_sql])
+        columns2 = ", ".join([f"c{i}" for i in range(len(headers2))] + [in_crystal_sql])
+
+        workbook = report_format == "workbook"
+        titles = iter(sheet_titles(["Validación Query"] * has_user2 + professionals)) if workbook else None
+        sheets = []
+
+        def query_rows():
+            return report_rows(conn.execute(f"SELECT {columns2} FROM query ORDER BY row"), types2)
+
+        def professional_rows(prof):
+            return report_rows(conn.execute(
+                f"SELECT {columns1} FROM crystal WHERE k_prof = ? ORDER BY row", (prof,)), types1)
+
+        def write_entry(base_name, headers, rows, value_types, label):
+            """
+            Escribe un reporte (rows da las filas al llamarla) y devuelve su
+            enlace. En workbook solo reserva su hoja del libro único.
+            """
+            if workbook:
+                sheet = next(titles)
+                sheets.append((sheet, headers, rows))
+                return {"download_link": artifact_link(process_id, WORKBOOK_FILE_NAME),
+                        "nombre_archivo": WORKBOOK_FILE_NAME, "hoja": sheet}
+            file_name = report_file_name(base_name, report_format)
+            logger.info(f"💾 Generando reporte para {label}: {file_name}")
+            write_rows_report(headers, rows(), os.path.join(output_dir, file_name), report_format, value_types)
+            return {"download_link": artifact_link(process_id, file_name), "nombre_archivo": file_name}
+
+        with phase_timer(phases, "write_reports"):
+            if not summary:
+                create_job_dir(output_dir)
+            if has_user2:
+                entry = dict(query_totals)
+                if not summary:
+                    entry = {**write_entry("Validación Usuarios Query", headers2 + ['Usuario en Crystal'],
+                                           query_rows, types2 + [{str}], "validación Query"), **query_totals}
+                user_data["query_validation"] = entry
+
+            # Un reporte por profesional, leyendo su bloque con el índice
+            for index, prof in enumerate(professionals):
+                if job_cancelled(process_id):
+                    return {"error": "Proceso cancelado por el usuario"}
+                entry = stats[prof]
+                if not summary:
+                    if not workbook:
+                        set_process_state(process_id, status=f"Procesando {prof}",
+                                          progress=40 + (index / max(len(professionals), 1)) * 55)
+                    entry = {**entry, **write_entry(format_filename(prof), headers1 + ['Validación Query'],
+                                                    lambda prof=prof: professional_rows(prof),
+                                                    types1 + [{str}], prof)}
+                professional_data[prof] = entry
+
+            if sheets:
+                cancelled = []
+
+                def workbook_sheets():
+                    for index, (sheet, headers, rows) in enumerate(sheets):
+                        if job_cancelled(process_id):
+                            cancelled.append(sheet)
+                            return
+                        set_process_state(process_id, status=f"Procesando {sheet}",
+                                          progress=40 + (index / len(sheets)) * 55)
+                        yield sheet, headers, rows()
+
+                logger.info(f"💾 Generando libro único: {WORKBOOK_FILE_NAME} ({len(sheets)} hojas)")
+                write_workbook(workbook_sheets(), os.path.join(output_dir, WORKBOOK_FILE_NAME))
+                if cancelled:
+                    return {"error": "Proceso cancelado por el usuario"}
+
+        set_process_state(process_id, status="completed", progress=100)
+        logger.info("✅ Procesamiento fuera de memoria completo")
+
+        result_data = {
+            "totals": totals,
+            "professionals": professionals,
+            "usuarios_crystal": usuarios_crystal,
+            "usuarios_query": usuarios_query,
+            "professional_data": professional_data,
+            "user_data": user_data,
+            "column_mapping": column_mapping,
+            "cache": {"parsed_inputs": {"hits": 0, "misses": 0}, "result": "bypass"},
+            "engine": "sqlite",
+            "process_id": process_id
+        }
+        if summary:
+            result_data["summary_only"] = True
+
+        with phase_timer(phases, "serialize"):
+            result = safe_serialize(result_data)
+        rows = {"crystal": rows1, "query": rows2}
+        if summary:
+            result["metrics"] = build_job_metrics(started, phases, rows, 0)
+            return result
+
+        artifacts = [os.path.join(output_dir, entry["nombre_archivo"])
+                     for entry in list(professional_data.values()) + list(user_data.values())]
+        output = report_output_metrics(report_format, artifacts, phases, rows1 + rows2)
+        result["metrics"] = build_job_metrics(started, phases, rows, len(set(artifacts)), output)
+        sweep_artifacts()
+        return result
+
+    except Exception as e:
+        logger.exception(f"❌ Error en procesamiento fuera de memoria: {e}")
+        return {"error": f"Error en procesamiento: {str(e)}"}
+    finally:
+        close_excel_inputs(sources)
+        if conn is not None:
+            conn.close()
+        if db_path:
+            try:
+                os.remove(db_path)
+            except OSError:
+                pass
+
+# ========================================================
+# MODO INCREMENTAL (ÍNDICE SQLITE POR SERIE)
+# ========================================================
+
+# Índice persistente y datos por profesional de cada serie (p. ej. el mes)
+INCREMENTAL_DIR = os.environ.get('INCREMENTAL_DIR', os.path.join(DATA_DIR, "indice_incremental"))
+INCREMENTAL_DB = os.path.join(INCREMENTAL_DIR, "indice.sqlite3")
+# Series sin cargas nuevas por más de estos días se eliminan
+INCREMENTAL_TTL_DAYS = int(os.environ.get('INCREMENTAL_TTL_DAYS', 45))
+
+INCREMENTAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    name TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    crystal_rows INTEGER NOT NULL,
+    crystal_hash TEXT,
+    query_rows INTEGER NOT NULL,
+    query_hash TEXT,
+    query_entry TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    series TEXT NOT NULL,
+    source TEXT NOT NULL,
+    user TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    PRIMARY KEY (series, source, user)
+);
+CREATE TABLE IF NOT EXISTS services (
+    series TEXT NOT NULL,
+    source TEXT NOT NULL,
+    service TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    first_row INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (series, source, service)
+);
+CREATE TABLE IF NOT EXISTS user_professionals (
+    series TEXT NOT NULL,
+    user TEXT NOT NULL,
+    professional TEXT NOT NULL,
+    PRIMARY KEY (series, user, professional)
+);
+CREATE TABLE IF NOT EXISTS professionals (
+    series TEXT NOT NULL,
+    professional TEXT NOT NULL,
+    total_servicios INTEGER NOT NULL,
+    total_usuarios INTEGER NOT NULL,
+    servicios_por_categoria TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    data_file TEXT NOT NULL,
+    PRIMARY KEY (series, professional)
+);
+"""
+
+series_locks = {}
+series_locks_lock = threading.Lock()
+
+def incremental_connect():
+    private_dir(INCREMENTAL_DIR)
+    conn = sqlite3.connect(INCREMENTAL_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(INCREMENTAL_SCHEMA)
+    if "first_row" not in {row["name"] for row in conn.execute("PRAGMA table_info(services)")}:
+        # Índice anterior sin la primera aparición de cada servicio: las
+        # series se reconstruyen en su próxima carga
+        try:
+            with conn:
+                conn.execute("ALTER TABLE services ADD COLUMN first_row INTEGER NOT NULL DEFAULT 0")
+                conn.execute("UPDATE series SET crystal_hash = NULL")
+        except sqlite3.OperationalError:
+            pass  # Otro worker ya la agregó
+    return conn
+
+def series_lock(series):
+    """Un solo trabajo a la vez por serie"""
+    with series_locks_lock:
+        return series_locks.setdefault(series, threading.Lock())
+
+def series_dir(series):
+    slug = re.sub(r'[^A-Za-z0-9_-]', '_', series)[:40]
+    return os.path.join(INCREMENTAL_DIR, f"{slug}-{hashlib.sha1(series.encode()).hexdigest()[:8]}")
+
+def index_keys(df, col):
+    """
+    Claves de índice de una columna (key_text, una llamada por valor
+    distinto), o None si no existe. Son estables entre cargas: un delta sin
+    vacíos da las mismas claves que uno con vacíos.
+    """
+    if col not in df.columns:
+        return None
+    codes, uniques = pd.factorize(df[col], use_na_sentinel=True)
+    keys = np.array([key_text(value) for value in uniques] + [""], dtype=object)
+    return keys[codes]
+
+def load_index_keys(conn, table, column, series, source):
+    return {row[0] for row in conn.execute(
+        f"SELECT {column} FROM {table} WHERE series = ? AND source = ?", (series, source))}
+
+def add_index_counts(conn, table, column, series, source, keys, offset=None):
+    """
+    Suma las filas del delta a los contadores por clave. Con offset (filas de
+    las cargas anteriores) guarda también la fila de primera aparición de las
+    claves nuevas, para desempatar como los demás motores (ordered_counts).
+    """
+    if keys is None or not len(keys):
+        return
+    counts = pd.Series(keys).value_counts()
+    if offset is None:
+        conn.executemany(
+            f"INSERT INTO {table} (series, source, {column}, rows) VALUES (?, ?, ?, ?) "
+            f"ON CONFLICT (series, source, {column}) DO UPDATE SET rows = rows + excluded.rows",
+            [(series, source, key, int(count)) for key, count in counts.items()]
+        )
+        return
+    firsts = pd.Series(keys).drop_duplicates()
+    first_rows = dict(zip(firsts.to_numpy(), firsts.index + offset))
+    conn.executemany(
+        f"INSERT INTO {table} (series, source, {column}, rows, first_row) VALUES (?, ?, ?, ?, ?) "
+        f"ON CONFLICT (series, source, {column}) DO UPDATE SET rows = rows + excluded.rows",
+        [(series, source, key, int(count), int(first_rows[key])) for key, count in counts.items()]
+    )
+
+def professionals_with_users(conn, series, users):
+    """Profesionales con atenciones de alguno de estos usuarios de Crystal"""
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_users (user TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM lookup_users")
+    conn.executemany("INSERT OR IGNORE INTO lookup_users (user) VALUES (?)", [(user,) for user in users])
+    return {row[0] for row in conn.execute(
+        "SELECT DISTINCT up.professional FROM user_professionals up "
+        "JOIN lookup_users l ON l.user = up.user WHERE up.series = ?", (series,))}
+
+def load_series(conn, series, fingerprint):
+    """
+    Estado de la última carga, o None si hay que reconstruir: serie nueva,
+    otros encabezados/columnas, carga anterior interrumpida o datos borrados
+    """
+    row = conn.execute("SELECT * FROM series WHERE name = ?", (series,)).fetchone()
+    if row is None or row["fingerprint"] != fingerprint or row["crystal_hash"] is None:
+        return None
+    data_files = [r[0] for r in conn.execute("SELECT data_file FROM professionals WHERE series = ?", (series,))]
+    if row["query_entry"]:
+        data_files.append("query.pkl")
+    base = series_dir(series)
+    if not all(os.path.isfile(os.path.join(base, "data", name)) for name in data_files):
+        return None
+    return dict(row)
+
+def reset_series(conn, series):
+    """Borra índice, datos y reportes de la serie (la próxima carga la reconstruye)"""
+    with conn:
+        for table in ("users", "services", "user_professionals", "professionals"):
+            conn.execute(f"DELETE FROM {table} WHERE series = ?", (series,))
+        conn.execute("DELETE FROM series WHERE name = ?", (series,))
+    shutil.rmtree(series_dir(series), ignore_errors=True)
+
+def prune_series(conn, current):
+    """
+    Elimina las series sin cargas nuevas en INCREMENTAL_TTL_DAYS. Las que
+    están en uso (incluida la actual) se dejan para otra vuelta.
+    """
+    limit = time.time() - INCREMENTAL_TTL_DAYS * 86400
+    expired = [row[0] for row in conn.execute("SELECT name FROM series WHERE updated_at < ?", (limit,))]
+    for name in expired:
+        lock = series_lock(name)
+        if name == current or not lock.acquire(blocking=False):
+            continue
+        try:
+            reset_series(conn, name)
+        finally:
+            lock.release()
+        logger.info(f"🧹 Serie incremental expirada: {name}")
+
+def append_series_data(path, delta):
+    """Agrega las filas nuevas a los datos guardados y devuelve el total"""
+    parts = [read_private_pickle(path)] if os.path.isfile(path) else []
+    if delta is not None and len(delta):
+        parts.append(delta)
+    df = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0].reset_index(drop=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    df.to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+    return df
+
+def link_report(source, target):
+    """Expone un reporte de la serie en el directorio del proceso sin copiarlo"""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+def process_incremental(file1_path, file2_path, process_id, series):
+    """
+    Modo incremental: los archivos de cada día suelen ser los del día anterior
+    más filas nuevas. Solo se cargan y validan las filas nuevas de la serie y
+    solo se regeneran los profesionales con filas nuevas o con usuarios que
+    recién aparecen en Query. Si los archivos no extienden la carga anterior
+    (otros encabezados o filas ya vistas modificadas) se reconstruye la serie.
+    """
+    load_heavy_modules()
+    sources = {}
+    try:
+        if job_cancelled(process_id):
+            return {"error": "Proceso cancelado por el usuario"}
+
+        started = time.perf_counter()
+        phases = {}
+        output_dir = job_artifact_dir(process_id)
+        logger.info(f"🧩 Iniciando procesamiento incremental de la serie '{series}'...")
+        set_process_state(process_id, status="reading_files", progress=10)
+
+        with phase_timer(phases, "detect_columns"):
+            headers1 = read_excel_headers(file1_path, sources)
+            headers2 = read_excel_headers(file2_path, sources)
+            col_prof1, col_serv1, col_user1 = detect_columns(headers1, "CRYSTAL")
+            col_prof2, col_serv2, col_user2 = detect_columns(headers2, "QUERY")
+
+        if not col_prof1:
+            return {
+                "error": "❌ No se pudo detectar la columna de profesional en el archivo CRYSTAL",
+                "details": {"crystal_columns": headers1, "query_columns": headers2}
+            }
+
+        column_mapping = {
+            "crystal": {"profesional": str(col_prof1), "servicio": str(col_serv1), "usuario": str(col_user1)},
+            "query": {"profesional": str(col_prof2), "servicio": str(col_serv2), "usuario": str(col_user2)}
+        }
+        fingerprint = json.dumps({"crystal": headers1, "query": headers2, "columns": column_mapping}, ensure_ascii=False)
+        has_query_report = col_user2 in headers2
+
+        with series_lock(series):
+            conn = incremental_connect()
+            try:
+                prune_series(conn, series)
+                state = load_series(conn, series, fingerprint)
+
+                # Leer solo las filas posteriores a la carga anterior; si lo ya
+                # visto cambió, releer todo y reconstruir
+                while True:
+                    digest1, digest2 = {}, {}
+                    with phase_timer(phases, "read_crystal"):
+                        delta1 = read_large_excel(file1_path, process_id, progress_range=(10, 20),
+                                                  skip_rows=state["crystal_rows"] if state else 0, digest=digest1,
+                                                  source=sources.pop(file1_path, None))
+                    if delta1 is None:
+                        return {"error": "Proceso cancelado por el usuario"}
+                    with phase_timer(phases, "read_query"):
+                        delta2 = read_large_excel(file2_path, process_id, progress_range=(20, 30),
+                                                  skip_rows=state["query_rows"] if state else 0, digest=digest2,
+                                                  source=sources.pop(file2_path, None))
+                    if delta2 is None:
+                        return {"error": "Proceso cancelado por el usuario"}
+                    if state is None or (digest1["prefix"] == state["crystal_hash"] and digest2["prefix"] == state["query_hash"]):
+                        break
+                    logger.info("🔁 Los archivos no extienden la carga anterior: se reconstruye la serie")
+                    state = None
+
+                if job_cancelled(process_id):
+                    return {"error": "Proceso cancelado por el usuario"}
+
+                mode = "delta" if state else "rebuild"
+                if state is None:
+                    reset_series(conn, series)
+                else:
+                    # Marca de carga en curso: si se interrumpe, la próxima reconstruye
+                    with conn:
+                        conn.execute("UPDATE series SET crystal_hash = NULL WHERE name = ?", (series,))
+
+                base_dir = series_dir(series)
+                data_dir = os.path.join(base_dir, "data")
+                reports_dir = os.path.join(base_dir, "reportes")
+                os.makedirs(data_dir, exist_ok=True)
+                os.makedirs(reports_dir, exist_ok=True)
+                rows = {"crystal": int(len(delta1)), "query": int(len(delta2))}
+                logger.info(f"📈 Filas nuevas - Crystal: {rows['crystal']}, Query: {rows['query']} ({mode})")
+                set_process_state(process_id, status="updating_index", progress=30)
+
+                with phase_timer(phases, "index_update"):
+                    prof_keys = index_keys(delta1, col_prof1)
+                    user_keys1 = index_keys(delta1, col_user1)
+                    user_keys2 = index_keys(delta2, col_user2)
+
+                    crystal_users = load_index_keys(conn, "users", "user", series, "crystal")
+                    query_users = load_index_keys(conn, "users", "user", series, "query")
+                    new_crystal_users = set(user_keys1) - crystal_users if user_keys1 is not None else set()
+                    new_query_users = set(user_keys2) - query_users if user_keys2 is not None else set()
+                    crystal_users |= new_crystal_users
+                    query_users |= new_query_users
+
+                    with conn:
+                        add_index_counts(conn, "users", "user", series, "crystal", user_keys1)
+                        add_index_counts(conn, "users", "user", series, "query", user_keys2)
+                        add_index_counts(conn, "services", "service", series, "crystal", index_keys(delta1, col_serv1),
+                                         offset=state["crystal_rows"] if state else 0)
+                        add_index_counts(conn, "services", "service", series, "query", index_keys(delta2, col_serv2),
+                                         offset=state["query_rows"] if state else 0)
+                        if user_keys1 is not None:
+                            conn.executemany(
+                                "INSERT OR IGNORE INTO user_professionals (series, user, professional) VALUES (?, ?, ?)",
+                                [(series, user, prof) for user, prof in set(zip(user_keys1, prof_keys))]
+                            )
+
+                    known = {row["professional"]: dict(row) for row in conn.execute(
+                        "SELECT * FROM professionals WHERE series = ?", (series,))}
+
+                    # Profesionales a regenerar: con filas nuevas, con usuarios que
+                    # recién aparecen en Query o cuyo reporte ya no está
+                    changed = set(prof_keys)
+                    if new_query_users:
+                        changed |= professionals_with_users(conn, series, new_query_users)
+                    changed |= {prof for prof, row in known.items()
+                                if not os.path.isfile(os.path.join(reports_dir, row["file_name"]))}
+
+                    query_entry = json.loads(state["query_entry"]) if state and state["query_entry"] else None
+                    query_changed = has_query_report and (
+                        query_entry is None or len(delta2) > 0 or bool(new_crystal_users)
+                        or not os.path.isfile(os.path.join(reports_dir, query_entry["nombre_archivo"])))
+
+                # Datos completos solo de lo que cambia; el resto se reutiliza
+                delta_groups = dict(iter(delta1.groupby(prof_keys, sort=False))) if len(delta1) else {}
+                del delta1
+
+                tasks = []
+                if query_changed:
+                    df2 = append_series_data(os.path.join(data_dir, "query.pkl"), delta2)
+                    query_user_keys = index_keys(df2, col_user2)
+                    in_crystal = pd.Series(query_user_keys).isin(crystal_users).to_numpy()
+                    tasks.append(("validación Query", build_query_validation_entry,
+                                  (df2, in_crystal, reports_dir, process_id)))
+                del delta2
+
+                task_professionals = sorted(changed)
+                data_files = {}
+                for prof in task_professionals:
+                    data_files[prof] = known[prof]["data_file"] if prof in known else \
+                        f"{hashlib.sha1(prof.encode()).hexdigest()[:16]}.pkl"
+                    df_prof = append_series_data(os.path.join(data_dir, data_files[prof]), delta_groups.pop(prof, None))
+                    in_query = pd.Series(index_keys(df_prof, col_user1)).isin(query_users).to_numpy() \
+                        if col_user1 in df_prof.columns else np.zeros(len(df_prof), dtype=bool)
+                    encode_key_columns(df_prof, (col_prof1, col_serv1, col_user1))
+                    df_prof['Validación Query'] = yes_no_column(in_query, df_prof.index)
+                    tasks.append((prof, build_professional_entry,
+                                  (prof, df_prof, col_serv1, col_user1, reports_dir, process_id)))
+
+                # Los reportes anteriores pueden estar enlazados desde procesos
+                # previos: se reemplazan por archivos nuevos, no se sobrescriben
+                for prof in task_professionals:
+                    if prof in known:
+                        try:
+                            os.remove(os.path.join(reports_dir, known[prof]["file_name"]))
+                        except OSError:
+                            pass
+                if query_changed and query_entry:
+                    try:
+                        os.remove(os.path.join(reports_dir, query_entry["nombre_archivo"]))
+                    except OSError:
+                        pass
+
+                with phase_timer(phases, "write_reports"):
+                    # Aquí ya se modificaron los datos de la serie: no se cancela a medias
+                    results = run_report_tasks(process_id, tasks, 35, 90)
+                if results is None:
+                    reset_series(conn, series)
+                    return {"error": "Proceso cancelado por el usuario"}
+                del tasks
+                files_written = len(results)
+
+                if query_changed:
+                    query_entry = results.pop(0)
+                    query_entry.pop("download_link", None)
+
+                # Empates por primera aparición en toda la serie, no solo en el profesional
+                service_rows = {row[0]: row[1] for row in conn.execute(
+                    "SELECT service, first_row FROM services WHERE series = ? AND source = 'crystal'", (series,))}
+                for entry in results:
+                    entry["servicios_por_categoria"] = ordered_counts(
+                        (service, count, service_rows.get(service, 0))
+                        for service, count in entry["servicios_por_categoria"].items())
+
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO professionals (series, professional, total_servicios, total_usuarios, "
+                        "servicios_por_categoria, file_name, data_file) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(series, prof, entry["total_servicios"], entry["total_usuarios"],
+                          json.dumps(entry["servicios_por_categoria"], ensure_ascii=False),
+                          entry["nombre_archivo"], data_files[prof])
+                         for prof, entry in zip(task_professionals, results)]
+                    )
+                    conn.execute(
+                        "INSERT OR REPLACE INTO series (name, fingerprint, crystal_rows, crystal_hash, query_rows, "
+                        "query_hash, query_entry, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (series, fingerprint, digest1["rows"], digest1["full"], digest2["rows"], digest2["full"],
+                         json.dumps(query_entry, ensure_ascii=False) if query_entry else None, time.time())
+                    )
+
+                # Resultado completo desde el índice
+                with phase_timer(phases, "serialize"):
+                    professional_data = {}
+                    for row in conn.execute("SELECT * FROM professionals WHERE series = ? ORDER BY professional", (series,)):
+                        professional_data[row["professional"]] = {
+                            "servicios_por_categoria": json.loads(row["servicios_por_categoria"]),
+                            "total_usuarios": row["total_usuarios"],
+                            "total_servicios": row["total_servicios"],
+                            "download_link": artifact_link(process_id, row["file_name"]),
+                            "nombre_archivo": row["file_name"]
+                        }
+                    user_data = {}
+                    if query_entry:
+                        user_data["query_validation"] = dict(query_entry, download_link=artifact_link(process_id, query_entry["nombre_archivo"]))
+
+                    def service_counts(source):
+                        return ordered_counts(tuple(row) for row in conn.execute(
+                            "SELECT service, rows, first_row FROM services WHERE series = ? AND source = ?",
+                            (series, source)))
+
+                    professionals = list(professional_data)
+                    result = {
+                        "totals": {
+                            "total_services_crystal": digest1["rows"],
+                            "total_services_query": digest2["rows"],
+                            "num_professionals": len(professionals),
+                            "num_users_crystal": len(crystal_users),
+                            "num_users_query": len(query_users),
+                            "servicios_por_categoria_crystal": service_counts("crystal"),
+                            "servicios_por_categoria_query": service_counts("query"),
+                        },
+                        "professionals": professionals,
+                        "usuarios_crystal": sorted(crystal_users),
+                        "usuarios_query": sorted(query_users),
+                        "professional_data": professional_data,
+                        "user_data": user_data,
+                        "column_mapping": column_mapping,
+                        "incremental": {
+                            "series": series,
+                            "mode": mode,
+                            "new_rows": rows,
+                            "regenerated_professionals": len(task_professionals),
+                            "reused_professionals": len(professionals) - len(task_professionals),
+                            "query_report": "regenerated" if query_changed else "reused",
+                        },
+                        "process_id": process_id
+                    }
+
+                # Enlazar los reportes vigentes de la serie en el directorio del proceso
+                create_job_dir(output_dir)
+                for entry in list(professional_data.values()) + list(user_data.values()):
+                    link_report(os.path.join(reports_dir, entry["nombre_archivo"]),
+                                os.path.join(output_dir, entry["nombre_archivo"]))
+            except Exception:
+                # Índice posiblemente a medio actualizar: reconstruir en la próxima carga
+                reset_series(conn, series)
+                raise
+            finally:
+                conn.close()
+
+        set_process_state(process_id, status="completed", progress=100)
+        result["metrics"] = build_job_metrics(started, phases, rows, files_written)
+        sweep_artifacts()
+        logger.info(f"✅ Serie '{series}' actualizada: {len(task_professionals)} profesionales regenerados")
+        return result
+
+    except Exception as e:
+        logger.exception(f"❌ Error en procesamiento incremental: {e}")
+        return {"error": f"Error en procesamiento: {str(e)}"}
+    finally:
+        close_excel_inputs(sources)
+
+# ========================================================
+# COLA DE TRABAJOS EN SEGUNDO PLANO
+# ========================================================
+
+def remove_temp_files(*paths):
+    """Elimina archivos temporales de entrada (rutas o listas de rutas) sin interrumpir el flujo"""
+    for path in [p for group in paths for p in as_path_list(group)]:
+        try:
+            if path and os.path.exists(path):
+                os.remove(path)
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudieron eliminar archivos temporales: {e}")
+
+def run_job(process_id, file1_path, file2_path, use_cache=True, lazy=False, series=None, source_names=None,
+            summary=False, engine="memory", report_format="xlsx"):
+    """
+    Ejecuta process_excel (process_incremental si hay serie, o
+    process_out_of_core con el motor sqlite) en un hilo del pool y guarda el
+    resultado final. En modo resumen los archivos se conservan para generar
+    los reportes después (/jobs/<id>/reports).
+    """
+    with log_context(process_id):
+        started = time.perf_counter()
+        set_process_state(process_id, status="starting", progress=0)
+        keep_inputs = False
+        try:
+            if series:
+                data = process_incremental(file1_path, file2_path, process_id, series)
+            elif engine == "sqlite":
+                data = process_out_of_core(file1_path, file2_path, process_id, summary, report_format)
+            else:
+                data = process_excel(file1_path, file2_path, process_id, use_cache, lazy, source_names, summary,
+                                     report_format)
+            keep_inputs = summary and isinstance(data, dict) and not data.get("error")
+        finally:
+            if not keep_inputs:
+                remove_temp_files(file1_path, file2_path)
+
+        with process_lock:
+            # Si ya no está activo, fue cancelado mientras corría o estaba en cola
+            cancelled = active_processes.pop(process_id, None) is None
+            if cancelled:
+                status = "cancelled"
+                data = {"error": "Proceso cancelado por el usuario"}
+            elif isinstance(data, dict) and data.get("error"):
+                status = "error"
+            else:
+                status = "completed"
+            job_results[process_id] = {"status": status, "result": data, "finished_at": time.time()}
+            if keep_inputs and status == "completed":
+                job_results[process_id]["inputs"] = {"file1": file1_path, "file2": file2_path,
+                                                     "source_names": source_names, "engine": engine,
+                                                     "report_format": report_format}
+        if keep_inputs and status != "completed":
+            remove_temp_files(file1_path, file2_path)
+        store_job_result(process_id, job_results[process_id])
+
+        if status != "completed":
+            # Reportes parciales de un proceso cancelado o fallido
+            remove_job_dir(job_artifact_dir(process_id))
+        else:
+            # Índice de búsqueda listo antes de la primera consulta a /jobs
+            get_job_index(process_id)
+
+        record_job_metrics(status, time.perf_counter() - started, data)
+        logger.info(f"🏁 Proceso {process_id} finalizado con estado: {status}", extra={"status": status})
+
+    # La memoria de este trabajo quedó libre
+    dispatch_waiting_jobs()
+
+def prune_finished_jobs():
+    """Elimina resultados de trabajos terminados hace más de JOB_RESULT_TTL segundos"""
+    limit = time.time() - JOB_RESULT_TTL
+    with process_lock:
+        expired = [pid for pid, job in job_results.items() if job["finished_at"] < limit]
+        # Archivos de trabajos de resumen cuyos reportes nunca se pidieron
+        inputs = [job_results.pop(pid).get("inputs") for pid in expired]
+    for entry in filter(None, inputs):
+        remove_temp_files(entry["file1"], entry["file2"])
+    prune_job_store(limit)
+
+# ========================================================
+# CONTROL DE ADMISIÓN POR MEMORIA
+# ========================================================
+
+# Memoria que pueden comprometer entre todos los trabajos admitidos
+# (por defecto el 70% del límite del contenedor, o de la RAM si no tiene)
+MEMORY_BUDGET_MB = int(os.environ.get('MEMORY_BUDGET_MB', total_memory_mb() * 0.7))
+# Memoria del sistema que se deja libre al admitir un trabajo nuevo
+MEMORY_RESERVE_MB = int(os.environ.get('MEMORY_RESERVE_MB', 64))
+# Trabajos que pueden esperar memoria; más allá se responde 429
+MAX_WAITING_JOBS = int(os.environ.get('MAX_WAITING_JOBS', 4))
+# Pico medido con 300k filas: ~130 bytes por celda entre lectura, columnas y reportes
+BYTES_PER_CELL = int(os.environ.get('BYTES_PER_CELL', 150))
+JOB_BASE_MEMORY_MB = 50
+# Cada proceso del pool de reportes (pandas y openpyxl importados): ~90 MB de
+# RSS medidos. Se reservan una vez del presupuesto, no por trabajo.
+REPORT_WORKER_MEMORY_MB = int(os.environ.get('REPORT_WORKER_MEMORY_MB', 90))
+# Particiones en vuelo hacia el pool: la copia serializada en el padre más la
+# cargada en el trabajador (~11 y ~43 bytes por celda). Entre todas no pasan
+# de una copia de los datos, así que se cuenta una por trabajo.
+REPORT_COPY_BYTES_PER_CELL = 55
+# Si la hoja no declara su dimensión: celdas aproximadas por byte del .xlsx
+XLSX_BYTES_PER_CELL = 7
+DEFAULT_RETRY_AFTER = 30  # segundos
+
+# Trabajos esperando memoria, en orden de llegada: [(process_id, args_de_run_job), ...]
+waiting_jobs = []
+
+# Espacios de nombres del paquete .xlsx y dimensión declarada ("A1:F60001")
+XLSX_REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+DIMENSION_REF = re.compile(r'^\$?([A-Z]{1,3})\$?(\d+)(?::\$?([A-Z]{1,3})\$?(\d+))?$')
+# Elementos a recorrer como máximo buscando <dimension> antes de <sheetData>
+SNIFF_MAX_ELEMENTS = 500
+
+def xml_local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def first_xml_element(stream, name, stop=None, **attributes):
+    """
+    Primer elemento <name> con esos atributos, o None si antes aparece <stop>
+    o ya se recorrieron SNIFF_MAX_ELEMENTS elementos
+    """
+    for count, (_, elem) in enumerate(ET.iterparse(stream, events=("start",))):
+        tag = xml_local_name(elem.tag)
+        if tag == name and all(elem.get(key) == value for key, value in attributes.items()):
+            return elem
+        if tag == stop or count >= SNIFF_MAX_ELEMENTS:
+            return None
+    return None
+
+def first_sheet_member(archive):
+    """Ruta dentro del .xlsx de la primera hoja del libro"""
+    with archive.open("xl/workbook.xml") as f:
+        sheet = first_xml_element(f, "sheet")
+    rel_id = sheet.get(f"{{{XLSX_REL_NS}}}id") if sheet is not None else None
+    if rel_id is None:
+        return None
+    with archive.open("xl/_rels/workbook.xml.rels") as f:
+        rel = first_xml_element(f, "Relationship", Id=rel_id)
+    target = rel.get("Target") if rel is not None else None
+    if not target:
+        return None
+    return target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+
+def column_number(letters):
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - 64
+    return number
+
+def sniff_dimensions(path):
+    """
+    (filas, columnas) según la dimensión declarada en la primera hoja, o None.
+    Solo abre el .xlsx como zip y lee el comienzo del XML de la hoja: no toca
+    sharedStrings ni los datos, que es justo lo que el control de admisión
+    intenta no gastar antes de decidir.
+    """
+    try:
+        with zipfile.ZipFile(path) as archive:
+            member = first_sheet_member(archive)
+            if member is None:
+                return None
+            with archive.open(member) as f:
+                dimension = first_xml_element(f, "dimension", stop="sheetData")
+    except (OSError, KeyError, zipfile.BadZipFile, ET.ParseError):
+        return None
+    match = DIMENSION_REF.match((dimension.get("ref") or "").upper()) if dimension is not None else None
+    # "A1" sola es lo que escriben algunas herramientas cuando no la calculan
+    if not match or match.group(3) is None:
+        return None
+    rows = int(match.group(4)) - int(match.group(2)) + 1
+    columns = column_number(match.group(3)) - column_number(match.group(1)) + 1
+    if rows <= 0 or columns <= 0:
+        return None
+    return rows, columns
+
+def estimate_job_memory(*paths):
+    """Pico de memoria estimado de un trabajo (MB) a partir de sus archivos (o listas de archivos)"""
+    cells = 0
+    for path in [p for group in paths for p in as_path_list(group)]:
+        dimensions = sniff_dimensions(path)
+        if dimensions:
+            cells += dimensions[0] * dimensions[1]
+        else:
+            cells += os.path.getsize(path) // XLSX_BYTES_PER_CELL
+    bytes_per_cell = BYTES_PER_CELL + (REPORT_COPY_BYTES_PER_CELL if REPORT_WORKERS > 1 else 0)
+    return round(JOB_BASE_MEMORY_MB + cells * bytes_per_cell / MB, 1)
+
+def report_pool_memory_mb():
+    """Memoria de los procesos del pool de reportes (0 si se escribe en el mismo proceso)"""
+    return REPORT_WORKERS * REPORT_WORKER_MEMORY_MB if REPORT_WORKERS > 1 else 0
+
+def jobs_memory_budget_mb():
+    """Presupuesto para los trabajos: MEMORY_BUDGET_MB menos el pool de reportes"""
+    return MEMORY_BUDGET_MB - report_pool_memory_mb()
+
+def committed_memory_mb():
+    """
+    Memoria estimada de los trabajos ya admitidos, incluidos los de otros
+    workers si el estado es compartido (requiere process_lock)
+    """
+    states = list(active_processes.values()) + list(shared_active_jobs().values())
+    return sum(state.get("memory_estimate_mb", 0) for state in states
+               if state.get("status") != "waiting_memory")
+
+def fits_in_memory(estimate_mb):
+    """
+    ¿Se puede admitir ahora? Debe caber en el presupuesto (sin el pool de
+    reportes) junto con los trabajos admitidos y en la memoria libre real (menos la reserva). Sin
+    trabajos propios en curso no hay nada que liberar, así que basta el
+    presupuesto. Requiere process_lock.
+    """
+    committed = committed_memory_mb()
+    if committed + estimate_mb > jobs_memory_budget_mb():
+        return False
+    if committed == 0:
+        return True
+    available = available_memory_mb() - MEMORY_RESERVE_MB
+    if report_executor is None:
+        # El pool arranca con el primer trabajo que lo use
+        available -= report_pool_memory_mb()
+    return estimate_mb <= available
+
+def retry_after_seconds():
+    """Sugerencia para reintentar: duración media de los trabajos terminados"""
+    with metrics_lock:
+        durations = histogram_values["job_duration_seconds"]
+        if not durations["count"]:
+            return DEFAULT_RETRY_AFTER
+        return max(5, int(durations["sum"] / durations["count"]) + 1)
+
+def submit_job(process_id, file1_path, file2_path, use_cache=True, lazy=False, estimate_mb=0, series=None,
+               source_names=None, summary=False, engine="memory", report_format="xlsx"):
+    """
+    Admite el trabajo en el pool si hay memoria, o lo deja esperando en orden
+    de llegada. Devuelve el estado inicial ("queued" o "waiting_memory"), o
+    None si la cola de espera está llena.
+    """
+    prune_finished_jobs()
+    start_artifact_sweeper()
+    args = (process_id, file1_path, file2_path, use_cache, lazy, series, source_names, summary, engine,
+            report_format)
+    with process_lock:
+        if not waiting_jobs and fits_in_memory(estimate_mb):
+            active_processes[process_id] = {"status": "queued", "progress": 0, "memory_estimate_mb": estimate_mb}
+            store_job_state(process_id, active_processes[process_id], force=True)
+            job_executor.submit(run_job, *args)
+            return "queued"
+        if len(waiting_jobs) >= MAX_WAITING_JOBS:
+            return None
+        waiting_jobs.append((process_id, args))
+        active_processes[process_id] = {"status": "waiting_memory", "progress": 0,
+                                        "memory_estimate_mb": estimate_mb, "queue_position": len(waiting_jobs)}
+        store_job_state(process_id, active_processes[process_id], force=True)
+    logger.info(f"⏳ Proceso {process_id} esperando memoria ({estimate_mb} MB estimados)")
+    return "waiting_memory"
+
+def dispatch_waiting_jobs():
+    """
+    Admite trabajos en espera mientras quepan (sin saltarse el orden) y
+    actualiza la posición de los demás. Se llama al terminar o cancelar uno.
+    """
+    cancelled = []
+    if SHARED_JOB_STATE:
+        # Cancelados desde otro worker mientras esperaban
+        with process_lock:
+            waiting = [process_id for process_id, _ in waiting_jobs]
+        remote = {process_id for process_id in waiting if job_cancel_requested(process_id, force=True)}
+    with process_lock:
+        # Cancelados mientras esperaban
+        for entry in list(waiting_jobs):
+            if entry[0] not in active_processes or (SHARED_JOB_STATE and entry[0] in remote):
+                active_processes.pop(entry[0], None)
+                waiting_jobs.remove(entry)
+                cancelled.append(entry)
+                job_results[entry[0]] = {"status": "cancelled", "finished_at": time.time(),
+                                         "result": {"error": "Proceso cancelado por el usuario"}}
+
+        while waiting_jobs:
+            process_id, args = waiting_jobs[0]
+            state = active_processes[process_id]
+            if not fits_in_memory(state["memory_estimate_mb"]):
+                break
+            waiting_jobs.pop(0)
+            state["status"] = "queued"
+            state.pop("queue_position", None)
+            job_executor.submit(run_job, *args)
+
+        for position, (process_id, _) in enumerate(waiting_jobs, 1):
+            active_processes[process_id]["queue_position"] = position
+        states = {process_id: dict(state) for process_id, state in active_processes.items()}
+
+    for process_id, args in cancelled:
+        remove_temp_files(args[1], args[2])
+        store_job_result(process_id, job_results[process_id])
+    # Posiciones y admisiones visibles para los demás workers
+    if SHARED_JOB_STATE:
+        for process_id, state in states.items():
+            if state.get("status") in ("queued", "waiting_memory"):
+                store_job_state(process_id, state, force=True)
+
+# ========================================================
+# RESULTADOS INDEXADOS Y PAGINADOS (/jobs)
+# ========================================================
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+GZIP_MIN_BYTES = 1024
+
+# Listas grandes que no viajan en el resumen: se consultan paginadas en /jobs
+PAGINATED_FIELDS = ("professionals", "usuarios_crystal", "usuarios_query", "professional_data")
+
+def json_response(obj, status=200):
+    """JSON con orjson (si está instalado) y gzip si el cliente lo acepta"""
+    if orjson is not None:
+        body = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    else:
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+    response = Response(body, status=status, mimetype='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    if len(body) >= GZIP_MIN_BYTES and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def search_index(values):
+    """Valores ordenados por su versión en minúsculas, para buscar por prefijo con bisect"""
+    pairs = sorted((str(value).lower(), value) for value in values)
+    return {"keys": [key for key, _ in pairs], "values": [value for _, value in pairs]}
+
+def build_result_index(result):
+    return {
+        "users": {
+            "crystal": search_index(result.get("usuarios_crystal", [])),
+            "query": search_index(result.get("usuarios_query", [])),
+        },
+        "user_sets": {
+            "crystal": set(result.get("usuarios_crystal", [])),
+            "query": set(result.get("usuarios_query", [])),
+        },
+        "professionals": search_index(result.get("professional_data", {}).keys()),
+    }
+
+def get_job_index(process_id):
+    """
+    Índice de búsqueda de un trabajo completado (se arma una sola vez).
+    Devuelve (resultado completo, índice) o (None, None).
+    """
+    job = get_job(process_id)
+    if not job or job["status"] != "completed":
+        return None, None
+    index = job.get("index")
+    if index is None:
+        index = build_result_index(job["result"])
+        job["index"] = index
+    return job["result"], index
+
+def result_summary(result):
+    """Resultado sin las listas grandes, con enlaces a las consultas paginadas"""
+    if not isinstance(result, dict) or result.get("error"):
+        return result
+    summary = {key: value for key, value in result.items() if key not in PAGINATED_FIELDS}
+    process_id = result.get("process_id")
+    summary["links"] = {
+        "users": f"/jobs/{process_id}/users",
+        "professionals": f"/jobs/{process_id}/professionals",
+    }
+    if result.get("summary_only"):
+        summary["links"]["reports"] = f"/jobs/{process_id}/reports"
+    return summary
+
+def page_request():
+    """(q, página, tamaño) de la consulta; ValueError si no son válidos"""
+    q = (request.args.get('q') or '').strip().lower()
+    page = int(request.args.get('page', 1))
+    per_page = int(request.args.get('per_page', DEFAULT_PAGE_SIZE))
+    if page < 1 or per_page < 1:
+        raise ValueError("page y per_page deben ser mayores que 0")
+    return q, page, min(per_page, MAX_PAGE_SIZE)
+
+def search_page(index, q, page, per_page):
+    """Coincidencias por prefijo (sin distinguir mayúsculas) de la página pedida"""
+    keys = index["keys"]
+    if q:
+        start = bisect.bisect_left(keys, q)
+        end = bisect.bisect_left(keys, q + '\U0010ffff', start)
+    else:
+        start, end = 0, len(keys)
+    total = end - start
+    first = start + (page - 1) * per_page
+    values = index["values"][first:min(first + per_page, end)] if first < end else []
+    return values, {"page": page, "per_page": per_page, "total": total, "pages": -(-total // per_page)}
+
+# ========================================================
+# DESCARGA DE TODOS LOS REPORTES EN ZIP (STREAMING)
+# ========================================================
+
+# Estructuras ZIP (sin compresión: los .xlsx ya están comprimidos)
+ZIP_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+ZIP_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+ZIP_END_RECORD = struct.Struct('<IHHHHIIH')
+ZIP_UTF8_FLAG = 0x0800
+ZIP_READ_BLOCK = 256 * 1024
+
+# CRC32 ya calculados, por (ruta, tamaño, fecha): LRU acotado, y se descartan
+# los de un proceso al borrar su directorio
+ZIP_CRC_CACHE_ENTRIES = 4096
+zip_crc_cache = OrderedDict()
+zip_crc_lock = threading.Lock()
+
+def zip_dos_datetime(timestamp):
+    """Fecha y hora en formato DOS para los encabezados ZIP"""
+    t = time.localtime(timestamp)
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = (max(t.tm_year - 1980, 0) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+def file_crc32(entry):
+    """CRC32 del archivo, cacheado por ruta, tamaño y fecha de modificación"""
+    key = (entry["path"], entry["size"], entry["mtime"])
+    with zip_crc_lock:
+        crc = zip_crc_cache.get(key)
+        if crc is not None:
+            zip_crc_cache.move_to_end(key)
+            return crc
+    crc = 0
+    with open(entry["path"], 'rb') as f:
+        for block in iter(lambda: f.read(ZIP_READ_BLOCK), b''):
+            crc = zlib.crc32(block, crc)
+    with zip_crc_lock:
+        zip_crc_cache[key] = crc
+        while len(zip_crc_cache) > ZIP_CRC_CACHE_ENTRIES:
+            zip_crc_cache.popitem(last=False)
+    return crc
+
+def forget_zip_crcs(job_dir):
+    """Descarta los CRC de los archivos de un directorio eliminado"""
+    prefix = os.path.join(job_dir, "")
+    with zip_crc_lock:
+        for key in [key for key in zip_crc_cache if key[0].startswith(prefix)]:
+            del zip_crc_cache[key]
+
+def build_zip_plan(files):
+    """
+    Calcula la estructura del ZIP para [(nombre_en_zip, ruta), ...].
+    Como no hay compresión, el tamaño total y la posición de cada parte se
+    conocen antes de leer los archivos (necesario para Range).
+    """
+    entries = []
+    offset = 0
+    for arcname, path in files:
+        stat = os.stat(path)
+        name = arcname.encode('utf-8')
+        entry = {"name": name, "path": path, "size": stat.st_size, "mtime": stat.st_mtime, "offset": offset}
+        entries.append(entry)
+        offset += ZIP_LOCAL_HEADER.size + len(name) + stat.st_size
+
+    if offset > 0xFFFFFFFF or len(entries) > 0xFFFF:
+        raise ValueError("El paquete ZIP supera el tamaño máximo soportado (4GB)")
+
+    central_size = sum(ZIP_CENTRAL_HEADER.size + len(e["name"]) for e in entries)
+    return {
+        "entries": entries,
+        "central_offset": offset,
+        "central_size": central_size,
+        "total_size": offset + central_size + ZIP_END_RECORD.size
+    }
+
+def zip_plan_etag(plan):
+    """ETag estable mientras los archivos del paquete no cambien"""
+    digest = hashlib.sha1()
+    for e in plan["entries"]:
+        digest.update(e["name"] + f":{e['size']}:{e['mtime']}".encode('utf-8'))
+    return digest.hexdigest()
+
+def zip_local_header(entry):
+    dos_time, dos_date = zip_dos_datetime(entry["mtime"])
+    return ZIP_LOCAL_HEADER.pack(
+        0x04034b50, 20, ZIP_UTF8_FLAG, 0, dos_time, dos_date,
+        file_crc32(entry), entry["size"], entry["size"], len(entry["name"]), 0
+    ) + entry["name"]
+
+def zip_central_directory(plan):
+    parts = []
+    for entry in plan["entries"]:
+        dos_time, dos_date = zip_dos_datetime(entry["mtime"])
+        parts.append(ZIP_CENTRAL_HEADER.pack(
+            0x02014b50, 20, 20, ZIP_UTF8_FLAG, 0, dos_time, dos_date,
+            file_crc32(entry), entry["size"], entry["size"], len(entry["name"]), 0, 0, 0, 0, 0,
+            entry["offset"]
+        ) + entry["name"])
+    count = len(plan["entries"])
+    parts.append(ZIP_END_RECORD.pack(
+        0x06054b50, 0, 0, count, count, plan["central_size"], plan["central_offset"], 0
+    ))
+    return b''.join(parts)
+
+def stream_zip(plan, start=0, stop=None):
+    """
+    Genera los bytes [start, stop) del ZIP sin armarlo en memoria ni en disco.
+    Las partes anteriores a start se saltan y los archivos se leen con seek.
+    """
+    stop = plan["total_size"] if stop is None else stop
+    position = 0
+
+    for entry in plan["entries"]:
+        if position >= stop:
+            return
+        header_size = ZIP_LOCAL_HEADER.size + len(entry["name"])
+        if position + header_size > start:
+            header = zip_local_header(entry)
+            yield header[max(start - position, 0):stop - position]
+        position += header_size
+
+        data_end = position + entry["size"]
+        if data_end > start and position < stop:
+            with open(entry["path"], 'rb') as f:
+                f.seek(max(start - position, 0))
+                remaining = min(data_end, stop) - max(start, position)
+                while remaining > 0:
+                    block = f.read(min(ZIP_READ_BLOCK, remaining))
+                    if not block:
+                        raise IOError(f"Archivo modificado durante la descarga: {entry['path']}")
+                    remaining -= len(block)
+                    yield block
+        position = data_end
+
+    if position < stop:
+        central = zip_central_directory(plan)
+        yield central[max(start - position, 0):stop - position]
+
+# ========================================================
+# ENDPOINTS FLASK
+# ========================================================
+
+# Modo diferido por defecto si no se indica en /upload
+REPORTS_LAZY_DEFAULT = os.environ.get('REPORTS_LAZY', '').lower() in ('1', 'true', 'yes', 'si')
+
+def form_flag(name, default=False):
+    """Lee un campo de formulario tipo bandera (1/true/yes/si)"""
+    value = request.form.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'si')
+
+def form_report_format(default):
+    """Formato de los reportes (campo format); ValueError si no existe o falta su dependencia"""
+    report_format = (request.form.get('format') or default).lower()
+    if report_format not in REPORT_FORMATS:
+        raise ValueError(f"format debe ser uno de: {', '.join(REPORT_FORMATS)}")
+    if not report_format_available(report_format):
+        raise ValueError(f"El formato {report_format} requiere pyarrow, que no está instalado en el servidor.")
+    return report_format
+
+def enqueue_job(process_id, file1_path, file2_path, use_cache=True, lazy=False, series=None,
+                source_names=None, summary=False, engine=None, report_format=None):
+    """
+    Control de admisión y encolado comunes a /upload y /jobs/<id>/reports.
+    Devuelve (respuesta, código): 202 si se encoló, 413 si no cabe en
+    memoria o 429 si la cola de espera está llena.
+    """
+    # Control de admisión: estimar el pico de memoria antes de encolar
+    estimate_mb = estimate_job_memory(file1_path, file2_path)
+    budget_mb = jobs_memory_budget_mb()
+
+    # Motor: en auto, un par que no cabe en memoria se procesa en disco
+    engine = engine or PROCESS_ENGINE
+    if engine == "auto":
+        single_pair = not series and not isinstance(file1_path, list) and not isinstance(file2_path, list)
+        engine = "sqlite" if single_pair and estimate_mb > budget_mb else "memory"
+    if engine == "sqlite":
+        estimate_mb = min(estimate_mb, OUT_OF_CORE_MEMORY_MB)
+
+    if estimate_mb > budget_mb:
+        return jsonify({
+            "error": f"Los archivos necesitan unos {estimate_mb:.0f} MB de memoria y el servidor admite {budget_mb} MB. Divide los archivos e inténtalo de nuevo.",
+            "memory_estimate_mb": estimate_mb
+        }), 413
+
+    # Encolar el procesamiento y responder de inmediato
+    report_format = report_format or REPORT_FORMAT
+    status = submit_job(process_id, file1_path, file2_path, use_cache, lazy, estimate_mb, series,
+                        source_names, summary, engine, report_format)
+    if status is None:
+        retry_after = retry_after_seconds()
+        response = jsonify({
+            "error": f"Servidor ocupado: hay demasiados procesos en espera. Intenta de nuevo en {retry_after} segundos.",
+            "retry_after": retry_after
+        })
+        response.headers["Retry-After"] = str(retry_after)
+        return response, 429
+
+    state = get_process_state(process_id) or {}
+    return jsonify({
+        "process_id": process_id,
+        "status": status,
+        "queue_position": state.get("queue_position"),
+        "memory_estimate_mb": estimate_mb,
+        "engine": engine,
+        "report_format": report_format,
+        "status_url": f"/status/{process_id}",
+        "result_url": f"/result/{process_id}"
+    }), 202
+
+@app.route('/upload', methods=['POST'])
+def upload():
+    try:
+        # Uno o varios archivos por lado (p. ej. un Crystal por sede)
+        files1 = [f for f in request.files.getlist('file1') if f and f.filename]
+        files2 = [f for f in request.files.getlist('file2') if f and f.filename]
+
+        if not files1 or not files2:
+            return jsonify({"error": "Debes subir ambos archivos."}), 400
+        if len(files1) > MAX_BATCH_FILES or len(files2) > MAX_BATCH_FILES:
+            return jsonify({"error": f"Se admiten hasta {MAX_BATCH_FILES} archivos Crystal y {MAX_BATCH_FILES} archivos Query por carga."}), 400
+        batch_mode = len(files1) > 1 or len(files2) > 1
+
+        # no_cache=1 fuerza a regenerar aunque el mismo par ya se haya procesado
+        use_cache = not form_flag('no_cache')
+        # lazy=1 genera cada Excel recién cuando se descarga por primera vez
+        lazy = form_flag('lazy', REPORTS_LAZY_DEFAULT)
+        # summary=1 solo calcula los totales, sin generar ni guardar reportes
+        summary = form_flag('summary')
+        # engine=memory|sqlite fuerza el motor; auto usa sqlite si no cabe en memoria
+        engine = (request.form.get('engine') or PROCESS_ENGINE).lower()
+        if engine not in ENGINES:
+            return jsonify({"error": f"engine debe ser uno de: {', '.join(ENGINES)}"}), 400
+        # format=xlsx|xlsx_stream|csv|parquet|workbook elige cómo se escriben los reportes
+        try:
+            report_format = form_report_format(REPORT_FORMAT)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        # incremental=1 procesa solo las filas nuevas de la serie (por defecto el mes actual)
+        series = None
+        if form_flag('incremental'):
+            series = (request.form.get('series') or '').strip()[:100] or time.strftime("%Y-%m")
+            if batch_mode:
+                return jsonify({"error": "El modo incremental admite un solo archivo Crystal y un solo archivo Query."}), 400
+            if summary:
+                return jsonify({"error": "El modo resumen no se puede combinar con el modo incremental."}), 400
+            if report_format != "xlsx":
+                if request.form.get('format'):
+                    return jsonify({"error": "El modo incremental solo genera reportes en formato xlsx."}), 400
+                report_format = "xlsx"
+        if engine == "sqlite" and (batch_mode or series):
+            return jsonify({"error": "El motor sqlite admite un solo archivo Crystal y un solo archivo Query, sin modo incremental."}), 400
+
+        # Generar ID único para este proceso
+        process_id = str(uuid.uuid4())
+
+        # Guardar archivos temporales - En Render usar /tmp
+        temp_dir = "/tmp" if os.path.exists("/tmp") else tempfile.gettempdir()
+        source_names = {}
+        paths1 = []
+        paths2 = []
+        for prefix, files, paths in (("crystal", files1, paths1), ("query", files2, paths2)):
+            for file in files:
+                path = os.path.join(temp_dir, f"{prefix}_{uuid.uuid4().hex[:8]}.xlsx")
+                file.save(path)
+                observe("upload_bytes", os.path.getsize(path))
+                source_names[path] = os.path.basename(file.filename)
+                paths.append(path)
+
+        # Un solo par sigue el camino de siempre; en lote se pasan listas
+        if batch_mode:
+            file1_path, file2_path = paths1, paths2
+        else:
+            file1_path, file2_path = paths1[0], paths2[0]
+            source_names = None
+
+        response, status_code = enqueue_job(process_id, file1_path, file2_path, use_cache, lazy, series,
+                                            source_names, summary, engine, report_format)
+        if status_code != 202:
+            remove_temp_files(file1_path, file2_path)
+        return response, status_code
+
+    except Exception as e:
+        logger.exception(f"❌ Error en /upload: {e}")
+        return jsonify({"error": f"Error del servidor: {str(e)}"}), 500
+
+@app.route('/status/<process_id>')
+def process_status(process_id):
+    """Devuelve el estado y progreso de un proceso"""
+    state = get_process_state(process_id)
+    if state is None:
+        return jsonify({"error": "Proceso no encontrado"}), 404
+    state["process_id"] = process_id
+    return jsonify(state)
+
+@app.route('/result/<process_id>')
+def process_result(process_id):
+    """
+    Devuelve el resumen de un proceso terminado (las listas completas se
+    consultan en /jobs/<id>/...). Con ?full=1 devuelve el resultado completo.
+    """
+    job = get_job(process_id)
+    if job:
+        full = request.args.get('full', '').lower() in ('1', 'true', 'yes', 'si')
+        return json_response(job["result"] if full else result_summary(job["result"]))
+    if get_process_state(process_id) is not None:
+        return jsonify({"process_id": process_id, "status": "running"}), 202
+    return jsonify({"error": "Proceso no encontrado"}), 404
+
+@app.route('/jobs/<process_id>')
+def job_summary(process_id):
+    """Resumen de un proceso completado"""
+    result, _ = get_job_index(process_id)
+    if result is None:
+        return jsonify({"error": "Proceso no encontrado o no completado"}), 404
+    return json_response(result_summary(result))
+
+@app.route('/jobs/<process_id>/users')
+def job_users(process_id):
+    """Usuarios de Crystal o Query, paginados y filtrados por prefijo (?source=&q=&page=&per_page=)"""
+    source = request.args.get('source', 'query')
+    if source not in ('crystal', 'query'):
+        return jsonify({"error": "source debe ser 'crystal' o 'query'"}), 400
+    try:
+        q, page, per_page = page_request()
+    except ValueError as e:
+        return jsonify({"error": f"Parámetros inválidos: {e}"}), 400
+
+    result, index = get_job_index(process_id)
+    if result is None:
+        return jsonify({"error": "Proceso no encontrado o no completado"}), 404
+
+    users, pagination = search_page(index["users"][source], q, page, per_page)
+    in_crystal, in_query = index["user_sets"]["crystal"], index["user_sets"]["query"]
+    items = [{"usuario": user, "en_crystal": user in in_crystal, "en_query": user in in_query} for user in users]
+    return json_response({"source": source, "q": q, **pagination, "items": items})
+
+@app.route('/jobs/<process_id>/professionals')
+def job_professionals(process_id):
+    """Profesionales con sus totales, paginados y filtrados por prefijo (?q=&page=&per_page=)"""
+    try:
+        q, page, per_page = page_request()
+    except ValueError as e:
+        return jsonify({"error": f"Parámetros inválidos: {e}"}), 400
+
+    result, index = get_job_index(process_id)
+    if result is None:
+        return jsonify({"error": "Proceso no encontrado o no completado"}), 404
+
+    names, pagination = search_page(index["professionals"], q, page, per_page)
+    professional_data = result.get("professional_data", {})
+    items = [{"profesional": name, **professional_data[name]} for name in names]
+    return json_response({"q": q, **pagination, "items": items})
+
+@app.route('/jobs/<process_id>/professionals/<path:name>')
+def job_professional(process_id, name):
+    """Detalle de un profesional"""
+    result, _ = get_job_index(process_id)
+    if result is None:
+        return jsonify({"error": "Proceso no encontrado o no completado"}), 404
+    entry = result.get("professional_data", {}).get(name)
+    if entry is None:
+        return jsonify({"error": "Profesional no encontrado"}), 404
+    return json_response({"profesional": name, **entry})
+
+@app.route('/jobs/<process_id>/reports', methods=['POST'])
+def job_reports(process_id):
+    """
+    Genera los reportes de un proceso de solo resumen: se encola un proceso
+    nuevo con los mismos archivos (acepta lazy y format como /upload)
+    """
+    job = get_job(process_id)
+    if not job or job["status"] != "completed":
+        return jsonify({"error": "Proceso no encontrado o no completado"}), 404
+
+    reports_id = str(uuid.uuid4())
+    with process_lock:
+        inputs = job.pop("inputs", None)
+        requested_id = job.get("reports_process_id")
+    if inputs is not None:
+        # Con estado compartido, otro worker tiene su propia copia de los
+        # archivos: la reserva se toma en el almacén, no solo en memoria
+        requested_id = claim_job_reports(process_id, reports_id)
+        if requested_id:
+            inputs = None
+            with process_lock:
+                job["reports_process_id"] = requested_id
+    if inputs is None:
+        if requested_id:
+            return jsonify({"error": "Los reportes de este proceso ya fueron solicitados",
+                            "process_id": requested_id, "status_url": f"/status/{requested_id}",
+                            "result_url": f"/result/{requested_id}"}), 409
+        return jsonify({"error": "Este proceso no es de solo resumen o sus archivos ya expiraron"}), 404
+
+    paths = as_path_list(inputs["file1"]) + as_path_list(inputs["file2"])
+    if not all(os.path.exists(path) for path in paths):
+        release_job_reports(process_id, reports_id)
+        return jsonify({"error": "Los archivos de este proceso ya no están disponibles"}), 410
+    try:
+        # Por defecto, el formato pedido con el resumen
+        report_format = form_report_format(inputs.get("report_format") or REPORT_FORMAT)
+    except ValueError as e:
+        release_job_reports(process_id, reports_id)
+        with process_lock:
+            job["inputs"] = inputs
+        return jsonify({"error": str(e)}), 400
+
+    response, status_code = enqueue_job(reports_id, inputs["file1"], inputs["file2"],
+                                        lazy=form_flag('lazy', REPORTS_LAZY_DEFAULT),
+                                        source_names=inputs.get("source_names"), engine=inputs.get("engine"),
+                                        report_format=report_format)
+    with process_lock:
+        if status_code == 202:
+            job["reports_process_id"] = reports_id
+        else:
+            # Se conservan los archivos para reintentar
+            job["inputs"] = inputs
+    if status_code != 202:
+        release_job_reports(process_id, reports_id)
+    return response, status_code
+
+@app.route('/cancel-process', methods=['POST'])
+def cancel_process():
+    """Endpoint para cancelar procesos activos"""
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({"error": "Datos no proporcionados"}), 400
+            
+        process_id = data.get('process_id')
         
-        if process_id and process_id in active_processes:
-            del active_processes[process_id]
-            print(f"✅ Proceso {process_id} cancelado")
+        with process_lock:
+            cancelled = bool(process_id) and active_processes.pop(process_id, None) is not None
+
+        # Con estado compartido el trabajo puede ser de otro worker: se marca
+        # y su dueño lo detiene en la siguiente verificación
+        if process_id and SHARED_JOB_STATE:
+            cancelled = request_job_cancel(process_id) or cancelled
+
+        if cancelled:
+            logger.info(f"✅ Proceso {process_id} cancelado")
+            dispatch_waiting_jobs()
             return jsonify({"success": True, "message": "Proceso cancelado correctamente"})
         else:
             return jsonify({"error": "Proceso no encontrado o ya finalizado"}), 404
             
     except Exception as e:
-        print(f"❌ Error cancelando proceso: {e}")
+        logger.error(f"❌ Error cancelando proceso: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/download/<filename>')
-def download_file(filename):
+@app.route('/download/<process_id>/<filename>')
+def download_file(process_id, filename):
     try:
-        # En Render usar /tmp
-        temp_dir = "/tmp" if os.path.exists("/tmp") else tempfile.gettempdir()
-        file_path = os.path.join(temp_dir, filename)
-        
-        if not os.path.exists(file_path):
+        job_dir = job_artifact_dir(process_id)
+        file_path = safe_join(job_dir, filename) if job_dir else None
+
+        # En modo diferido el Excel se genera en la primera descarga
+        with log_context(process_id):
+            available = bool(file_path) and ensure_report(file_path)
+        if not available:
             return jsonify({"error": "Archivo no encontrado"}), 404
 
+        # El archivo se conserva para reintentos; el almacén lo expira por TTL/espacio
+        touch_job_dir(job_dir)
+
         # Enviar archivo con nombre personalizado
-        response = send_file(file_path, as_attachment=True, download_name=filename)
+        return send_file(file_path, as_attachment=True, download_name=filename)
         
-        # Intentar eliminar después de descargar
-        try:
-            os.remove(file_path)
-            print(f"🧹 Archivo eliminado tras descarga: {filename}")
-        except Exception as e:
-            print(f"⚠️ No se pudo eliminar archivo {filename}: {e}")
-            
+    except Exception as e:
+        return jsonify({"error": f"Error en descarga: {str(e)}"}), 500
+
+@app.route('/download-all/<process_id>')
+def download_all(process_id):
+    """Descarga en un solo ZIP todos los reportes generados por un proceso (soporta Range)"""
+    try:
+        job = get_job(process_id)
+        if not job or job["status"] != "completed" or job["result"].get("summary_only"):
+            return jsonify({"error": "Proceso no encontrado o sin reportes"}), 404
+
+        result = job["result"]
+        entries = list(result.get("user_data", {}).values()) + list(result.get("professional_data", {}).values())
+
+        # Los enlaces pueden apuntar al directorio de otro proceso (resultado en caché)
+        files = {}
+        for entry in entries:
+            path = artifact_path_from_link(entry["download_link"])
+            if path and ensure_report(path):
+                files.setdefault(entry["nombre_archivo"], path)
+        files = list(files.items())
+        for job_dir in {os.path.dirname(path) for _, path in files}:
+            touch_job_dir(job_dir)
+        if not files:
+            return jsonify({"error": "Los reportes de este proceso ya no están disponibles"}), 404
+
+        plan = build_zip_plan(files)
+        etag = zip_plan_etag(plan)
+        total = plan["total_size"]
+
+        status = 200
+        start, stop = 0, total
+        # Range solo aplica si el paquete no cambió (If-Range con el mismo ETag)
+        if request.range and request.if_range.date is None and request.if_range.etag in (None, etag):
+            byte_range = request.range.range_for_length(total)
+            if byte_range is None:
+                response = Response(status=416)
+                response.headers['Content-Range'] = f"bytes */{total}"
+                return response
+            start, stop = byte_range
+            status = 206
+
+        response = Response(stream_zip(plan, start, stop), status=status, mimetype='application/zip', direct_passthrough=True)
+        response.headers['Content-Length'] = str(stop - start)
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers['ETag'] = f'"{etag}"'
+        response.headers['Content-Disposition'] = 'attachment; filename="Reportes.zip"'
+        if status == 206:
+            response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{total}"
         return response
-        
+
     except Exception as e:
         return jsonify({"error": f"Error en descarga: {str(e)}"}), 500
 
+# Rutas que responden sin las librerías pesadas (None: ruta inexistente)
+LIGHT_ENDPOINTS = {"home", "static", "healthz", "process_status", None}
+
+@app.before_request
+def ensure_heavy_modules():
+    """El resto de las rutas procesan o miden: cargan las librerías si aún no están"""
+    if request.endpoint not in LIGHT_ENDPOINTS:
+        load_heavy_modules()
+
+@app.route('/healthz')
+def healthz():
+    """Chequeo de vida liviano: no importa pandas/openpyxl ni toca trabajos"""
+    return jsonify({
+        "status": "ok",
+        "uptime_seconds": round(time.perf_counter() - APP_IMPORT_STARTED, 3),
+        "heavy_modules_loaded": heavy_modules_ready.is_set(),
+        "startup": startup_timings,
+    })
+
 @app.route('/')
 def home():
     return render_template('index.html')
 
+@app.route('/metrics')
+def metrics():
+    """Métricas en formato de exposición de Prometheus"""
+    return Response(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
 # Manejo de errores global
 @app.errorhandler(500)
 def internal_error(error):
@@ -519,10 +4362,14 @@ def internal_error(error):
 def not_found(error):
     return jsonify({"error": "Endpoint no encontrado"}), 404
 
+startup_timings["import_seconds"] = round(time.perf_counter() - APP_IMPORT_STARTED, 4)
+start_heavy_modules_preload()
+
 if __name__ == '__main__':
     # En Render, usar el puerto proporcionado por la variable de entorno
     port = int(os.environ.get('PORT', 10000))
-    print(f"🚀 Iniciando aplicación en puerto: {port}")
-    print(f"📁 Directorio de trabajo: {os.getcwd()}")
-    print(f"📁 Temp dir: {tempfile.gettempdir()}")
+    logger.info(f"🚀 Iniciando aplicación en puerto: {port}")
+    logger.info(f"📁 Directorio de trabajo: {os.getcwd()}")
+    logger.info(f"📁 Temp dir: {tempfile.gettempdir()}")
+    logger.info(f"📁 Datos: {DATA_DIR}")
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,433 @@
+"""
+Benchmarks por fase del procesamiento Crystal/Query.
+
+Mide por separado lectura, detect_columns, agregación, validación cruzada,
+particionado, escritura de los Excel y safe_serialize, además del recorrido
+completo de process_excel (y de process_out_of_core, el motor sqlite) y
+del arranque en frío de la app (workload "startup"). La fase write usa el
+formato xlsx; cada formato de --formats agrega su fase write_<formato>.
+Para cada fase guarda el tiempo (mediana de las repeticiones) y el pico de
+RSS, y escribe un reporte JSON que se puede comparar contra una línea base
+guardada.
+
+Ejemplos:
+    python benchmarks/bench.py --rows 10000 100000
+    python benchmarks/bench.py --rows 100000 --save-baseline benchmarks/baseline.json
+    python benchmarks/bench.py --rows 100000 --baseline benchmarks/baseline.json --fail-on-regression
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+# Cachés y reportes en un directorio propio para no mezclar con la app real.
+# Se fija antes de importar app (y lo heredan los procesos del pool).
+BENCH_TMP = os.environ.setdefault('BENCH_TMP', tempfile.mkdtemp(prefix="bench_servicios_"))
+os.environ.setdefault('DATA_DIR', BENCH_TMP)
+# Los logs por reporte distorsionan los tiempos; --verbose los activa
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import app  # noqa: E402
+from workload import generate_workload, workload_name  # noqa: E402
+
+# Las fases se llaman directamente: cargar ya pandas/openpyxl
+app.load_heavy_modules()
+
+REPORT_VERSION = 1
+RSS_SAMPLE_INTERVAL = 0.01  # segundos
+
+PHASES = [
+    "read_crystal", "read_query", "detect_columns", "aggregation",
+    "validation", "partition", "write", "safe_serialize",
+]
+
+STARTUP_PHASES = ["import_app", "first_healthz", "heavy_modules", "total"]
+
+# Recorridos completos por motor: clave en el reporte -> motor
+END_TO_END = {"end_to_end": "memory", "end_to_end_sqlite": "sqlite"}
+
+# Arranque en un intérprete nuevo, sin precarga para medir cada etapa aislada
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+timings = {}
+def peak_rss_mb():
+    # VmHWM es propio del proceso; ru_maxrss hereda el pico del padre en Linux
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith("VmHWM")) / 1024
+def mark(phase, since):
+    now = time.perf_counter()
+    timings[phase] = {"seconds": now - since, "peak_rss_mb": peak_rss_mb()}
+    return now
+import app
+t = mark("import_app", start)
+assert app.app.test_client().get("/healthz").status_code == 200
+t = mark("first_healthz", t)
+app.load_heavy_modules()
+mark("heavy_modules", t)
+print(json.dumps(timings))
+"""
+
+# ========================================================
+# MEDICIÓN DE TIEMPO Y MEMORIA
+# ========================================================
+
+def current_rss():
+    """RSS del proceso más sus hijos (los trabajadores del pool de escritura)"""
+    process = psutil.Process()
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss
+
+def measure(fn, *args, **kwargs):
+    """
+    Ejecuta fn muestreando el RSS en un hilo aparte.
+    Devuelve (resultado, segundos, pico_rss_mb).
+    """
+    peak = [current_rss()]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(RSS_SAMPLE_INTERVAL):
+            peak[0] = max(peak[0], current_rss())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        done.set()
+        sampler.join()
+    peak[0] = max(peak[0], current_rss())
+    return result, elapsed, peak[0] / (1024 * 1024)
+
+def reset_bench_dirs():
+    for path in (app.ARTIFACTS_DIR, app.PARSED_CACHE_DIR, app.RESULT_CACHE_DIR):
+        shutil.rmtree(path, ignore_errors=True)
+
+# ========================================================
+# FASES
+# ========================================================
+
+def run_phases(crystal_path, query_path, formats=()):
+    """Una pasada por todas las fases, con las mismas funciones que process_excel"""
+    timings = {}
+
+    def timed(phase, fn, *args, **kwargs):
+        result, seconds, peak_mb = measure(fn, *args, **kwargs)
+        timings[phase] = {"seconds": seconds, "peak_rss_mb": peak_mb}
+        return result
+
+    process_id = f"bench-{time.time_ns()}"
+    app.active_processes[process_id] = {"status": "starting", "progress": 0}
+    output_dir = app.job_artifact_dir(process_id)
+    try:
+        df1 = timed("read_crystal", app.read_large_excel, crystal_path)
+        df2 = timed("read_query", app.read_large_excel, query_path)
+
+        def detect():
+            return (app.detect_columns(list(df1.columns), "CRYSTAL"),
+                    app.detect_columns(list(df2.columns), "QUERY"))
+        crystal_columns, query_columns = timed("detect_columns", detect)
+        col_prof1, col_serv1, col_user1 = crystal_columns
+        col_prof2, col_serv2, col_user2 = query_columns
+
+        def aggregate():
+            app.encode_key_columns(df1, crystal_columns)
+            app.encode_key_columns(df2, query_columns)
+            return app.compute_aggregates(df1, df2, crystal_columns, query_columns)
+        aggregates = timed("aggregation", aggregate)
+
+        def validate():
+            in_query, in_crystal = app.cross_validate(df1, df2, col_user1, col_user2)
+            df1['Validación Query'] = app.yes_no_column(in_query, df1.index)
+            return in_crystal
+        in_crystal = timed("validation", validate)
+
+        df1_sorted, prof_ranges = timed("partition", app.partition_by_professional, df1, col_prof1)
+
+        def write():
+            os.makedirs(output_dir, exist_ok=True)
+            tasks, task_professionals = app.build_report_tasks(
+                df1_sorted, prof_ranges, aggregates["professionals"], df2, in_crystal,
+                (col_serv1, col_user1, col_user2), output_dir, process_id)
+            return app.run_report_tasks(process_id, tasks, 30, 85), task_professionals
+        results, task_professionals = timed("write", write)
+
+        # Mismos reportes con cada escritor, en un directorio por formato
+        for report_format in formats:
+            def write_format():
+                format_dir = os.path.join(output_dir, report_format)
+                os.makedirs(format_dir, exist_ok=True)
+                tasks, _ = app.build_report_tasks(
+                    df1_sorted, prof_ranges, aggregates["professionals"], df2, in_crystal,
+                    (col_serv1, col_user1, col_user2), format_dir, process_id, report_format=report_format)
+                entries = app.run_report_tasks(process_id, tasks, 30, 85, parallel=report_format != "workbook")
+                if report_format == "workbook":
+                    app.write_workbook_report(tasks, entries, format_dir)
+            timed(f"write_{report_format}", write_format)
+
+        user_data = {}
+        if col_user2 in df2.columns:
+            user_data["query_validation"] = results.pop(0)
+        result_data = {
+            "totals": aggregates["totals"],
+            "professionals": aggregates["professionals"],
+            "usuarios_crystal": aggregates["usuarios_crystal"],
+            "usuarios_query": aggregates["usuarios_query"],
+            "professional_data": {str(prof): entry for prof, entry in zip(task_professionals, results)},
+            "user_data": user_data,
+            "process_id": process_id,
+        }
+        timed("safe_serialize", app.safe_serialize, result_data)
+    finally:
+        app.active_processes.pop(process_id, None)
+        app.remove_job_dir(output_dir)
+    return timings
+
+def run_end_to_end(crystal_path, query_path, engine="memory"):
+    """
+    process_excel completo, sin caché de resultados ni de archivos leídos, o
+    process_out_of_core con engine="sqlite"
+    """
+    reset_bench_dirs()
+    process_id = f"bench-e2e-{time.time_ns()}"
+    app.active_processes[process_id] = {"status": "starting", "progress": 0}
+    try:
+        if engine == "sqlite":
+            result, seconds, peak_mb = measure(app.process_out_of_core, crystal_path, query_path, process_id)
+        else:
+            result, seconds, peak_mb = measure(app.process_excel, crystal_path, query_path, process_id, use_cache=False)
+    finally:
+        app.active_processes.pop(process_id, None)
+        app.remove_job_dir(app.job_artifact_dir(process_id))
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    return {"seconds": seconds, "peak_rss_mb": peak_mb}
+
+def run_startup():
+    """Arranque en frío: importar app, primer /healthz y carga de las librerías pesadas"""
+    env = dict(os.environ, PRELOAD_HEAVY_MODULES="0")
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, os.path.dirname(BENCH_DIR)],
+                            env=env, capture_output=True, text=True, check=True).stdout
+    total = time.perf_counter() - start
+    timings = json.loads(output.strip().splitlines()[-1])
+    timings["total"] = {"seconds": total, "peak_rss_mb": max(t["peak_rss_mb"] for t in timings.values())}
+    return timings
+
+def bench_startup(args):
+    runs = {phase: [] for phase in STARTUP_PHASES}
+    for _ in range(args.repeat):
+        timings = run_startup()
+        for phase in STARTUP_PHASES:
+            runs[phase].append(timings[phase])
+    return {"params": {}, "phases": {phase: summarize(phase_runs) for phase, phase_runs in runs.items()}}
+
+def summarize(runs):
+    """Mediana de tiempos y máximo de RSS entre repeticiones"""
+    return {
+        "seconds": statistics.median(run["seconds"] for run in runs),
+        "runs": [round(run["seconds"], 4) for run in runs],
+        "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+    }
+
+def bench_workload(params, args):
+    crystal_path, query_path = generate_workload(args.data_dir, **params)
+    phases = PHASES + [f"write_{report_format}" for report_format in args.formats]
+    phase_runs = {phase: [] for phase in phases}
+    e2e_runs = {key: [] for key in END_TO_END}
+    for _ in range(args.repeat):
+        timings = run_phases(crystal_path, query_path, args.formats)
+        for phase in phases:
+            phase_runs[phase].append(timings[phase])
+        if not args.skip_end_to_end:
+            for key, engine in END_TO_END.items():
+                e2e_runs[key].append(run_end_to_end(crystal_path, query_path, engine))
+
+    entry = {
+        "params": params,
+        "file_size_mb": {
+            "crystal": os.path.getsize(crystal_path) / (1024 * 1024),
+            "query": os.path.getsize(query_path) / (1024 * 1024),
+        },
+        "phases": {phase: summarize(runs) for phase, runs in phase_runs.items()},
+    }
+    for key, runs in e2e_runs.items():
+        if runs:
+            entry[key] = summarize(runs)
+    return entry
+
+# ========================================================
+# REPORTE Y COMPARACIÓN CON LÍNEA BASE
+# ========================================================
+
+def environment_info():
+    import numpy
+    import openpyxl
+    import pandas
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "report_workers": app.REPORT_WORKERS,
+        "read_chunk_size": app.READ_CHUNK_SIZE,
+        "pandas": pandas.__version__,
+        "numpy": numpy.__version__,
+        "openpyxl": openpyxl.__version__,
+    }
+
+def iter_measurements(report):
+    """(workload, fase, medición) para todas las fases y el recorrido completo"""
+    for name, workload in report["workloads"].items():
+        for phase, measurement in workload["phases"].items():
+            yield name, phase, measurement
+        for key in END_TO_END:
+            if key in workload:
+                yield name, key, workload[key]
+
+def compare_reports(current, baseline, threshold, min_seconds):
+    """
+    Compara tiempos y RSS contra la línea base. Una fase es regresión si
+    empeora más que threshold (proporción) y además más que min_seconds,
+    para no marcar ruido en fases de milisegundos.
+    """
+    base = {(name, phase): m for name, phase, m in iter_measurements(baseline)}
+    rows = []
+    for name, phase, measurement in iter_measurements(current):
+        reference = base.get((name, phase))
+        if reference is None:
+            continue
+        delta = measurement["seconds"] - reference["seconds"]
+        ratio = measurement["seconds"] / reference["seconds"] if reference["seconds"] else float("inf")
+        rows.append({
+            "workload": name,
+            "phase": phase,
+            "baseline_seconds": reference["seconds"],
+            "seconds": measurement["seconds"],
+            "ratio": ratio,
+            "baseline_peak_rss_mb": reference["peak_rss_mb"],
+            "peak_rss_mb": measurement["peak_rss_mb"],
+            "regression": ratio > 1 + threshold and delta > min_seconds,
+        })
+    return rows
+
+def print_report(report):
+    for name, workload in report["workloads"].items():
+        print(f"\n📊 {name}")
+        print(f"   {'fase':<18}{'segundos':>10}{'pico RSS MB':>14}")
+        for _, phase, measurement in iter_measurements({"workloads": {name: workload}}):
+            print(f"   {phase:<18}{measurement['seconds']:>10.3f}{measurement['peak_rss_mb']:>14.1f}")
+
+def print_comparison(rows):
+    print(f"\n🔎 Comparación con línea base")
+    print(f"   {'workload':<34}{'fase':<18}{'base s':>9}{'actual s':>10}{'ratio':>8}")
+    for row in rows:
+        mark = "  ❌ regresión" if row["regression"] else ""
+        print(f"   {row['workload']:<34}{row['phase']:<18}{row['baseline_seconds']:>9.3f}"
+              f"{row['seconds']:>10.3f}{row['ratio']:>8.2f}{mark}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks por fase de process_excel")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000],
+                        help="Filas de Crystal por workload (10k a 1M)")
+    parser.add_argument("--professionals", type=int, default=50)
+    parser.add_argument("--services", type=int, default=8)
+    parser.add_argument("--overlap", type=float, default=0.6, help="Proporción de usuarios Query presentes en Crystal")
+    parser.add_argument("--messiness", type=int, default=1, choices=[0, 1, 2])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-end-to-end", action="store_true", help="No medir los recorridos completos")
+    parser.add_argument("--skip-startup", action="store_true", help="No medir el arranque en frío de la app")
+    parser.add_argument("--formats", nargs="*", choices=[f for f in app.REPORT_FORMATS if f != "xlsx"],
+                        default=[f for f in app.REPORT_FORMATS if f != "xlsx" and app.report_format_available(f)],
+                        help="Formatos de reporte a medir además de xlsx (fases write_<formato>)")
+    parser.add_argument("--data-dir", default=os.path.join(BENCH_DIR, "data"), help="Dónde guardar los workloads generados")
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results", "latest.json"))
+    parser.add_argument("--save-baseline", metavar="RUTA", help="Guardar además el reporte como línea base")
+    parser.add_argument("--baseline", metavar="RUTA", help="Línea base contra la cual comparar")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Empeoramiento tolerado (0.10 = 10%%)")
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="Diferencias menores se consideran ruido")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Salir con código 1 si hay regresiones")
+    parser.add_argument("--verbose", action="store_true", help="Mostrar los logs de app.py")
+    args = parser.parse_args()
+    unavailable = [f for f in args.formats if not app.report_format_available(f)]
+    if unavailable:
+        parser.error(f"formatos sin sus dependencias instaladas: {', '.join(unavailable)}")
+    if args.verbose:
+        app.logger.setLevel("INFO")
+
+    report = {
+        "version": REPORT_VERSION,
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "environment": environment_info(),
+        "repeat": args.repeat,
+        "workloads": {},
+    }
+
+    try:
+        if not args.skip_startup:
+            print(f"⏱️ Midiendo arranque en frío ({args.repeat} repeticiones)...")
+            report["workloads"]["startup"] = bench_startup(args)
+        for rows in args.rows:
+            params = {
+                "rows": rows,
+                "professionals": args.professionals,
+                "services": args.services,
+                "overlap": args.overlap,
+                "messiness": args.messiness,
+                "seed": args.seed,
+            }
+            name = workload_name(**params)
+            print(f"⏱️ Ejecutando {name} ({args.repeat} repeticiones)...")
+            report["workloads"][name] = bench_workload(params, args)
+    finally:
+        app.reset_report_executor()
+        shutil.rmtree(BENCH_TMP, ignore_errors=True)
+
+    print_report(report)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows = compare_reports(report, baseline, args.threshold, args.min_seconds)
+        report["comparison"] = {"baseline": args.baseline, "threshold": args.threshold,
+                                "min_seconds": args.min_seconds, "rows": rows}
+        print_comparison(rows)
+        regressions = [row for row in rows if row["regression"]]
+
+    for path in filter(None, [args.output, args.save_baseline]):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"💾 Reporte guardado en {path}")
+
+    if regressions:
+        print(f"❌ {len(regressions)} fase(s) con regresión")
+        if args.fail_on_regression:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Generador de archivos Crystal/Query sintéticos para los benchmarks.
+
+Permite variar filas, profesionales, categorías de servicio, proporción de
+usuarios de Query que también están en Crystal y qué tan "desordenados"
+vienen los encabezados. Los archivos se escriben con openpyxl en modo
+write_only para poder generar hasta 1M de filas en tiempo razonable.
+"""
+
+import argparse
+import datetime
+import os
+import random
+
+from openpyxl import Workbook
+
+# Encabezados por nivel de desorden: 0 = limpio, 1 = mayúsculas/espacios,
+# 2 = variantes y acentos que detect_columns debe reconocer
+CRYSTAL_HEADERS = [
+    ["Profesional", "Servicio", "Usuario", "Fecha", "Valor", "Sede"],
+    ["  PROFESIONAL ", " Servicio  ", "USUARIO", "Fecha ", " VALOR", "sede"],
+    ["Nombre Médico Tratante", "Procedimiento Realizado", "Identificación Paciente", "Fecha Atención", "Valor $", "Sede / Ciudad"],
+]
+QUERY_HEADERS = [
+    ["Profesional", "Servicio", "Usuario", "Fecha"],
+    [" MEDICO ", "TIPO ESTUDIO ", "  Cedula", "FECHA"],
+    ["Médico Remitente", "Categoría Estudio", "Cédula Usuario", "Fecha Solicitud"],
+]
+
+SEDES = ["Bogotá", "Medellín", "Cali", "Barranquilla", "Bucaramanga"]
+
+
+def workload_name(rows, professionals, services, overlap, messiness, seed):
+    return f"r{rows}_p{professionals}_s{services}_o{int(overlap * 100)}_m{messiness}_seed{seed}"
+
+
+def generate_workload(output_dir, rows=10000, professionals=50, services=8, overlap=0.6,
+                      messiness=1, seed=42, query_ratio=0.5, blank_ratio=0.01):
+    """
+    Genera (o reutiliza si ya existen) crystal.xlsx y query.xlsx en
+    output_dir/<nombre del workload>. Devuelve (ruta_crystal, ruta_query).
+    """
+    name = workload_name(rows, professionals, services, overlap, messiness, seed)
+    target = os.path.join(output_dir, name)
+    crystal_path = os.path.join(target, "crystal.xlsx")
+    query_path = os.path.join(target, "query.xlsx")
+    if os.path.exists(crystal_path) and os.path.exists(query_path):
+        return crystal_path, query_path
+
+    os.makedirs(target, exist_ok=True)
+    rng = random.Random(seed)
+    messiness = max(0, min(messiness, len(CRYSTAL_HEADERS) - 1))
+
+    prof_names = [f"Dr. {rng.choice(['Ana', 'Luis', 'Juan', 'María', 'Carlos', 'Sofía'])} "
+                  f"{rng.choice(['Pérez', 'Gómez', 'Rodríguez', 'López', 'Martínez'])} {i}"
+                  for i in range(professionals)]
+    service_names = [f"Servicio {chr(65 + i % 26)}{i // 26 or ''}" for i in range(services)]
+
+    # Cerca de 3 atenciones por usuario en Crystal
+    crystal_users = [1000000 + i for i in range(max(rows // 3, 1))]
+    query_rows = max(int(rows * query_ratio), 1)
+    shared = crystal_users[:int(len(crystal_users) * overlap)]
+    only_query = [9000000 + i for i in range(max(int(len(shared) * (1 - overlap) / max(overlap, 0.01)), 1))]
+    query_users = shared + only_query
+
+    start = datetime.datetime(2025, 1, 1)
+
+    def maybe_blank(value):
+        return None if rng.random() < blank_ratio else value
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Crystal")
+    ws.append(CRYSTAL_HEADERS[messiness])
+    for _ in range(rows):
+        ws.append([
+            maybe_blank(rng.choice(prof_names)),
+            maybe_blank(rng.choice(service_names)),
+            maybe_blank(rng.choice(crystal_users)),
+            start + datetime.timedelta(days=rng.randrange(90)),
+            round(rng.uniform(10000, 500000), 2),
+            rng.choice(SEDES),
+        ])
+    wb.save(crystal_path)
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Query")
+    ws.append(QUERY_HEADERS[messiness])
+    for _ in range(query_rows):
+        ws.append([
+            maybe_blank(rng.choice(prof_names)),
+            maybe_blank(rng.choice(service_names)),
+            maybe_blank(rng.choice(query_users)),
+            start + datetime.timedelta(days=rng.randrange(90)),
+        ])
+    wb.save(query_path)
+
+    return crystal_path, query_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera archivos Crystal/Query sintéticos")
+    parser.add_argument("--output-dir", default=os.path.join(os.path.dirname(__file__), "data"))
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--professionals", type=int, default=50)
+    parser.add_argument("--services", type=int, default=8)
+    parser.add_argument("--overlap", type=float, default=0.6, help="Proporción de usuarios Query presentes en Crystal")
+    parser.add_argument("--messiness", type=int, default=1, choices=[0, 1, 2])
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    crystal, query = generate_workload(args.output_dir, args.rows, args.professionals, args.services,
+                                       args.overlap, args.messiness, args.seed)
+    print(f"✅ Crystal: {crystal}")
+    print(f"✅ Query:   {query}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Fixtures comunes: la app con cachés, reportes y estado en un directorio
+temporal propio, y un par Crystal/Query sintético pequeño (benchmarks/workload.py).
+"""
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
+
+# Se fija antes de importar app (y lo heredan los procesos del pool)
+TEST_TMP = tempfile.mkdtemp(prefix="test_servicios_")
+os.environ['DATA_DIR'] = os.path.join(TEST_TMP, "datos")
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import app as app_module  # noqa: E402
+from workload import generate_workload  # noqa: E402
+
+app_module.load_heavy_modules()
+
+JOB_TIMEOUT = 120  # segundos
+
+
+@pytest.fixture(scope="session")
+def workload():
+    """(crystal, query): 600 atenciones de 8 profesionales"""
+    return generate_workload(os.path.join(TEST_TMP, "data"), rows=600, professionals=8, services=4, seed=7)
+
+
+@pytest.fixture
+def client():
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def fresh_caches(monkeypatch, tmp_path):
+    """Cachés de archivos leídos y de resultados vacías para la prueba"""
+    monkeypatch.setattr(app_module, "PARSED_CACHE_DIR", str(tmp_path / "parsed_cache"))
+    monkeypatch.setattr(app_module, "RESULT_CACHE_DIR", str(tmp_path / "result_cache"))
+    return app_module
+
+
+@pytest.fixture
+def shared_state(monkeypatch, tmp_path):
+    """Backend sqlite de estado compartido en un archivo propio de la prueba"""
+    results_dir = tmp_path / "resultados"
+    monkeypatch.setattr(app_module, "SHARED_JOB_STATE", True)
+    monkeypatch.setattr(app_module, "JOB_STATE_DB", str(tmp_path / "trabajos.sqlite3"))
+    monkeypatch.setattr(app_module, "JOB_RESULTS_DIR", str(results_dir))
+    # Conexiones por hilo nuevas: los hilos del pool conservan las de otras pruebas
+    monkeypatch.setattr(app_module, "job_store_local", threading.local())
+    return app_module
+
+
+def upload(client, crystal, query, **fields):
+    """POST /upload con un par de archivos; devuelve la respuesta"""
+    with open(crystal, 'rb') as f1, open(query, 'rb') as f2:
+        data = {"file1": (f1, "crystal.xlsx"), "file2": (f2, "query.xlsx")}
+        data.update({key: str(value) for key, value in fields.items()})
+        return client.post('/upload', data=data, content_type='multipart/form-data')
+
+
+def wait_job(process_id, timeout=JOB_TIMEOUT):
+    """
+    Espera a que el trabajo termine y devuelve su entrada de job_results.
+    No toma process_lock, así un bloqueo del trabajo falla la prueba en vez de colgarla.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = app_module.job_results.get(process_id)
+        if job is not None:
+            return job
+        time.sleep(0.05)
+    pytest.fail(f"El proceso {process_id} no terminó en {timeout} s")
+
+
+def comparable(result):
+    """El resultado sin métricas, identificadores ni enlaces, conservando el orden de las claves"""
+    result = json.loads(json.dumps(result, default=str))
+    for key in ("metrics", "process_id", "cache", "engine", "incremental"):
+        result.pop(key, None)
+    for entries in (result["professional_data"], result["user_data"]):
+        for entry in entries.values():
+            entry.pop("download_link", None)
+    return result
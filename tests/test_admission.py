@@ -0,0 +1,110 @@
+import os
+import threading
+
+import pandas as pd
+
+import app
+from conftest import upload, wait_job
+
+
+def test_sniff_dimensions_reads_declared_dimension(tmp_path):
+    path = str(tmp_path / "con_dimension.xlsx")
+    pd.DataFrame({"Profesional": ["A"] * 300, "Usuario": range(300), "Servicio": ["X"] * 300}).to_excel(path, index=False)
+    assert app.sniff_dimensions(path) == (301, 3)
+
+
+def test_estimate_falls_back_to_file_size(workload):
+    """openpyxl write_only no declara la dimensión: se estima por tamaño"""
+    crystal, _ = workload
+    assert app.sniff_dimensions(crystal) is None
+    cells = os.path.getsize(crystal) // app.XLSX_BYTES_PER_CELL
+    expected = round(app.JOB_BASE_MEMORY_MB + cells * app.BYTES_PER_CELL / app.MB, 1)
+    assert app.estimate_job_memory(crystal) == expected
+
+
+def test_estimate_counts_report_pool(workload, monkeypatch):
+    """Con pool: los procesos se reservan del presupuesto y cada trabajo suma sus particiones en vuelo"""
+    crystal, _ = workload
+    monkeypatch.setattr(app, "REPORT_WORKERS", 2)
+    monkeypatch.setattr(app, "MEMORY_BUDGET_MB", 358)
+    cells = os.path.getsize(crystal) // app.XLSX_BYTES_PER_CELL
+    bytes_per_cell = app.BYTES_PER_CELL + app.REPORT_COPY_BYTES_PER_CELL
+    assert app.estimate_job_memory(crystal) == round(app.JOB_BASE_MEMORY_MB + cells * bytes_per_cell / app.MB, 1)
+    assert app.jobs_memory_budget_mb() == 358 - 2 * app.REPORT_WORKER_MEMORY_MB
+
+
+def test_report_pool_reservation_rejects_job(client, workload, monkeypatch):
+    """Cabría en el presupuesto completo, pero no en lo que deja el pool"""
+    monkeypatch.setattr(app, "REPORT_WORKERS", 2)
+    monkeypatch.setattr(app, "MEMORY_BUDGET_MB", 358)
+    monkeypatch.setattr(app, "estimate_job_memory", lambda *paths: 200)
+    response = upload(client, *workload, engine="memory")
+    assert response.status_code == 413
+    assert response.get_json()["memory_estimate_mb"] == 200
+
+
+def test_sniff_dimensions_rejects_non_xlsx(tmp_path):
+    path = tmp_path / "roto.xlsx"
+    path.write_bytes(b"no es un zip")
+    assert app.sniff_dimensions(str(path)) is None
+
+
+def fake_cgroup(monkeypatch, tmp_path, limit_mb, usage_mb):
+    """Contenedor con límite de memoria (cgroup v2) en un host con mucha más RAM"""
+    (tmp_path / "memory.max").write_text(f"{limit_mb * app.MB}\n")
+    (tmp_path / "memory.current").write_text(f"{usage_mb * app.MB}\n")
+    (tmp_path / "memory.stat").write_text("anon 0\ninactive_file 0\n")
+    monkeypatch.setattr(app, "CGROUP_MEMORY_FILES", ((str(tmp_path / "memory.max"), str(tmp_path / "memory.current"),
+                                                      str(tmp_path / "memory.stat"), "inactive_file"),))
+    monkeypatch.setattr(app, "physical_memory_mb", lambda: 16384)
+    monkeypatch.setattr(app, "MEMORY_BUDGET_MB", int(app.total_memory_mb() * 0.7))
+
+
+def hold_jobs(monkeypatch):
+    """Los trabajos admitidos quedan en curso hasta liberar la compuerta"""
+    gate = threading.Event()
+    run_job = app.run_job
+
+    def gated_run_job(*args):
+        gate.wait(10)
+        run_job(*args)
+
+    monkeypatch.setattr(app, "run_job", gated_run_job)
+    return gate
+
+
+def test_budget_follows_container_limit(client, workload, fresh_caches, monkeypatch, tmp_path):
+    fake_cgroup(monkeypatch, tmp_path, limit_mb=512, usage_mb=100)
+    assert app.total_memory_mb() == 512
+    assert app.MEMORY_BUDGET_MB == 358
+    monkeypatch.setattr(app, "estimate_job_memory", lambda *paths: 200)
+    monkeypatch.setattr(app, "MAX_WAITING_JOBS", 1)
+    gate = hold_jobs(monkeypatch)
+
+    first = upload(client, *workload, no_cache=1).get_json()
+    second = upload(client, *workload, no_cache=1).get_json()
+    third = upload(client, *workload, no_cache=1)
+    assert first["status"] == "queued"
+    assert second["status"] == "waiting_memory"
+    assert third.status_code == 429
+
+    gate.set()
+    assert wait_job(first["process_id"])["status"] == "completed"
+    assert wait_job(second["process_id"])["status"] == "completed"
+
+
+def test_headroom_measured_against_container_limit(client, workload, fresh_caches, monkeypatch, tmp_path):
+    """Cabe en el presupuesto, pero el contenedor ya usa 400 de sus 512 MB"""
+    fake_cgroup(monkeypatch, tmp_path, limit_mb=512, usage_mb=400)
+    assert app.available_memory_mb() == 112
+    monkeypatch.setattr(app, "estimate_job_memory", lambda *paths: 100)
+    gate = hold_jobs(monkeypatch)
+
+    first = upload(client, *workload, no_cache=1).get_json()
+    second = upload(client, *workload, no_cache=1).get_json()
+    assert first["status"] == "queued"
+    assert second["status"] == "waiting_memory"
+
+    gate.set()
+    assert wait_job(first["process_id"])["status"] == "completed"
+    assert wait_job(second["process_id"])["status"] == "completed"
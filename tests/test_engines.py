@@ -0,0 +1,62 @@
+import json
+
+from openpyxl import Workbook, load_workbook
+
+import app
+from conftest import comparable
+
+
+def copy_sheet(source, target, rows=None, user_column=None, transform=None):
+    """Copia las primeras filas de un libro, opcionalmente transformando la columna de usuario"""
+    wb_in = load_workbook(source, read_only=True)
+    wb_out = Workbook(write_only=True)
+    ws = wb_out.create_sheet("Hoja")
+    for i, row in enumerate(wb_in.active.iter_rows(values_only=True)):
+        if rows is not None and i > rows:
+            break
+        row = list(row)
+        if i and transform is not None and row[user_column] is not None:
+            row[user_column] = transform(row[user_column])
+        ws.append(row)
+    wb_in.close()
+    wb_out.save(target)
+    return target
+
+
+def assert_same(expected, actual):
+    assert expected == actual
+    # Mismo orden en todos los niveles, también en los empates
+    assert json.dumps(expected, ensure_ascii=False) == json.dumps(actual, ensure_ascii=False)
+
+
+def run(function, process_id, *args, **kwargs):
+    app.active_processes[process_id] = {"status": "starting", "progress": 0}
+    try:
+        result = function(*args, process_id, **kwargs)
+    finally:
+        app.active_processes.pop(process_id, None)
+    assert "error" not in result, result
+    return result
+
+
+def test_engines_match_memory(workload, tmp_path):
+    crystal, query = workload
+    # Query con usuarios como decimales (1000000.0): la misma clave que en Crystal
+    query = copy_sheet(query, str(tmp_path / "query_float.xlsx"), user_column=2, transform=float)
+
+    expected = comparable(run(app.process_excel, "test-engine-memory", crystal, query, use_cache=False))
+    assert "1000000" in expected["usuarios_query"]
+    assert_same(expected, comparable(run(app.process_out_of_core, "test-engine-sqlite", crystal, query)))
+    assert_same(expected, comparable(run(app.process_incremental, "test-engine-incremental", crystal, query,
+                                         series="test-engines")))
+
+
+def test_incremental_append_matches_memory(workload, tmp_path):
+    crystal, query = workload
+    partial = copy_sheet(crystal, str(tmp_path / "crystal_parcial.xlsx"), rows=250)
+
+    run(app.process_incremental, "test-append-first", partial, query, series="test-append")
+    appended = run(app.process_incremental, "test-append-second", crystal, query, series="test-append")
+    assert appended["incremental"]["mode"] == "delta"
+    expected = run(app.process_excel, "test-append-memory", crystal, query, use_cache=False)
+    assert_same(comparable(expected), comparable(appended))
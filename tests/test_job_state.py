@@ -0,0 +1,71 @@
+import threading
+
+from conftest import upload, wait_job
+
+
+def test_remote_cancel_of_queued_job(client, workload, shared_state, monkeypatch):
+    """Otro worker cancela un trabajo que sigue en cola en este: no debe bloquear process_lock"""
+    gate = threading.Event()
+    run_job = shared_state.run_job
+
+    def gated_run_job(*args):
+        gate.wait(10)
+        run_job(*args)
+
+    monkeypatch.setattr(shared_state, "run_job", gated_run_job)
+    response = upload(client, *workload, no_cache=1)
+    assert response.status_code == 202
+    process_id = response.get_json()["process_id"]
+
+    # La marca que deja /cancel-process en el worker que recibió el pedido
+    assert shared_state.request_job_cancel(process_id)
+    gate.set()
+
+    job = wait_job(process_id)
+    assert job["status"] == "cancelled"
+    assert client.get(f"/status/{process_id}").get_json()["status"] == "cancelled"
+    assert client.get(f"/result/{process_id}").get_json()["error"] == "Proceso cancelado por el usuario"
+    # El lock quedó libre para el resto de las rutas
+    assert client.get('/jobs/no-existe').status_code == 404
+
+
+def test_remote_cancel_of_running_job(client, workload, shared_state, monkeypatch):
+    """La marca remota detiene un trabajo en curso en su siguiente set_process_state"""
+    started, gate = threading.Event(), threading.Event()
+    process_excel = shared_state.process_excel
+
+    def gated_process_excel(*args, **kwargs):
+        started.set()
+        gate.wait(10)
+        shared_state.set_process_state(args[2], status="Leyendo", progress=5)
+        return process_excel(*args, **kwargs)
+
+    monkeypatch.setattr(shared_state, "process_excel", gated_process_excel)
+    monkeypatch.setattr(shared_state, "JOB_STATE_FLUSH_SECONDS", 0)
+    process_id = upload(client, *workload, no_cache=1).get_json()["process_id"]
+    assert started.wait(30)
+
+    assert shared_state.request_job_cancel(process_id)
+    gate.set()
+
+    assert wait_job(process_id)["status"] == "cancelled"
+    assert process_id not in shared_state.active_processes
+
+
+def test_reports_requested_once_across_workers(client, workload, shared_state):
+    """La reserva de reportes vive en el almacén compartido, no en la copia de cada worker"""
+    process_id = upload(client, *workload, summary=1, no_cache=1).get_json()["process_id"]
+    assert wait_job(process_id)["status"] == "completed"
+
+    first = client.post(f"/jobs/{process_id}/reports")
+    assert first.status_code == 202
+    reports_id = first.get_json()["process_id"]
+
+    # Otro worker carga el resultado publicado, todavía con sus archivos de entrada
+    with shared_state.process_lock:
+        shared_state.job_results.pop(process_id)
+    second = client.post(f"/jobs/{process_id}/reports")
+    assert second.status_code == 409
+    assert second.get_json()["process_id"] == reports_id
+
+    assert wait_job(reports_id)["status"] == "completed"
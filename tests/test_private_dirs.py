@@ -0,0 +1,50 @@
+import os
+import stat
+
+import pandas as pd
+import pytest
+
+import app
+
+
+def test_data_dirs_are_private(workload):
+    crystal, query = workload
+    app.active_processes["test-private"] = {"status": "starting", "progress": 0}
+    try:
+        result = app.process_excel(crystal, query, "test-private")
+    finally:
+        app.active_processes.pop("test-private", None)
+    assert "error" not in result
+
+    for path in (app.DATA_DIR, app.PARSED_CACHE_DIR, app.RESULT_CACHE_DIR, app.ARTIFACTS_DIR):
+        info = os.stat(path)
+        assert info.st_uid == os.getuid()
+        assert stat.S_IMODE(info.st_mode) == 0o700, path
+
+
+def test_private_dir_tightens_own_directory(tmp_path):
+    path = tmp_path / "abierto"
+    path.mkdir(mode=0o777)
+    os.chmod(path, 0o777)
+    app.private_dir(str(path))
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason="cambiar el dueño de un archivo requiere root")
+def test_foreign_pickles_are_refused(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "PARSED_CACHE_DIR", str(tmp_path / "parsed_cache"))
+    app.put_cached_input("ajeno", pd.DataFrame({"a": [1]}), ("a", None, None))
+    path = app.parsed_cache_path("ajeno")
+    assert app.get_cached_input("ajeno") is not None
+
+    os.chown(path, 12345, -1)
+    with pytest.raises(PermissionError):
+        app.read_private_pickle(path)
+    assert app.get_cached_input("ajeno") is None
+    assert not os.path.exists(path)
+
+    foreign_dir = tmp_path / "ajeno"
+    foreign_dir.mkdir()
+    os.chown(foreign_dir, 12345, -1)
+    with pytest.raises(PermissionError):
+        app.private_dir(str(foreign_dir))
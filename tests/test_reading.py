@@ -0,0 +1,58 @@
+import app
+
+
+def run_process(crystal, query, process_id, **kwargs):
+    app.active_processes[process_id] = {"status": "starting", "progress": 0}
+    try:
+        return app.process_excel(crystal, query, process_id, use_cache=False, **kwargs)
+    finally:
+        app.active_processes.pop(process_id, None)
+        app.remove_job_dir(app.job_artifact_dir(process_id))
+
+
+def count_opens(monkeypatch):
+    opened = []
+    open_first_sheet = app.open_first_sheet
+
+    def counting_open(path):
+        opened.append(path)
+        return open_first_sheet(path)
+
+    monkeypatch.setattr(app, "open_first_sheet", counting_open)
+    return opened
+
+
+def test_each_input_is_opened_once(workload, fresh_caches, monkeypatch):
+    """Encabezados y filas salen del mismo libro abierto"""
+    opened = count_opens(monkeypatch)
+    result = run_process(*workload, "test-open-once")
+    assert "error" not in result
+    assert sorted(opened) == sorted(workload)
+
+
+def test_sqlite_engine_opens_each_input_once(workload, fresh_caches, monkeypatch):
+    opened = count_opens(monkeypatch)
+    app.active_processes["test-open-sqlite"] = {"status": "starting", "progress": 0}
+    try:
+        result = app.process_out_of_core(*workload, "test-open-sqlite")
+    finally:
+        app.active_processes.pop("test-open-sqlite", None)
+    assert "error" not in result
+    assert sorted(opened) == sorted(workload)
+
+
+def test_summary_reads_only_key_columns(workload, fresh_caches, monkeypatch):
+    read_large_excel = app.read_large_excel
+    frames = []
+
+    def recording_read(*args, **kwargs):
+        df = read_large_excel(*args, **kwargs)
+        frames.append(df)
+        return df
+
+    monkeypatch.setattr(app, "read_large_excel", recording_read)
+    summary = run_process(*workload, "test-summary-usecols", summary=True)
+    full = run_process(*workload, "test-summary-full")
+    assert summary["totals"] == full["totals"]
+    assert [len(df.columns) for df in frames[:2]] == [3, 3]
+    assert len(frames[2].columns) > 3
@@ -0,0 +1,44 @@
+import glob
+import os
+
+import pandas as pd
+
+import app
+
+
+def run_process(crystal, query, process_id, **kwargs):
+    app.active_processes[process_id] = {"status": "starting", "progress": 0}
+    try:
+        return app.process_excel(crystal, query, process_id, use_cache=False, **kwargs)
+    finally:
+        app.active_processes.pop(process_id, None)
+
+
+def test_lazy_partitions_keep_only_their_categories(workload):
+    """Cada pendiente del modo diferido lleva solo las categorías de su profesional"""
+    result = run_process(*workload, "test-lazy-categories", lazy=True)
+    assert "error" not in result
+    pending = glob.glob(os.path.join(app.job_artifact_dir("test-lazy-categories"), ".*.pkl"))
+    assert len(pending) == len(result["professional_data"]) + 1
+
+    for path in pending:
+        df = pd.read_pickle(path)["df"]
+        for col, dtype in df.dtypes.items():
+            if isinstance(dtype, pd.CategoricalDtype):
+                assert set(df[col].cat.categories) == set(df[col].unique()), (path, col)
+    app.remove_job_dir(app.job_artifact_dir("test-lazy-categories"))
+
+
+def test_available_cpus_follow_container_quota(monkeypatch, tmp_path):
+    """Medio CPU de cuota (cgroup v2) en un host con más CPUs: un solo proceso"""
+    cpu_max = tmp_path / "cpu.max"
+    monkeypatch.setattr(app, "CGROUP_CPU_FILES", ((str(cpu_max), None),))
+    monkeypatch.setattr(app.os, "sched_getaffinity", lambda pid: set(range(16)))
+
+    cpu_max.write_text("50000 100000\n")
+    assert app.cgroup_cpu_quota() == 0.5
+    assert app.available_cpus() == 1
+
+    cpu_max.write_text("max 100000\n")
+    assert app.cgroup_cpu_quota() is None
+    assert app.available_cpus() == 16
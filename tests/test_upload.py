@@ -0,0 +1,126 @@
+import io
+import threading
+import zipfile
+
+import app
+from conftest import comparable, upload, wait_job
+
+
+def test_upload_status_result(client, workload, fresh_caches):
+    """/upload responde enseguida y el resultado se consulta con /status y /result"""
+    response = upload(client, *workload, no_cache=1)
+    assert response.status_code == 202
+    process_id = response.get_json()["process_id"]
+
+    assert client.get(f"/status/{process_id}").status_code == 200
+    assert wait_job(process_id)["status"] == "completed"
+
+    status = client.get(f"/status/{process_id}").get_json()
+    assert status == {"status": "completed", "progress": 100, "process_id": process_id}
+    summary = client.get(f"/result/{process_id}").get_json()
+    assert summary["totals"] and "professional_data" not in summary
+    full = client.get(f"/result/{process_id}?full=1").get_json()
+    entry = next(iter(full["professional_data"].values()))
+    report = client.get(entry["download_link"])
+    assert report.status_code == 200 and report.data[:2] == b"PK"
+
+    assert client.get('/status/no-existe').status_code == 404
+    assert client.get('/result/no-existe').status_code == 404
+
+
+def test_cancel_process(client, workload, fresh_caches, monkeypatch):
+    gate = threading.Event()
+    run_job = fresh_caches.run_job
+
+    def gated_run_job(*args):
+        gate.wait(10)
+        run_job(*args)
+
+    monkeypatch.setattr(fresh_caches, "run_job", gated_run_job)
+    process_id = upload(client, *workload, no_cache=1).get_json()["process_id"]
+
+    response = client.post('/cancel-process', json={"process_id": process_id})
+    assert response.status_code == 200 and response.get_json()["success"]
+    gate.set()
+
+    assert wait_job(process_id)["status"] == "cancelled"
+    assert client.get(f"/status/{process_id}").get_json()["status"] == "cancelled"
+    assert client.post('/cancel-process', json={"process_id": process_id}).status_code == 404
+    assert client.post('/cancel-process', json={}).status_code == 400
+
+
+def test_download_all_ranges(client, workload, fresh_caches):
+    process_id = upload(client, *workload, no_cache=1).get_json()["process_id"]
+    job = wait_job(process_id)
+    assert job["status"] == "completed"
+
+    full = client.get(f"/download-all/{process_id}")
+    assert full.status_code == 200
+    assert full.headers["Accept-Ranges"] == "bytes"
+    etag = full.headers["ETag"]
+    with zipfile.ZipFile(io.BytesIO(full.data)) as archive:
+        assert archive.testzip() is None
+        names = archive.namelist()
+    result = job["result"]
+    assert len(names) == len(result["professional_data"]) + len(result["user_data"])
+
+    total = len(full.data)
+    part = client.get(f"/download-all/{process_id}", headers={"Range": "bytes=100-"})
+    assert part.status_code == 206
+    assert part.headers["Content-Range"] == f"bytes 100-{total - 1}/{total}"
+    assert part.data == full.data[100:]
+
+    # If-Range: se reanuda con el mismo paquete, si cambió se envía completo
+    resumed = client.get(f"/download-all/{process_id}", headers={"Range": "bytes=0-99", "If-Range": etag})
+    assert resumed.status_code == 206 and resumed.data == full.data[:100]
+    changed = client.get(f"/download-all/{process_id}", headers={"Range": "bytes=0-99", "If-Range": '"otro"'})
+    assert changed.status_code == 200 and changed.data == full.data
+
+    beyond = client.get(f"/download-all/{process_id}", headers={"Range": f"bytes={total}-"})
+    assert beyond.status_code == 416
+    assert beyond.headers["Content-Range"] == f"bytes */{total}"
+
+
+def test_result_cache_hit_and_bypass(client, workload, fresh_caches):
+    def run(**fields):
+        process_id = upload(client, *workload, **fields).get_json()["process_id"]
+        job = wait_job(process_id)
+        assert job["status"] == "completed"
+        return job["result"]
+
+    first = run()
+    assert first["cache"]["result"] == "miss"
+    hit = run()
+    assert hit["cache"]["result"] == "hit"
+    assert comparable(hit) == comparable(first)
+    assert run(no_cache=1)["cache"]["result"] == "bypass"
+
+
+def test_engines_over_http_match_memory(client, workload, fresh_caches):
+    def full_result(**fields):
+        process_id = upload(client, *workload, no_cache=1, **fields).get_json()["process_id"]
+        assert wait_job(process_id)["status"] == "completed"
+        return comparable(client.get(f"/result/{process_id}?full=1").get_json())
+
+    expected = full_result(engine="memory")
+    assert full_result(engine="sqlite") == expected
+    assert full_result(incremental=1, series="test-http") == expected
+
+
+def test_zip_crc_cache_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "ZIP_CRC_CACHE_ENTRIES", 3)
+    monkeypatch.setattr(app, "zip_crc_cache", app.OrderedDict())
+    job_dir = tmp_path / "proceso"
+    job_dir.mkdir()
+    entries = []
+    for i in range(5):
+        path = job_dir / f"reporte_{i}.xlsx"
+        path.write_bytes(b"x" * (i + 1))
+        entries.append({"path": str(path), "size": i + 1, "mtime": path.stat().st_mtime})
+        app.file_crc32(entries[-1])
+    assert len(app.zip_crc_cache) == 3
+    assert [key[0] for key in app.zip_crc_cache] == [entry["path"] for entry in entries[2:]]
+
+    # Borrar el directorio del proceso descarta sus entradas
+    app.remove_job_dir(str(job_dir))
+    assert not app.zip_crc_cache